@@ -0,0 +1,303 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Work out the count, min, max, mean and percentiles of a sensor's readings as they come in. Used by the v2 scripts.
+# Notes: Each channel keeps the most recent readings in a ring buffer with a fixed size so memory use does not grow in
+# daemon mode. The ring buffer is an array of doubles made once and reused each cycle, which takes 8 bytes a reading
+# rather than a Python float object each, and the classes use __slots__ so each object does not carry a dictionary.
+# Percentiles of the ring buffer are exact (same as numpy's default linear method). When bEstimate is set a P-square
+# estimator (Jain & Chlamtac 1985) also tracks one chosen percentile over every reading since the last reset using 5
+# markers. It is off by default as it costs far more per reading than the ring buffer and nothing sends its value yet.
+# The markers are poor for the first few dozen readings, so the first nExact readings are kept and used exactly.
+# Readings that are None (failed the error check) are counted and skipped rather than wiping out the whole result.
+# FilterList() is the same as the numpy filters in filters.py but in plain Python, which is quicker for a few readings
+# (e.g. the 6 DHT22 readings per cycle) and means numpy does not have to be loaded, which is slow on a Pi Zero.
+# Run this file on its own to compare the speed against the old list + sort + np.percentile way and the numpy filters.
+
+# --- Imports ---
+from array import array # Used for the ring buffer
+import math # Used for the percentile position
+
+
+
+# --- Classes ---
+class SampleWindow(object): # Class that keeps the most recent nSize readings in an array that is never made bigger
+	__slots__ = ("nSize", "aValues", "nNext", "nLength")
+
+	def __init__(self, nSize):
+		self.nSize = nSize
+		self.aValues = array("d", [0.0]) * nSize
+		self.nNext = 0 # Position the next reading is put in
+		self.nLength = 0
+
+	def Add(self, dValue):
+		self.aValues[self.nNext] = dValue
+		self.nNext = (self.nNext + 1) % self.nSize
+		if self.nLength < self.nSize:
+			self.nLength += 1
+
+	def Clear(self):
+		self.nNext = 0
+		self.nLength = 0
+
+	def GetValues(self): # Returns a list of the readings, oldest first
+		if self.nLength < self.nSize:
+			return self.aValues[:self.nLength].tolist()
+		return (self.aValues[self.nNext:] + self.aValues[:self.nNext]).tolist()
+
+	def __len__(self):
+		return self.nLength
+
+
+class P2Quantile(object): # Class that estimates a quantile of a stream of values without storing them
+	__slots__ = ("dQuantile", "nExact", "lsFirst", "lsHeights", "lsPositions", "lsDesired", "lsIncrements")
+
+	def __init__(self, dQuantile, nExact=64):
+		self.dQuantile = dQuantile # e.g. 0.8 for the 80th percentile
+		self.nExact = nExact # Until there have been more values than this the quantile of the stored values is used
+		self.lsFirst = [] # The first nExact values
+		self.lsHeights = [] # Marker heights. The first 5 values are stored until the markers can be set up.
+		self.lsPositions = [1, 2, 3, 4, 5] # Actual marker positions
+		self.lsDesired = [1, 1 + 2 * dQuantile, 1 + 4 * dQuantile, 3 + 2 * dQuantile, 5] # Desired marker positions
+		self.lsIncrements = [0, dQuantile / 2, dQuantile, (1 + dQuantile) / 2, 1]
+
+	def Add(self, dValue):
+		if self.lsFirst is not None:
+			if len(self.lsFirst) < self.nExact:
+				self.lsFirst.append(dValue)
+			else: # The markers have seen enough values to be used
+				self.lsFirst = None
+		lsHeights = self.lsHeights
+		if len(lsHeights) < 5:
+			lsHeights.append(dValue)
+			lsHeights.sort()
+			return
+		if dValue < lsHeights[0]: # Find the cell the value is in and update the extreme markers
+			lsHeights[0] = dValue
+			k = 0
+		elif dValue >= lsHeights[4]:
+			lsHeights[4] = dValue
+			k = 3
+		else:
+			k = 0
+			while dValue >= lsHeights[k + 1]:
+				k += 1
+		lsPositions = self.lsPositions
+		for i in range(k + 1, 5):
+			lsPositions[i] += 1
+		for i in range(5):
+			self.lsDesired[i] += self.lsIncrements[i]
+		for i in range(1, 4): # Move the middle markers if they are too far from where they should be
+			d = self.lsDesired[i] - lsPositions[i]
+			if (d >= 1 and lsPositions[i + 1] - lsPositions[i] > 1) or (d <= -1 and lsPositions[i - 1] - lsPositions[i] < -1):
+				nSign = 1 if d > 0 else -1
+				dHeight = self.Parabolic(i, nSign)
+				if not lsHeights[i - 1] < dHeight < lsHeights[i + 1]:
+					dHeight = lsHeights[i] + nSign * (lsHeights[i + nSign] - lsHeights[i]) / float(lsPositions[i + nSign] - lsPositions[i])
+				lsHeights[i] = dHeight
+				lsPositions[i] += nSign
+
+	def Parabolic(self, i, nSign):
+		q, n = self.lsHeights, self.lsPositions
+		return q[i] + nSign / float(n[i + 1] - n[i - 1]) * ((n[i] - n[i - 1] + nSign) * (q[i + 1] - q[i]) / float(n[i + 1] - n[i])
+			+ (n[i + 1] - n[i] - nSign) * (q[i] - q[i - 1]) / float(n[i] - n[i - 1]))
+
+	def GetValue(self): # Returns the estimate or None if there have been no values
+		if len(self.lsHeights) == 0:
+			return None
+		if self.lsFirst is not None: # Too few values for the markers to have settled so work it out exactly
+			return Percentile(sorted(self.lsFirst), self.dQuantile * 100)
+		return self.lsHeights[2]
+
+
+class StreamingAggregator(object): # Class used to summarise the readings from one channel e.g. CT1 real power
+	__slots__ = ("nWindowSize", "dPercentile", "bEstimate", "oWindow", "oEstimator", "nCount", "nSkipped", "dSum", "dMin", "dMax")
+
+	def __init__(self, nWindowSize=256, dPercentile=80, bEstimate=0):
+		self.nWindowSize = nWindowSize
+		self.dPercentile = dPercentile # Percentile sent to emoncms, and tracked over every reading when bEstimate is set
+		self.bEstimate = bEstimate # 1 = also track dPercentile over every reading since the last reset, not just the window
+		self.oWindow = SampleWindow(nWindowSize) # Most recent readings
+		self.Reset()
+
+	def Reset(self): # Clear the readings e.g. at the start of a new cycle
+		self.oWindow.Clear()
+		self.oEstimator = P2Quantile(self.dPercentile / 100.0) if self.bEstimate == 1 else None
+		self.nCount = 0 # Number of good readings
+		self.nSkipped = 0 # Number of readings that were None
+		self.dSum = 0.0
+		self.dMin = None
+		self.dMax = None
+
+	def Add(self, dValue):
+		if dValue is None: # Failed the error check so do not use it
+			self.nSkipped += 1
+			return
+		self.nCount += 1
+		self.dSum += dValue
+		if self.dMin is None or dValue < self.dMin:
+			self.dMin = dValue
+		if self.dMax is None or dValue > self.dMax:
+			self.dMax = dValue
+		self.oWindow.Add(dValue)
+		if self.oEstimator is not None:
+			self.oEstimator.Add(dValue)
+
+	def GetMean(self):
+		return None if self.nCount == 0 else self.dSum / self.nCount
+
+	def GetPercentile(self, dPercent=None): # Exact percentile of the readings in the window, or None if there are none
+		return Percentile(sorted(self.oWindow.GetValues()), self.dPercentile if dPercent is None else dPercent)
+
+	def GetFiltered(self, dictFilter): # Final value of the readings in the window using a filter (see filters.py), or None if there are none
+		return FilterList(self.oWindow.GetValues(), dictFilter)
+
+	def GetEstimate(self): # Estimate of dPercentile over every reading since the last reset, not just the window. None if bEstimate is not set.
+		if self.nCount <= len(self.oWindow): # Every reading is still in the window so the exact value is known
+			return self.GetPercentile()
+		return None if self.oEstimator is None else self.oEstimator.GetValue()
+
+	def GetStats(self): # Returns the summary as a dictionary
+		return {"Count": self.nCount, "Skipped": self.nSkipped, "Min": self.dMin, "Max": self.dMax, "Mean": self.GetMean(),
+			"P" + str(self.dPercentile): self.GetPercentile()}
+
+	def __str__(self): # Used when the readings are printed
+		return str(self.oWindow.GetValues())
+
+
+
+# --- Functions ---
+def Percentile(lsSorted, dPercent): # Percentile of a sorted list using linear interpolation, the same as np.percentile
+	if len(lsSorted) == 0:
+		return None
+	dPosition = (len(lsSorted) - 1) * dPercent / 100.0
+	nLower = int(math.floor(dPosition))
+	nUpper = min(nLower + 1, len(lsSorted) - 1)
+	return lsSorted[nLower] + (lsSorted[nUpper] - lsSorted[nLower]) * (dPosition - nLower)
+
+def Median(lsValues):
+	return Percentile(sorted(lsValues), 50)
+
+def Mean(lsValues):
+	return sum(lsValues) / float(len(lsValues))
+
+def FilterList(lsValues, dictFilter): # Same as filters.FilterValues() without numpy. lsValues is oldest first with None for bad readings.
+	sMethod = dictFilter.get("method", "percentile")
+	if "max_step" in dictFilter:
+		lsValues = RemoveSpikes(lsValues, dictFilter["max_step"])
+	lsGood = [dValue for dValue in lsValues if dValue is not None]
+	if sMethod not in ("percentile", "median_mad", "hampel", "rate", "ewma"):
+		raise ValueError("Unknown filter method " + str(sMethod))
+	if len(lsGood) == 0:
+		return None
+	if sMethod == "percentile":
+		return Percentile(sorted(lsGood), dictFilter.get("percentile", 80))
+	dLimit = dictFilter.get("k", 3.0) * 1.4826 # Robust standard deviations allowed
+	if sMethod == "median_mad":
+		dMedian = Median(lsGood)
+		dMAD = Median([abs(dValue - dMedian) for dValue in lsGood])
+		return Mean([dValue for dValue in lsGood if abs(dValue - dMedian) <= dLimit * dMAD])
+	if sMethod == "hampel":
+		nWindow = int(dictFilter.get("window", 3))
+		lsCleaned = []
+		for (n, dValue) in enumerate(lsValues):
+			if dValue is None:
+				continue
+			lsWindow = [d for d in lsValues[max(0, n - nWindow):n + nWindow + 1] if d is not None]
+			dMedian = Median(lsWindow)
+			dMAD = Median([abs(d - dMedian) for d in lsWindow])
+			lsCleaned.append(dMedian if abs(dValue - dMedian) > dLimit * dMAD else dValue)
+		return Mean(lsCleaned)
+	if sMethod == "rate": # The spikes have already been removed using max_step
+		return Mean(lsGood)
+	dWeight = 1 - dictFilter.get("alpha", 0.3) # ewma. The newest reading has a weight of 1 and bad readings are skipped.
+	lsWeights = [dWeight ** (len(lsValues) - 1 - n) for n in range(len(lsValues))]
+	return (sum(w * dValue for (w, dValue) in zip(lsWeights, lsValues) if dValue is not None)
+		/ sum(w for (w, dValue) in zip(lsWeights, lsValues) if dValue is not None))
+
+def RemoveSpikes(lsValues, dMaxStep): # Same as filters.RemoveSpikes() for a list. Single readings that jump away from the readings around them are set to None.
+	lsGood = [n for (n, dValue) in enumerate(lsValues) if dValue is not None] # Positions of the good readings
+	lsResult = list(lsValues)
+	for (i, n) in enumerate(lsGood):
+		dValue = lsValues[n]
+		lsBefore = [lsValues[m] for m in lsGood[max(0, i - 2):i]] # Up to two good readings either side, nearest last/first
+		lsAfter = [lsValues[m] for m in lsGood[i + 1:i + 3]]
+		if lsBefore and lsAfter:
+			bSpike = abs(dValue - lsBefore[-1]) > dMaxStep and abs(dValue - lsAfter[0]) > dMaxStep and abs(lsBefore[-1] - lsAfter[0]) <= dMaxStep
+		elif len(lsAfter) == 2: # First reading
+			bSpike = abs(dValue - lsAfter[0]) > dMaxStep and abs(lsAfter[0] - lsAfter[1]) <= dMaxStep
+		elif len(lsBefore) == 2: # Last reading
+			bSpike = abs(dValue - lsBefore[-1]) > dMaxStep and abs(lsBefore[-1] - lsBefore[0]) <= dMaxStep
+		else:
+			bSpike = False
+		if bSpike:
+			lsResult[n] = None
+	return lsResult
+
+def BenchmarkFilters(nRuns=2000, lsSizes=(6, 32, 64, 128, 256), nSeed=1): # Compare FilterList with the numpy filters to see where numpy becomes quicker
+	import random
+	import time
+	try:
+		from filters import FilterValues
+	except ImportError:
+		print("numpy is not installed so the filters can not be compared")
+		return
+	oRandom = random.Random(nSeed)
+	for dictFilter in ({"method": "percentile", "percentile": 80}, {"method": "median_mad", "k": 3}, {"method": "hampel", "window": 3, "k": 3},
+			{"method": "rate", "max_step": 10}, {"method": "ewma", "alpha": 0.3, "max_step": 10}):
+		lsResults = []
+		for nSamples in lsSizes:
+			lsRuns = [[None if oRandom.random() < 0.05 else oRandom.gauss(100, 1) + (50 if oRandom.random() < 0.05 else 0) for x in range(nSamples)]
+				for n in range(max(10, nRuns * 6 // nSamples))]
+			dStart = time.time()
+			for lsValues in lsRuns:
+				FilterList(lsValues, dictFilter)
+			dList = (time.time() - dStart) / len(lsRuns)
+			dStart = time.time()
+			for lsValues in lsRuns:
+				FilterValues(lsValues, dictFilter)
+			dNumpy = (time.time() - dStart) / len(lsRuns)
+			for lsValues in lsRuns[:20]: # Check the results are the same
+				dA, dB = FilterList(lsValues, dictFilter), FilterValues(lsValues, dictFilter)
+				if (dA is None) != (dB is None) or (dA is not None and abs(dA - dB) > 1e-6):
+					raise AssertionError(dictFilter["method"] + " does not match numpy: " + str(dA) + " " + str(dB))
+			lsResults.append(str(nSamples) + ": " + "%.0f" % (dList * 1e6) + "/" + "%.0f" % (dNumpy * 1e6))
+		print(dictFilter["method"] + " us per run (readings: list/numpy) " + ", ".join(lsResults))
+
+def Benchmark(nRuns=20000, nSamples=6, nSeed=1): # Compare the time taken to get the 80th percentile of each run's readings
+	import random
+	import time
+	oRandom = random.Random(nSeed)
+	lsRuns = [[oRandom.uniform(0, 4000) for x in range(nSamples)] for n in range(nRuns)]
+
+	dStart = time.time()
+	oAggregator = StreamingAggregator()
+	for lsValues in lsRuns:
+		oAggregator.Reset()
+		for dValue in lsValues:
+			oAggregator.Add(dValue)
+		oAggregator.GetPercentile(80)
+	print("StreamingAggregator: " + "%.1f" % ((time.time() - dStart) / nRuns * 1e6) + " us per run of " + str(nSamples) + " readings")
+
+	try:
+		import numpy as np
+	except ImportError:
+		print("numpy is not installed so the old way can not be timed")
+		return
+	dStart = time.time()
+	for lsValues in lsRuns:
+		lsList = []
+		for dValue in lsValues:
+			lsList.append(dValue)
+		dResult = np.percentile((np.array(sorted(lsList))),80)
+	print("list + sort + np.percentile: " + "%.1f" % ((time.time() - dStart) / nRuns * 1e6) + " us per run of " + str(nSamples) + " readings")
+	for lsValues in lsRuns[:100]: # Check the results are the same
+		if abs(np.percentile(np.array(lsValues), 80) - Percentile(sorted(lsValues), 80)) > 1e-9:
+			raise AssertionError("Percentile does not match numpy")
+
+
+
+# --- Main Code ---
+if __name__ == "__main__":
+	Benchmark()
+	Benchmark(nRuns=200, nSamples=1000)
+	BenchmarkFilters()
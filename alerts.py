@@ -0,0 +1,269 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Check every reading against the alert rules in sensors.json as soon as it is read and send a notification when a
+# rule is broken, e.g. the room is too hot or a circuit is close to its breaker. Used by collector.py and the v2 scripts.
+# Notes: The board's frames are checked by the serial reader as they arrive and each DHT22 reading as soon as it has passed
+# the error check, so an alert goes out within seconds rather than after someone looks at emoncms. Each rule in the
+# "alerts" section of sensors.json has:
+#	inputs - the inputs it applies to, with * as a wildcard e.g. "DHT*_Temperature_C" or "CT1_Irms_A"
+#	above / below - the reading is bad when it is above or below these. Either can be left out.
+#	hysteresis - once alerting the reading has to come back this far inside the limits before the alert clears, so a
+#		reading sitting on the limit does not keep alerting and clearing. Default 0.
+#	hold_s - the reading has to stay bad this long before the alert is sent (hold-off), so one odd reading does not alert. Default 0.
+#	repeat_s - while the alert is still active it is sent again this often. null = only once. Default null.
+#	notify - names of the notifiers to send to. Default ["log"].
+# The notifiers are listed under "notifiers" with a "type" of command (run a local program with the message as its last
+# argument), webhook (POST the alert as JSON to a url), syslog or log (print it), and an optional "max_per_hour" so a
+# fault that keeps alerting can not flood anyone. New types can be added to dictNotifierTypes.
+# The rules are matched to each input the first time it is seen and kept in a dictionary by input name, so checking a
+# reading is one dictionary lookup and a couple of comparisons per rule for that input, however many rules there are in
+# total. Notifications are sent on their own thread (see stages.py) so a slow webhook can not hold up the readings.
+# Where each rule is up to is only kept in memory, so hold_s and repeat_s longer than one run only work in daemon mode.
+
+# --- Imports ---
+import time # Used for the hold-off and rate limits
+import json # Used for the webhook
+import fnmatch # Used to match the rules to the inputs
+import threading # Used as the board and DHT22 sensors are checked on different threads
+from metrics import oSharedMetrics # Used to count the alerts and notifications
+from stages import Stage # Used to send the notifications without holding up the readings
+
+
+
+# --- Classes ---
+class AlertRule(object): # Class for one rule from the config
+	def __init__(self, dictRule):
+		self.sName = dictRule.get("name", dictRule["inputs"])
+		self.sInputs = dictRule["inputs"]
+		dHysteresis = dictRule.get("hysteresis", 0)
+		self.dAbove = float("inf") if dictRule.get("above") is None else float(dictRule["above"]) # inf and -inf so checking a reading needs no checks for None
+		self.dBelow = float("-inf") if dictRule.get("below") is None else float(dictRule["below"])
+		self.dClearAbove = self.dAbove - dHysteresis # Has to come back to here to clear
+		self.dClearBelow = self.dBelow + dHysteresis
+		self.dHold_s = dictRule.get("hold_s", 0)
+		self.dRepeat_s = float("inf") if dictRule.get("repeat_s") is None else dictRule["repeat_s"]
+		self.lsNotify = dictRule.get("notify", ["log"])
+
+	def Describe(self): # Returns the limits as text e.g. "above 30"
+		return " and ".join(s for s in (None if self.dAbove == float("inf") else "above " + str(self.dAbove), None if self.dBelow == float("-inf") else "below " + str(self.dBelow)) if s is not None)
+
+
+class AlertState(object): # Class holding where one rule is up to for one input. There is one for each rule and input so it uses __slots__.
+	__slots__ = ("oRule", "sInputName", "nState", "dSince", "dLastSent")
+
+	def __init__(self, oRule, sInputName):
+		self.oRule = oRule
+		self.sInputName = sInputName
+		self.nState = nOK
+		self.dSince = None # Time the reading went bad
+		self.dLastSent = None # Time the alert was last sent
+
+
+class AlertEngine(object): # Class that checks readings against the rules and sends the alerts
+	def __init__(self, dictAlerts=None, bDebugPrint=0, nMaxQueue=100):
+		self.bDebugPrint = bDebugPrint
+		self.Lock = threading.Lock() # Only used when rules are matched to a new input
+		self.dictAlerts = None
+		self.lsRules = []
+		self.dictNotifiers = {"log": LogNotifier({})}
+		self.dictStates = {} # Input name -> list of AlertStates for the rules that apply to it
+		self.oStage = Stage("alerts", self.Send, nMaxQueue, bDebugPrint).Start()
+		self.SetConfig(dictAlerts or {})
+
+	def SetConfig(self, dictAlerts): # Use the rules and notifiers from the "alerts" section of the config. Only done again when the section has changed.
+		if dictAlerts is self.dictAlerts:
+			return
+		with self.Lock:
+			dictNotifiers = {"log": LogNotifier({})}
+			for (sName, dictNotifier) in dictAlerts.get("notifiers", {}).items():
+				if dictNotifier.get("enabled", 1) == 1:
+					if dictNotifier["type"] not in dictNotifierTypes:
+						raise ValueError("Unknown notifier type " + str(dictNotifier["type"]) + ", use one of " + ", ".join(sorted(dictNotifierTypes)))
+					dictNotifiers[sName] = dictNotifierTypes[dictNotifier["type"]](dictNotifier)
+			dictOldStates = dict(((oState.oRule.sName, oState.sInputName), oState) for lsStates in self.dictStates.values() for oState in lsStates)
+			self.lsRules = [AlertRule(dictRule) for dictRule in dictAlerts.get("rules", [])]
+			self.dictNotifiers = dictNotifiers
+			self.dictStates = {}
+			for (sRule, sInputName), oOldState in dictOldStates.items(): # Carry on with alerts that are already active if their rule is still there
+				lsStates = self.Compile(sInputName)
+				for oState in lsStates:
+					if oState.oRule.sName == sRule:
+						oState.nState, oState.dSince, oState.dLastSent = oOldState.nState, oOldState.dSince, oOldState.dLastSent
+			self.dictAlerts = dictAlerts
+
+	def Compile(self, sInputName): # Match the rules to an input the first time it is seen. Called with the lock held.
+		lsStates = self.dictStates.get(sInputName)
+		if lsStates is None:
+			lsStates = [AlertState(oRule, sInputName) for oRule in self.lsRules if fnmatch.fnmatchcase(sInputName, oRule.sInputs)]
+			self.dictStates[sInputName] = lsStates
+		return lsStates
+
+	def Check(self, sInputName, dValue, dTime=None): # Check a reading against the rules for its input. Only readings that passed the error check should be given.
+		lsStates = self.dictStates.get(sInputName)
+		if lsStates is None:
+			with self.Lock:
+				lsStates = self.Compile(sInputName)
+		if dTime is None:
+			dTime = time.time()
+		for oState in lsStates: # Nothing to do for an input no rules apply to
+			oRule = oState.oRule
+			if oState.nState == nAlerting:
+				if oRule.dClearBelow <= dValue <= oRule.dClearAbove:
+					oState.nState = nOK
+					self.Notify(oState, "cleared", dValue, dTime)
+				elif dTime - oState.dLastSent >= oRule.dRepeat_s:
+					self.Notify(oState, "still active", dValue, dTime)
+			elif dValue > oRule.dAbove or dValue < oRule.dBelow:
+				if oState.nState == nOK:
+					oState.nState = nPending
+					oState.dSince = dTime
+				if dTime - oState.dSince >= oRule.dHold_s:
+					oState.nState = nAlerting
+					self.Notify(oState, "active", dValue, dTime)
+			elif oState.nState == nPending: # Went back inside the limits before the hold-off so nothing is sent
+				oState.nState = nOK
+
+	def Notify(self, oState, sStatus, dValue, dTime):
+		oState.dLastSent = dTime
+		oRule = oState.oRule
+		dictAlert = {"rule": oRule.sName, "input": oState.sInputName, "value": dValue, "status": sStatus, "time": dTime, "limits": oRule.Describe(),
+			"message": oRule.sName + " " + sStatus + ": " + oState.sInputName + " is " + "%.2f" % dValue + " (alert when " + oRule.Describe() + ")"}
+		oSharedMetrics.Inc("alerts_total", rule=oRule.sName, status=sStatus)
+		self.oStage.Put((oRule.lsNotify, dictAlert))
+
+	def Send(self, tItem): # Run on the alerts stage's thread
+		lsNotify, dictAlert = tItem
+		for sName in lsNotify:
+			oNotifier = self.dictNotifiers.get(sName)
+			if oNotifier is None:
+				if self.bDebugPrint == 1:
+					print("Alert notifier " + sName + " is not in the config or is disabled")
+				continue
+			if not oNotifier.Allow(dictAlert["time"]):
+				oSharedMetrics.Inc("alert_notifications_total", notifier=sName, result="limited")
+				continue
+			try:
+				oNotifier.Send(dictAlert)
+				oSharedMetrics.Inc("alert_notifications_total", notifier=sName, result="sent")
+			except Exception as e: # One notifier failing should not stop the others
+				oSharedMetrics.Inc("alert_notifications_total", notifier=sName, result="failed")
+				if self.bDebugPrint == 1:
+					print("Alert notifier " + sName + " failed: " + str(e))
+
+	def GetActive(self): # Returns a list of (rule name, input name) for the alerts that are active
+		return sorted((oState.oRule.sName, oState.sInputName) for lsStates in list(self.dictStates.values()) for oState in lsStates if oState.nState == nAlerting)
+
+	def Stop(self): # Send the notifications that are still queued
+		self.oStage.Stop()
+
+
+class Notifier(object): # Base class for the notifiers. Keeps to max_per_hour.
+	def __init__(self, dictNotifier):
+		self.nMaxPerHour = dictNotifier.get("max_per_hour") # None = no limit
+		self.dTokens = self.nMaxPerHour
+		self.dLastTime = None
+
+	def Allow(self, dTime): # Returns True if another notification can be sent. The allowance refills evenly over the hour.
+		if self.nMaxPerHour is None:
+			return True
+		if self.dLastTime is not None:
+			self.dTokens = min(self.nMaxPerHour, self.dTokens + max(0, dTime - self.dLastTime) * self.nMaxPerHour / 3600.0)
+		self.dLastTime = dTime
+		if self.dTokens < 1:
+			return False
+		self.dTokens -= 1
+		return True
+
+
+class LogNotifier(Notifier): # Print the alert
+	def Send(self, dictAlert):
+		print(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(dictAlert["time"])) + " ALERT " + dictAlert["message"])
+
+
+class CommandNotifier(Notifier): # Run a local program e.g. a script that sounds a buzzer. The message is passed as its last argument.
+	def __init__(self, dictNotifier):
+		Notifier.__init__(self, dictNotifier)
+		self.lsCommand = dictNotifier["command"] if isinstance(dictNotifier["command"], list) else [dictNotifier["command"]]
+
+	def Send(self, dictAlert):
+		import subprocess # Only imported when a command is used
+		nReturn = subprocess.call(self.lsCommand + [dictAlert["message"]])
+		if nReturn != 0:
+			raise RuntimeError(" ".join(self.lsCommand) + " returned " + str(nReturn))
+
+
+class WebhookNotifier(Notifier): # POST the alert as JSON to a url e.g. a chat or paging service
+	def __init__(self, dictNotifier):
+		Notifier.__init__(self, dictNotifier)
+		self.sURL = dictNotifier["url"]
+		self.dTimeout_s = dictNotifier.get("timeout_s", 10)
+
+	def Send(self, dictAlert):
+		try: # Only imported when a webhook is used
+			from urllib.request import urlopen, Request # Python 3
+		except ImportError:
+			from urllib2 import urlopen, Request # Python 2
+		oRequest = Request(self.sURL, json.dumps(dictAlert, sort_keys=True).encode("utf-8"), {"Content-Type": "application/json"})
+		urlopen(oRequest, timeout=self.dTimeout_s).close()
+
+
+class SyslogNotifier(Notifier): # Write the alert to the system log so it is picked up by whatever watches the log
+	def __init__(self, dictNotifier):
+		Notifier.__init__(self, dictNotifier)
+		import syslog # Only imported when syslog is used. Not available on Windows.
+		self.syslog = syslog
+
+	def Send(self, dictAlert):
+		self.syslog.syslog(self.syslog.LOG_INFO if dictAlert["status"] == "cleared" else self.syslog.LOG_ALERT, "RPi_Server_Room_Monitor: " + dictAlert["message"])
+
+
+
+# --- Functions ---
+def SelfTest(): # Check the hold-off, hysteresis, repeat and rate limit
+	lsSent = []
+	class ListNotifier(Notifier):
+		def Send(self, dictAlert):
+			lsSent.append((dictAlert["input"], dictAlert["status"], dictAlert["time"]))
+	dictNotifierTypes["list"] = ListNotifier
+	try:
+		oEngine = AlertEngine({"notifiers": {"test": {"type": "list", "max_per_hour": 3}}, "rules": [
+			{"name": "Hot", "inputs": "DHT*_Temperature_C", "above": 30, "hysteresis": 1, "hold_s": 10, "repeat_s": 60, "notify": ["test"]},
+			{"name": "Voltage", "inputs": "VT1_Vrms_V", "below": 216.2, "above": 253, "hysteresis": 2, "notify": ["test"]}]})
+		for (dTime, dValue) in ((0, 29), (5, 31), (10, 29.5), (20, 31), (25, 31), (30, 31), (31, 29.5), (40, 28.9), (50, 31), (60, 31), (120, 31), (200, 31), (300, 31)):
+			oEngine.Check("DHT1_Temperature_C", dValue, dTime)
+		for (dTime, dValue) in ((301, 240), (302, 210), (303, 217), (304, 219), (305, 260)):
+			oEngine.Check("VT1_Vrms_V", dValue, dTime)
+		oEngine.Check("CT1_Irms_A", 20, 0) # No rules
+		oEngine.Stop()
+		lsExpected = [("DHT1_Temperature_C", "active", 30), ("DHT1_Temperature_C", "cleared", 40), ("DHT1_Temperature_C", "active", 60)] # The repeats and the voltage alert are over 3 per hour
+		if lsSent != lsExpected or oEngine.GetActive() != [("Hot", "DHT1_Temperature_C"), ("Voltage", "VT1_Vrms_V")]:
+			raise AssertionError("Sent " + str(lsSent) + " but expected " + str(lsExpected) + ", active " + str(oEngine.GetActive()))
+		print("Alert self test passed")
+	finally:
+		del dictNotifierTypes["list"]
+
+def Benchmark(nRules=500, nInputs=100, nReadings=200000): # Time checking readings with a lot of rules
+	import random
+	oRandom = random.Random(1)
+	lsInputs = ["CT" + str(n) + "_Irms_A" for n in range(nInputs)]
+	lsRules = [{"name": "Rule" + str(n), "inputs": "CT" + str(n % nInputs) + "_Irms_A" if n % 50 else "CT*_Irms_A", "above": 12 + oRandom.random(), "hysteresis": 0.5,
+		"hold_s": 5, "notify": []} for n in range(nRules)]
+	oEngine = AlertEngine({"rules": lsRules})
+	lsReadings = [(oRandom.choice(lsInputs), oRandom.uniform(0, 13)) for n in range(nReadings)]
+	dStart = time.time()
+	for (n, (sInputName, dValue)) in enumerate(lsReadings):
+		oEngine.Check(sInputName, dValue, n * 0.01)
+	dElapsed_s = time.time() - dStart
+	oEngine.Stop()
+	print(str(nRules) + " rules over " + str(nInputs) + " inputs: " + "%.2f" % (dElapsed_s / nReadings * 1e6) + " us per reading ("
+		+ "%.0f" % (nRules / float(nInputs)) + " rules per input), " + str(len(oEngine.GetActive())) + " alerts active")
+
+
+
+# --- Main Code ---
+nOK, nPending, nAlerting = 0, 1, 2 # States of a rule for an input
+dictNotifierTypes = {"log": LogNotifier, "command": CommandNotifier, "webhook": WebhookNotifier, "syslog": SyslogNotifier} # Add new types of notifier here
+
+if __name__ == "__main__":
+	SelfTest()
+	Benchmark()
@@ -0,0 +1,251 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Measure how long each part of a cycle takes using simulated hardware so it can be run on any Linux machine.
+# Notes: The board is replaced by rpict3v1.SimulatedBoard, the DHT22 sensors by dht.SimulatedDHTBackend and the emoncms
+# servers by emoncms.StubEmoncmsServer, so nothing needs to be connected and no data is sent anywhere. The sensors and
+# channels come from sensors.json. For each part the time per cycle (mean, 95th percentile and max), the throughput and
+# the peak memory of the process are printed so a change can be compared before and after.
+# The start up time of each script is also timed by running its imports in a new Python process, as happens every
+# minute when it is run from cron, along with which of the slow to load modules (e.g. numpy) were loaded.
+# Run it with: python benchmark.py [number of cycles] [capture file]
+# Given a capture file recorded with sCapturePath (see capture.py), the real traffic in it is also replayed and timed.
+# A day of readings is also run in simulated time (frames given straight to the board pipeline with made up timestamps)
+# to check the memory used by a collector in daemon mode stays flat rather than growing each cycle.
+
+# --- Imports ---
+import sys # Used for the number of cycles
+import time # Used for the timings
+import os # Used for the temporary files
+import shutil # Used to remove the temporary files
+import tempfile # Used for the outbox and history
+import subprocess # Used to time starting each script in a new process
+import gc # Used to count the Python objects in the memory benchmark
+try:
+	import resource # Used for the peak memory. Not available on Windows.
+except ImportError:
+	resource = None
+from aggregate import Percentile # Used for the 95th percentile of the cycle times
+from config import GetRegistry, sDefaultPath # Used to load the sensors
+from pipelines import BoardPipeline, DHTPipeline # Used to take the readings
+from rpict3v1 import SimulatedBoard # Used in place of the board
+from dht import DHTScheduler, SimulatedDHTBackend # Used in place of the DHT22 sensors
+from emoncms import EmoncmsBatch, EmoncmsServer, PublishToServers, StubEmoncmsServer # Used in place of the emoncms servers
+from outbox import Outbox # Used to time posting through the outbox
+from publish import PublishPolicy, PublishChanges # Used to only post the values that have changed as collector.py does
+from history import HistoryStore # Used to time saving the history
+from stages import Stage # Used to save the history and post on their own threads as collector.py does
+from capture import Replay, PrintCounts # Used to time replaying a capture of real traffic
+from alerts import AlertEngine # Used to check the readings against the alert rules as collector.py does
+
+
+
+# --- Functions ---
+def GetPeakMemory_MB(): # Peak memory used by the process so far, or None if it can not be found
+	if resource is None:
+		return None
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0 # kB on Linux
+
+def GetRSS_MB(): # Memory the process is using now, or None if it can not be found. Only works on Linux.
+	try:
+		with open("/proc/self/status") as f:
+			for sLine in f:
+				if sLine.startswith("VmRSS:"):
+					return int(sLine.split()[1]) / 1024.0 # kB
+	except IOError:
+		pass
+	return None
+
+def PrintTimes(sName, lsTimes, sThroughput=""): # Print the mean, 95th percentile and max of a list of times
+	lsSorted = sorted(lsTimes)
+	dPeak_MB = GetPeakMemory_MB()
+	print(sName + ": mean " + "%.2f" % (1000 * sum(lsSorted) / len(lsSorted)) + " ms, p95 " + "%.2f" % (1000 * Percentile(lsSorted, 95))
+		+ " ms, max " + "%.2f" % (1000 * lsSorted[-1]) + " ms" + sThroughput + ("" if dPeak_MB is None else ", peak memory " + "%.1f" % dPeak_MB + " MB"))
+
+def BenchmarkStartup(nRuns=5, lsScripts=("collector.py", "read_board_v2.py", "read_sensors_v2.py")): # Time the imports of each script in a new process
+	sFolder = os.path.dirname(os.path.abspath(__file__))
+	lsSlowModules = ["numpy", "ssl", "sqlite3", "serial", "Adafruit_DHT"] # Modules that take a while to load on a Pi
+	sCheck = "\nimport sys\nprint(','.join(s for s in " + repr(lsSlowModules) + " if s in sys.modules))\n" # Print which ones were loaded
+	lsRuns = [("python only", "pass\n")] # Python on its own to compare against
+	for sScript in lsScripts:
+		with open(os.path.join(sFolder, sScript)) as f:
+			sSource = f.read()
+		lsRuns.append((sScript, sSource[sSource.index("# --- Imports ---"):sSource.index("# ---", sSource.index("# --- Imports ---") + 1)])) # Just the imports so nothing is read or sent
+	lsRuns.append(("first DHT22 cycle", "from config import GetRegistry, sDefaultPath\nfrom pipelines import DHTPipeline\nfrom dht import DHTScheduler, SimulatedDHTBackend\n"
+		"DHTPipeline(DHTScheduler(SimulatedDHTBackend(), 1, 0.01), 6, 0).Read(GetRegistry(sDefaultPath))\n")) # Imports plus working out the final values
+	for (sName, sCode) in lsRuns:
+		lsTimes = []
+		for n in range(nRuns):
+			dStart = time.time()
+			sLoaded = subprocess.check_output([sys.executable, "-c", sCode + sCheck], cwd=sFolder).decode().strip()
+			lsTimes.append(time.time() - dStart)
+		print("Start up (" + sName + "): first " + "%.0f" % (1000 * lsTimes[0]) + " ms, then mean "
+			+ "%.0f" % (1000 * sum(lsTimes[1:]) / max(1, len(lsTimes) - 1)) + " ms" + (", loaded " + sLoaded if sLoaded else ""))
+
+def BenchmarkBoard(oRegistry, nCycles, dCycle_s=0.5): # Read the simulated board as fast as it can send and time working out the final values
+	oBoard = BoardPipeline(100000, 0, 0, SimulatedBoard(dGarbageRate=0.01, dFramesPerSecond=None, nSeed=1).Open, bEnergy=1)
+	lsTimes = []
+	nFrames = 0
+	oBoard.Start(oRegistry)
+	for n in range(nCycles):
+		time.sleep(dCycle_s) # Frames arrive in the background as they would between cycles
+		nFirst = oBoard.nLastFrame
+		dStart = time.time()
+		oBoard.Read(oRegistry)
+		lsTimes.append(time.time() - dStart)
+		nFrames += oBoard.nLastFrame - nFirst
+		oBoard.Start(oRegistry)
+	oBoard.Stop()
+	PrintTimes("Board (store + filters + energy)", lsTimes, ", " + "%.0f" % (nFrames / (nCycles * dCycle_s)) + " frames/s read from the serial port")
+
+def BenchmarkDHT(oRegistry, nCycles): # Read the simulated DHT22 sensors with some failures
+	oBackend = SimulatedDHTBackend(dFailureRate=0.2, dLatency_s=0.005, nSeed=1)
+	oDHT = DHTPipeline(DHTScheduler(oBackend, 1, 0.01), 6, 0)
+	lsTimes = []
+	for n in range(nCycles):
+		dStart = time.time()
+		oDHT.Read(oRegistry)
+		lsTimes.append(time.time() - dStart)
+	PrintTimes("DHT22 (6 readings)", lsTimes, ", " + "%.1f" % (oBackend.nReads / float(nCycles)) + " tries per cycle")
+
+def BenchmarkPublish(oRegistry, nCycles, sPath): # Post a full batch to two stub servers, straight and through the outbox
+	lsStubs = [StubEmoncmsServer(dLatency_s=0.005).Start() for n in range(2)]
+	lsServers = [EmoncmsServer("Stub" + str(n), oStub.GetAddress(), "/", "key", dTimeout_s=5) for (n, oStub) in enumerate(lsStubs)]
+	oOutbox = Outbox(os.path.join(sPath, "outbox.db"))
+	for (sName, oUseOutbox) in (("Publish", None), ("Publish with outbox", oOutbox)):
+		lsTimes = []
+		for n in range(nCycles):
+			oBatch = MakeBatch(oRegistry, n)
+			dStart = time.time()
+			lsResults = PublishToServers(lsServers, oBatch, 0, oUseOutbox)
+			lsTimes.append(time.time() - dStart)
+			if not all(oResult.bSuccess == 1 for oResult in lsResults):
+				raise AssertionError("Post to a stub server failed")
+		PrintTimes(sName + " (2 servers)", lsTimes, ", " + str(len(oBatch.dictValues[oRegistry.sNodeID])) + " values per post")
+	oOutbox.Close()
+	for oStub in lsStubs:
+		oStub.Stop()
+
+def BenchmarkCollector(oRegistry, nCycles, sPath, dCycle_s=0.5, dServerLatency_s=0.005): # Whole cycles as collector.py runs them: board and DHT22 at once, then history and posting on their own threads
+	oStub = StubEmoncmsServer(dLatency_s=dServerLatency_s).Start()
+	lsServers = [EmoncmsServer("Stub", oStub.GetAddress(), "/", "key", dTimeout_s=5)]
+	oOutbox = Outbox(os.path.join(sPath, "outbox_collector.db"))
+	oHistory = HistoryStore(os.path.join(sPath, "history"))
+	oPolicy = PublishPolicy() # Last values sent are only kept in memory
+	def SaveHistory(oBatch):
+		oHistory.AddBatch(oBatch)
+		oHistory.Flush()
+	oHistoryStage = Stage("history", SaveHistory).Start()
+	oPublishStage = Stage("publish", lambda oBatch: PublishChanges(oPolicy, lsServers, oBatch, oRegistry.dictPublish, 0, oOutbox)).Start()
+	oBoard = BoardPipeline(1000, 0, 0, SimulatedBoard(dGarbageRate=0.01, dFramesPerSecond=50, nSeed=2).Open, bEnergy=1)
+	oDHT = DHTPipeline(DHTScheduler(SimulatedDHTBackend(dFailureRate=0.2, dLatency_s=0.005, nSeed=2), 1, 0.01), 6, 0)
+	lsTimes = []
+	for n in range(nCycles):
+		dStart = time.time()
+		oBoard.Start(oRegistry)
+		oDHT.Read(oRegistry)
+		oBoard.Read(oRegistry)
+		oBatch = EmoncmsBatch()
+		oBoard.AddToBatch(oBatch, oRegistry)
+		oDHT.AddToBatch(oBatch, oRegistry)
+		oBatch.SetTimestamp(int(time.time()))
+		oHistoryStage.Put(oBatch)
+		oPublishStage.Put(oBatch)
+		lsTimes.append(time.time() - dStart)
+		time.sleep(max(0, dCycle_s - lsTimes[-1]))
+	oBoard.Stop()
+	dStart = time.time()
+	oPublishStage.Stop() # Wait for the posts that are still queued
+	oHistoryStage.Stop()
+	dFinish_s = time.time() - dStart
+	oHistory.Close()
+	oOutbox.Close()
+	oStub.Stop()
+	PrintTimes("Collector cycle (server takes " + "%.0f" % (dServerLatency_s * 1000) + " ms)", lsTimes, ", " + str(oStub.nRequests) + " posts for "
+		+ str(nCycles) + " cycles, " + "%.2f" % dFinish_s + " s to finish posting after the last cycle")
+
+def BenchmarkMemory(oRegistry, sPath, nHours=24, nFramesPerMinute=60): # Run a reading a minute for nHours of simulated time, as collector.py does in daemon mode, and check the memory stays flat
+	oStub = StubEmoncmsServer(nMaxRequests=10).Start()
+	lsServers = [EmoncmsServer("Stub", oStub.GetAddress(), "/", "key", dTimeout_s=5)]
+	oOutbox = Outbox(os.path.join(sPath, "outbox_memory.db"))
+	oHistory = HistoryStore(os.path.join(sPath, "history_memory"))
+	oPolicy = PublishPolicy()
+	oAlerts = AlertEngine()
+	oBoard = BoardPipeline(1000, 0, 0, bEnergy=1, oAlerts=oAlerts)
+	oDHT = DHTPipeline(DHTScheduler(SimulatedDHTBackend(dFailureRate=0.2, nSeed=3), 1, 0), 6, 0, oAlerts)
+	oSimulatedBoard = SimulatedBoard(dGarbageRate=0.01, nSeed=3) # Frames are given to the pipeline with simulated times so a day takes seconds
+	dStart = 1500000000.0
+	lsHours = [] # (hour, RSS, number of Python objects)
+	dTimer = time.time()
+	for nMinute in range(nHours * 60):
+		dNow = dStart + nMinute * 60
+		for n in range(nFramesPerMinute):
+			oBoard.AddData(oRegistry, oSimulatedBoard.MakeLine(), dNow + n * 60.0 / nFramesPerMinute)
+		oBoard.Start(oRegistry)
+		oDHT.Read(oRegistry)
+		oBoard.Read(oRegistry)
+		oBatch = EmoncmsBatch()
+		oBoard.AddToBatch(oBatch, oRegistry)
+		oDHT.AddToBatch(oBatch, oRegistry)
+		oBatch.SetTimestamp(int(dNow))
+		oHistory.AddBatch(oBatch)
+		oHistory.Flush()
+		oSend = oPolicy.Apply(oBatch, oRegistry.dictPublish, dNow)
+		PublishToServers(lsServers, oSend, 0, oOutbox)
+		oPolicy.Commit(oSend, dNow)
+		if nMinute % 60 == 59:
+			gc.collect()
+			lsHours.append((nMinute // 60 + 1, GetRSS_MB(), len(gc.get_objects())))
+	dElapsed_s = time.time() - dTimer
+	oAlerts.Stop()
+	oHistory.Close()
+	oOutbox.Close()
+	oStub.Stop()
+	nFirst, dFirst_MB, nFirstObjects = lsHours[0]
+	nLast, dLast_MB, nLastObjects = lsHours[-1]
+	if dFirst_MB is not None:
+		print("Memory over " + str(nHours) + " h of simulated readings (" + "%.1f" % dElapsed_s + " s): RSS " + "%.1f" % dFirst_MB + " MB after 1 h, "
+			+ "%.1f" % dLast_MB + " MB after " + str(nLast) + " h (" + "%+.2f" % (dLast_MB - dFirst_MB) + " MB), " + str(nFirstObjects) + " -> "
+			+ str(nLastObjects) + " Python objects, RSS each hour " + " ".join("%.1f" % dRSS_MB for (nHour, dRSS_MB, nObjects) in lsHours))
+	return lsHours
+
+def MakeBatch(oRegistry, nCycle): # A batch with a value for every board channel and DHT22 reading
+	oBatch = EmoncmsBatch()
+	for (oSensor, sSensorValueType) in oRegistry.lsChannels:
+		oBatch.AddValue(oRegistry.sNodeID, oSensor.sName, sSensorValueType, 100.0 + nCycle)
+	for oSensor in oRegistry.lsDHTSensors:
+		oBatch.AddValue(oRegistry.sNodeID, oSensor.sName, "Temperature_C", 22.0, sFormat="%.1f")
+		oBatch.AddValue(oRegistry.sNodeID, oSensor.sName, "Humidity_P", 45.0, sFormat="%.1f")
+	return oBatch
+
+def BenchmarkReplay(sCapturePath): # Replay a capture of real traffic through the pipelines
+	lsTimes = []
+	dictLast = {"Time": time.time()}
+	def TimeCycle(oBatch):
+		lsTimes.append(time.time() - dictLast["Time"])
+		dictLast["Time"] = time.time()
+	dictCounts = Replay(sCapturePath, fnBatch=TimeCycle)
+	PrintCounts(sCapturePath, dictCounts)
+	if lsTimes:
+		PrintTimes("Replayed cycle", lsTimes)
+
+def Benchmark(nCycles=10, sCapturePath=None):
+	oRegistry = GetRegistry(sDefaultPath)
+	sPath = tempfile.mkdtemp()
+	try:
+		BenchmarkStartup()
+		BenchmarkBoard(oRegistry, nCycles)
+		BenchmarkDHT(oRegistry, nCycles)
+		BenchmarkPublish(oRegistry, nCycles * 5, sPath)
+		BenchmarkCollector(oRegistry, nCycles, sPath)
+		BenchmarkCollector(oRegistry, nCycles, sPath, dServerLatency_s=1.0) # A slow server must not slow down the readings
+		BenchmarkMemory(oRegistry, sPath)
+		if sCapturePath is not None:
+			BenchmarkReplay(sCapturePath)
+	finally:
+		shutil.rmtree(sPath)
+
+
+
+# --- Main Code ---
+if __name__ == "__main__":
+	Benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 10, sys.argv[2] if len(sys.argv) > 2 else None)
@@ -0,0 +1,222 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Record every raw read from the RPICT3V1 board and the DHT22 sensors to a file and replay it later through the same
+# decoding, error checks and filters. Used by collector.py and the v2 scripts when sCapturePath is set.
+# Notes: When a CT reads oddly the debug prints have long since scrolled away, so the raw data can be recorded and replayed
+# on any machine as many times as needed, as fast as the code can go rather than in real time. It is also used to benchmark
+# changes against real traffic rather than the simulated board.
+# The file is append only. Each record is a 1 byte type, the monotonic time (8 byte double) and the length of the data
+# (2 bytes), followed by the data:
+#	session - written each time the file is opened, with the wall clock time so the monotonic times can be turned back into real times
+#	serial - the bytes exactly as they were read from the serial port, before the decoder has seen them
+#	dht - one try of a DHT22 sensor: pin, humidity and temperature (NaN if the try failed)
+#	board - the board pipeline took the frames received so far for a cycle
+#	dht cycle - the DHT22 pipeline started a cycle, with the number of readings it takes
+# A file ending in .gz is compressed with gzip. The file is flushed at the end of each cycle so at most one cycle is lost if
+# the Pi loses power, and a record cut short at the end of the file is ignored.
+# Replay with: python capture.py replay <file> [sensors.json]
+
+# --- Imports ---
+import os # Used for the file size
+import sys # Used for the command line
+import time # Used for the timestamps
+import math # Used for NaN
+import struct # Used to pack the records
+import gzip # Used to compress the file
+import threading # Used as the board and DHT22 sensors are read on their own threads
+
+
+
+# --- Classes ---
+class CaptureRecorder(object): # Class that writes records to a capture file. Does nothing until Open() is called.
+	def __init__(self):
+		self.File = None
+		self.Lock = threading.Lock()
+		self.nRecords = 0
+		self.dOffset = 0.0 # Wall clock time minus monotonic time, worked out the same way as ReadCapture() does
+
+	def Open(self, sPath): # Start recording. Records are added to the end of the file if it already exists.
+		with self.Lock:
+			self.File = gzip.open(sPath, "ab") if sPath.endswith(".gz") else open(sPath, "ab")
+		dMonotonic = fnMonotonic()
+		dWallClock = time.time()
+		self.dOffset = dWallClock - dMonotonic
+		self.Add(nSession, struct.pack("<d", dWallClock), dMonotonic)
+		return self
+
+	def Add(self, nType, Data=b"", dTime=None): # dTime is the monotonic time of the record, or None for now
+		if self.File is None: # Not recording. This is checked first so it costs almost nothing when recording is off.
+			return
+		Data = bytes(Data)
+		with self.Lock:
+			if self.File is None:
+				return
+			dTime = fnMonotonic() if dTime is None else dTime
+			for nStart in range(0, max(1, len(Data)), 65535): # The length has to fit in 2 bytes
+				sChunk = Data[nStart:nStart + 65535]
+				self.File.write(struct.pack(sHeader, nType, dTime, len(sChunk)) + sChunk)
+				self.nRecords += 1
+
+	def AddSerial(self, Data, dTimestamp=None): # Bytes read from the serial port. dTimestamp is the wall clock time the serial reader gave them.
+		if self.File is not None:
+			self.Add(nSerial, Data, None if dTimestamp is None else dTimestamp - self.dOffset) # Replayed as exactly dTimestamp as the offset is close to it
+
+	def AddDHT(self, nPin, dHumidity_P, dTemperature_C): # One try of a DHT22 sensor. None if it failed.
+		if self.File is not None:
+			self.Add(nDHT, struct.pack(sDHT, nPin, float("nan") if dHumidity_P is None else dHumidity_P, float("nan") if dTemperature_C is None else dTemperature_C))
+
+	def AddBoardCycle(self): # The frames received so far have been taken for a cycle
+		if self.File is not None:
+			self.Add(nBoardCycle)
+			self.Flush()
+
+	def AddDHTCycle(self, nReadings): # The DHT22 pipeline is about to take nReadings readings
+		if self.File is not None:
+			self.Add(nDHTCycle, struct.pack("<H", nReadings))
+			self.Flush()
+
+	def Flush(self):
+		with self.Lock:
+			if self.File is not None:
+				self.File.flush()
+
+	def Close(self):
+		with self.Lock:
+			if self.File is not None:
+				self.File.close()
+				self.File = None
+
+
+
+# --- Functions ---
+def ReadCapture(sPath): # Yields (type, wall clock time, data) for each record in a capture file
+	File = gzip.open(sPath, "rb") if sPath.endswith(".gz") else open(sPath, "rb")
+	nHeader = struct.calcsize(sHeader)
+	dOffset = 0.0 # Wall clock time minus monotonic time for the current session
+	try:
+		while True:
+			try:
+				sRecord = File.read(nHeader)
+				if len(sRecord) < nHeader:
+					return
+				nType, dTime, nLength = struct.unpack(sHeader, sRecord)
+				Data = File.read(nLength)
+			except (EOFError, IOError, struct.error): # Cut short when the Pi lost power
+				return
+			if len(Data) < nLength:
+				return
+			if nType == nSession:
+				dOffset = struct.unpack("<d", Data)[0] - dTime
+			yield nType, dTime + dOffset, Data
+	finally:
+		File.close()
+
+def Replay(sPath, sConfigPath=None, fnBatch=None, bDebugPrint=0): # Replay a capture through the board and DHT22 pipelines. fnBatch is called with each cycle's batch. Returns a dictionary of counts.
+	from config import GetRegistry, sDefaultPath # Only imported when replaying
+	from pipelines import BoardPipeline, DHTPipeline
+	from dht import DHTScheduler, ReplayDHTBackend
+	from emoncms import EmoncmsBatch
+	oRegistry = GetRegistry(sDefaultPath if sConfigPath is None else sConfigPath)
+	oBackend = ReplayDHTBackend()
+	for (nType, dTime, Data) in ReadCapture(sPath): # The DHT22 tries are read first as each cycle's tries are recorded after its start
+		if nType == nDHT:
+			nPin, dHumidity_P, dTemperature_C = struct.unpack(sDHT, Data)
+			oBackend.AddRead(nPin, None if math.isnan(dHumidity_P) else round(dHumidity_P, 1), None if math.isnan(dTemperature_C) else round(dTemperature_C, 1))
+	oBoard = BoardPipeline(100000, 0, bDebugPrint, bEnergy=1) # Energy totals are only kept in memory
+	oDHT = DHTPipeline(DHTScheduler(oBackend, 1e9, 0), 6, bDebugPrint) # No waiting between tries
+	dictCounts = {"Records": 0, "Bytes": 0, "BoardCycles": 0, "DHTCycles": 0, "Start": None, "End": None}
+	dStart = time.time()
+	for (nType, dTime, Data) in ReadCapture(sPath):
+		dictCounts["Records"] += 1
+		dictCounts["Start"] = dTime if dictCounts["Start"] is None else dictCounts["Start"]
+		dictCounts["End"] = dTime
+		if nType == nSerial:
+			dictCounts["Bytes"] += len(Data)
+			oBoard.AddData(oRegistry, Data, dTime)
+		elif nType in (nBoardCycle, nDHTCycle):
+			oBatch = EmoncmsBatch()
+			if nType == nBoardCycle:
+				oBoard.Start(oRegistry)
+				oBoard.Read(oRegistry)
+				oBoard.AddToBatch(oBatch, oRegistry)
+				dictCounts["BoardCycles"] += 1
+			else:
+				oDHT.nReadings = struct.unpack("<H", Data)[0]
+				oDHT.Read(oRegistry)
+				oDHT.AddToBatch(oBatch, oRegistry)
+				dictCounts["DHTCycles"] += 1
+			oBatch.SetTimestamp(int(dTime))
+			if fnBatch is not None:
+				fnBatch(oBatch)
+	dictCounts["Replay_s"] = time.time() - dStart
+	return dictCounts
+
+def PrintBatch(oBatch): # Print the values of a replayed cycle
+	for sNodeID in oBatch.lsNodeIDs:
+		for (sInputName, sValue, nTimestamp) in oBatch.dictValues[sNodeID]:
+			print(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(nTimestamp)) + " " + sNodeID + " " + sInputName + " " + sValue)
+
+def PrintCounts(sPath, dictCounts):
+	dCaptured_s = 0 if dictCounts["Start"] is None else dictCounts["End"] - dictCounts["Start"]
+	print("Replayed " + str(dictCounts["Records"]) + " records (" + "%.1f" % (os.path.getsize(sPath) / 1024.0) + " kB on disk, " + str(dictCounts["Bytes"])
+		+ " bytes from the serial port), " + str(dictCounts["BoardCycles"]) + " board and " + str(dictCounts["DHTCycles"]) + " DHT22 cycles covering "
+		+ "%.1f" % dCaptured_s + " s in " + "%.2f" % dictCounts["Replay_s"] + " s (" + "%.0f" % (dCaptured_s / max(dictCounts["Replay_s"], 1e-9)) + " x real time)")
+
+def SelfTest(nCycles=3, dCycle_s=0.5): # Record the simulated board and DHT22 sensors through the pipelines, replay the capture and check the values match
+	import tempfile
+	import shutil
+	from config import GetRegistry, sDefaultPath
+	from pipelines import BoardPipeline, DHTPipeline
+	from rpict3v1 import SimulatedBoard
+	from dht import DHTScheduler, SimulatedDHTBackend
+	from emoncms import EmoncmsBatch
+	from capture import oSharedRecorder as oRecorder # The one used by the pipelines, not the copy made when this file is run on its own
+	sFolder = tempfile.mkdtemp()
+	try:
+		for sName in ("capture.bin", "capture.bin.gz"):
+			sPath = os.path.join(sFolder, sName)
+			oRecorder.Open(sPath)
+			oRegistry = GetRegistry(sDefaultPath)
+			oBoard = BoardPipeline(1000, 0, 0, SimulatedBoard(dGarbageRate=0.05, dFramesPerSecond=50, nSeed=1).Open, bEnergy=1)
+			oDHT = DHTPipeline(DHTScheduler(SimulatedDHTBackend(dFailureRate=0.3, nSeed=1), 1, 0), 6, 0)
+			lsLive = []
+			for n in range(nCycles):
+				oBoard.Start(oRegistry)
+				time.sleep(dCycle_s)
+				oDHT.Read(oRegistry)
+				oBoard.Read(oRegistry)
+				for oPipeline in (oDHT, oBoard): # The order their cycles were recorded in
+					oBatch = EmoncmsBatch()
+					oPipeline.AddToBatch(oBatch, oRegistry)
+					lsLive.append(oBatch.dictValues)
+			oBoard.Stop()
+			oRecorder.Close()
+			lsReplayed = []
+			dictCounts = Replay(sPath, fnBatch=lambda oBatch: lsReplayed.append(dict((sNodeID, [(sInputName, sValue, None) for (sInputName, sValue, nTimestamp) in lsValues])
+				for (sNodeID, lsValues) in oBatch.dictValues.items())))
+			if lsReplayed != lsLive:
+				raise AssertionError("Replayed values do not match the live values: " + str(lsReplayed) + " != " + str(lsLive))
+			PrintCounts(sPath, dictCounts)
+		with open(sPath, "rb") as f: # Cut the file short as if the Pi lost power while writing
+			Data = f.read()
+		with open(sPath, "wb") as f:
+			f.write(Data[:-7])
+		Replay(sPath)
+		print("Capture self test passed: the replayed values match the live values for " + str(nCycles) + " cycles")
+	finally:
+		shutil.rmtree(sFolder)
+
+
+
+# --- Main Code ---
+nSession, nSerial, nDHT, nBoardCycle, nDHTCycle = 0, 1, 2, 3, 4 # Record types
+sHeader = "<BdH" # Type, monotonic time, length of the data
+sDHT = "<Hff" # Pin, humidity, temperature
+fnMonotonic = getattr(time, "monotonic", time.time) # Python 2 does not have a monotonic clock
+oSharedRecorder = CaptureRecorder() # Shared by the serial reader and DHT22 scheduler
+
+if __name__ == "__main__":
+	if len(sys.argv) > 2 and sys.argv[1] == "replay":
+		PrintCounts(sys.argv[2], Replay(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None, PrintBatch))
+	else:
+		SelfTest()
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Read the CT/VT board and the DHT22 sensors in one script and post all the readings to emoncms together.
+# Notes: Replaces running read_board_v2.py and read_sensors_v2.py side by side. The serial port is read on a background
+# thread while the DHT22 sensors are being read, then the readings from both are put in one batch so each server gets one
+# post per cycle for the Server_Room node, with the power and temperature readings at the same time. Only one process
+# has to start, load numpy and keep web connections open. The sensors are listed in sensors.json.
+# Saving the history and posting to the servers are done on their own threads (see stages.py) so a slow server or SD card
+# never delays the next set of readings. The values are given the time they were read, so they are posted with the input/bulk API.
+# Set bDaemonMode to 1 to keep the script running and take readings every dCycleInterval_s rather than starting it from cron.
+
+# --- Imports ---
+import os # Used for the outbox path
+import time # Used for the time the readings were taken
+from config import GetRegistry, sDefaultPath # Used to load the sensors, channels and servers from sensors.json
+from pipelines import BoardPipeline, DHTPipeline # Used to take the readings and work out the final values
+from dht import DHTScheduler, AdafruitDHTBackend, SimulatedDHTBackend # Used to read all the oDHT22 temperature and humidity sensors at the same time
+from emoncms import EmoncmsBatch # Used to gather all the values into one post per server
+from publish import PublishPolicy, PublishChanges # Used to only send values that have changed and send them to all the emoncms servers at the same time
+from outbox import Outbox # Used to keep readings on the SD card until the servers have them
+from rpict3v1 import SimulatedBoard # Used to run without the board
+from history import HistoryStore # Used to keep a history of the readings on the Pi
+from scheduler import FixedIntervalScheduler # Used to take readings at a fixed interval in daemon mode
+from metrics import oSharedMetrics, MetricsServer # Used to see where each cycle's time goes
+from stages import Stage # Used to save the history and post to the servers without holding up the readings
+from capture import oSharedRecorder # Used to record the raw readings so they can be replayed later
+from alerts import AlertEngine # Used to send an alert as soon as a reading breaks a rule in sensors.json
+
+
+
+# --- Functions ---
+def RunCycle(): # Take a set of readings from every sensor, work out the final values and send them to emoncms
+	oRegistry = GetRegistry(sConfigPath) # Only read again if sensors.json has been changed
+	if bReadBoard == 1:
+		oBoard.Start(oRegistry) # Frames keep arriving in the background while the DHT22 sensors are read
+	if bReadDHT == 1:
+		oDHT.Read(oRegistry)
+	if bReadBoard == 1:
+		oBoard.Read(oRegistry) # Only waits if the DHT22 sensors took less than dSampleWindow_s on the first cycle
+
+	oBatch = EmoncmsBatch() # All the values are sent in one request per server rather than one request per value
+	if bReadBoard == 1:
+		oBoard.AddToBatch(oBatch, oRegistry)
+	if bReadDHT == 1:
+		oDHT.AddToBatch(oBatch, oRegistry)
+	oBatch.SetTimestamp(int(time.time())) # So the values have the right time even if they are posted later
+	if oHistoryStage is not None: # Keep a copy on the Pi with 1 minute, 15 minute and 1 hour rollups
+		oHistoryStage.Put(oBatch)
+	if bDebugSendData == 1: # Send data to the emoncms servers
+		oPublishStage.Put((oRegistry, oBatch))
+	if sMetricsPath is not None:
+		oSharedMetrics.Dump(sMetricsPath)
+
+def SaveHistory(oBatch): # Run on the history stage's thread
+	oHistory.AddBatch(oBatch)
+	oHistory.Flush()
+
+def Publish(tItem): # Run on the publish stage's thread
+	oRegistry, oBatch = tItem
+	PublishChanges(oPublishPolicy, oRegistry.lsServers, oBatch, oRegistry.dictPublish, bDebugPrint, oOutbox)
+
+
+
+# --- Control Settings ---
+bDebugPrint = 0 # 0/1 will disable/enable debug print statements
+bDebugSendData = 1 # Enable sending data to emoncms servers
+bReadBoard = 1 # Read the CT and VT board
+bReadDHT = 1 # Read the DHT22 sensors
+bSimulate = 0 # 1 = use a simulated board and DHT22 sensors so the script can be run on a machine without them
+bDaemonMode = 0 # 0 = take one set of readings and exit e.g. when run from cron, 1 = keep running
+dCycleInterval_s = 60 # Time between the start of each set of readings in daemon mode. Can be less than a minute.
+bOfflineBuffer = 1 # 1 = keep readings on the SD card until each server has accepted them, so nothing is lost while a server is down
+sOutboxPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "outbox_collector.db") # Database used to keep the readings
+bPublishOnChange = 1 # 1 = only send values that have changed by more than their deadband or are due a heartbeat (see publish.py and sensors.json)
+sPublishStatePath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "publish_collector.json") # File used to keep the last values sent
+sCapturePath = None # File every raw read from the sensors is recorded to so it can be replayed with capture.py e.g. os.path.join(os.path.dirname(os.path.abspath(__file__)), "capture_collector.bin.gz"). None = off.
+bAlerts = 1 # 1 = check every reading against the alert rules in sensors.json as soon as it is read and send the alerts (see alerts.py)
+bEnergy = 1 # 1 = also send the kWh total, apparent power, power factor and peak power of each CT worked out from every frame (see energy.py). Only used when bDaemonMode = 1.
+sEnergyStatePath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "energy_collector.json") # File used to keep the kWh totals between runs
+bHistory = 1 # 1 = keep a history of the readings on the SD card (see history.py for how long each level is kept)
+sHistoryPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "history") # Folder used for the history
+nMetricsPort = 9105 # Port the metrics are served on in daemon mode at /metrics (Prometheus) and /metrics.json. None = off.
+sMetricsPath = None # File the metrics are written to as JSON after each cycle e.g. when run from cron. None = off.
+nStageQueueSize = 60 # Cycles that can be waiting to be saved or posted before the oldest is dropped. The outbox keeps trying each server so this only fills if posting itself is stuck.
+sConfigPath = sDefaultPath # File listing the sensors, their pins, the order of the board channels and the emoncms servers
+dSampleWindow_s = 30 # Time spent collecting frames from the board on the first cycle, or on every run when not in daemon mode
+nFrameBufferSize = 1000 # Number of frames kept in memory by the serial reader
+dReadDeadline_s = 8 # Time each DHT22 sensor has to give a good reading. There are 6 readings per cycle so keep this below dCycleInterval_s / 6.
+
+
+
+# --- Main Code ---
+if sCapturePath is not None:
+	oSharedRecorder.Open(sCapturePath)
+oAlerts = AlertEngine(None, bDebugPrint) if bAlerts == 1 else None # The rules are loaded from sensors.json each cycle
+oOutbox = Outbox(sOutboxPath) if bOfflineBuffer == 1 else None
+oPublishPolicy = PublishPolicy(sPublishStatePath, bDebugPrint) if bPublishOnChange == 1 else None
+if bEnergy == 1 and bDaemonMode == 0: # From cron the board is only read for dSampleWindow_s of each minute so the kWh total would miss the rest
+	bEnergy = 0
+	if bDebugPrint == 1:
+		print("The energy totals are only worked out in daemon mode")
+oHistory = HistoryStore(sHistoryPath) if bHistory == 1 else None
+oHistoryStage = Stage("history", SaveHistory, nStageQueueSize, bDebugPrint).Start() if bHistory == 1 else None
+oPublishStage = Stage("publish", Publish, nStageQueueSize, bDebugPrint).Start()
+if bSimulate == 1:
+	oBoard = BoardPipeline(nFrameBufferSize, dSampleWindow_s, bDebugPrint, SimulatedBoard(dGarbageRate=0.01).Open, bEnergy, sEnergyStatePath, oAlerts)
+	oDHTBackend = SimulatedDHTBackend(dFailureRate=0.2, dLatency_s=0.02)
+else:
+	oBoard = BoardPipeline(nFrameBufferSize, dSampleWindow_s, bDebugPrint, None, bEnergy, sEnergyStatePath, oAlerts)
+	oDHTBackend = AdafruitDHTBackend()
+if bReadDHT == 1:
+	oDHT = DHTPipeline(DHTScheduler(oDHTBackend, dReadDeadline_s), 6, bDebugPrint, oAlerts)
+
+if bDaemonMode == 1:
+	if nMetricsPort is not None:
+		MetricsServer(oSharedMetrics, nMetricsPort).Start() # e.g. curl http://localhost:9105/metrics
+	FixedIntervalScheduler(dCycleInterval_s, bDebugPrint).Run(RunCycle) # Keeps the sensors, serial reader and web connections open between cycles
+else:
+	RunCycle()
+oSharedRecorder.Close()
+if oAlerts is not None:
+	oAlerts.Stop() # Send any alerts that are still queued
+oPublishStage.Stop() # Finish posting what has been queued
+if oHistoryStage is not None:
+	oHistoryStage.Stop()
+	oHistory.Close() # Write anything still buffered
+if sMetricsPath is not None:
+	oSharedMetrics.Dump(sMetricsPath) # Again now the posts have finished
+
+
+
+if bDebugPrint == 1:
+	print("Script Finished")
+#End of script
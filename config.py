@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Load the sensors, channels and emoncms servers from sensors.json. Used by the v2 scripts.
+# Notes: The sensors used to be written into the Main Code of each script. Now they are listed in a JSON file along with
+# their pins, the serial port, turns ratios, the range of good readings, the filters, the servers to post to and when to post, and
+# GetRegistry() turns the file into a SensorRegistry that the scripts loop over. Sensors can be added without changing any
+# code. The file is only read again when it has been changed (its modified time is checked), so in daemon mode the scripts
+# can call GetRegistry() every cycle to pick up changes and it costs one os.stat() when nothing has changed.
+# The filter for a reading (see filters.py) is the first one found of: the sensor's "filters" for that type of reading, the
+# sensor's "filter", the "filter" of the board or dht section, the "filter" in "aggregation", and the percentile.
+
+# --- Imports ---
+import os # Used to check when the file was changed
+import json # Used to read the file
+import threading # Used in case the registry is asked for from more than one thread
+from sensors import CTVTSensor, DHTSensor # Used to create the sensors
+from emoncms import EmoncmsServer # Used to create the servers
+from gateway import GatewayServer # Used for servers that are a gateway collecting the readings from many rooms
+from rpict3v1 import ChannelScale # Used to work out the scale of each board channel
+
+
+
+# --- Classes ---
+class SensorRegistry(object): # Class holding everything created from one version of the config file
+	def __init__(self, dictConfig):
+		self.dictConfig = dictConfig
+		self.sNodeID = dictConfig.get("node", "Server_Room") # Node IDs cant have spaces in them
+		dictAggregation = dictConfig.get("aggregation", {})
+		self.dPercentile = dictAggregation.get("percentile", 80) # Percentile sent to emoncms
+		self.nWindowSize = dictAggregation.get("window", 256) # Most readings kept by each aggregator
+		dictFilter = dictAggregation.get("filter", {"method": "percentile", "percentile": self.dPercentile}) # Filter used when a section or sensor does not set one
+		self.dictPublish = dictConfig.get("publish", {}) # Deadbands and intervals used to decide which values are sent (see publish.py)
+		self.dictAlerts = dictConfig.get("alerts", {}) # Rules each reading is checked against and where the alerts are sent (see alerts.py)
+		self.lsServers = [GetServer(dictServer) for dictServer in dictConfig.get("servers", [])]
+
+		dictBoard = dictConfig.get("board", {})
+		self.sSerialPort = dictBoard.get("port", "/dev/ttyAMA0")
+		self.nBaudRate = dictBoard.get("baudrate", 38400)
+		self.lsCTVTSensors = [CTVTSensor(dictSensor["name"], dictSensor.get("turns_ratio", 1), dictSensor.get("enabled", 1), GetLimits(dictSensor),
+			GetFilters(dictSensor, dictBoard.get("filter", dictFilter), CTVTSensor.dictDefaultLimits)) for dictSensor in dictBoard.get("sensors", [])]
+		dictCTVTSensors = dict((oSensor.sName, oSensor) for oSensor in self.lsCTVTSensors)
+		self.lsChannels = [] # (sensor, reading type) for each value in a frame, in the order the board sends them
+		for (sName, sSensorValueType) in dictBoard.get("channels", []):
+			if sName not in dictCTVTSensors:
+				raise ValueError("Board channel " + sName + "_" + sSensorValueType + " is for a sensor that is not in the config")
+			if sSensorValueType not in CTVTSensor.dictDefaultLimits:
+				raise ValueError("Board channel " + sName + "_" + sSensorValueType + " has an unknown reading type")
+			self.lsChannels.append((dictCTVTSensors[sName], sSensorValueType))
+		dictEnergy = dictBoard.get("energy", {})
+		self.dEnergyMaxGap_s = dictEnergy.get("max_gap_s", 10) # Longest time between frames that is integrated for the kWh totals (see energy.py)
+		self.sVoltageSensor = dictEnergy.get("voltage") # VT used for the apparent power. None = the first VT in the channels.
+
+		dictDHT = dictConfig.get("dht", {})
+		self.lsDHTSensors = [DHTSensor(dictSensor["name"], dictSensor["pin"], dictSensor.get("enabled", 1), GetLimits(dictSensor), self.nWindowSize, self.dPercentile,
+			GetFilters(dictSensor, dictDHT.get("filter", dictFilter), DHTSensor.dictDefaultLimits)) for dictSensor in dictDHT.get("sensors", [])]
+
+	def Close(self): # Close the connections to the servers. Done when the config file changes and a new registry replaces this one.
+		for oServer in self.lsServers:
+			oServer.Close()
+
+	def GetChannelNames(self): # Names of the board channels e.g. "CT1_Irms_A"
+		return [oSensor.sName + "_" + sSensorValueType for (oSensor, sSensorValueType) in self.lsChannels]
+
+	def GetChannelScales(self): # Scale for each board channel using its sensor's turns ratio
+		return [ChannelScale(sSensorValueType, oSensor.nTurnsRatio) for (oSensor, sSensorValueType) in self.lsChannels]
+
+	def GetChannelLimits(self): # Returns (list of minimums, list of maximums) for the board channels
+		return ([oSensor.dictLimits[sSensorValueType][0] for (oSensor, sSensorValueType) in self.lsChannels],
+			[oSensor.dictLimits[sSensorValueType][1] for (oSensor, sSensorValueType) in self.lsChannels])
+
+	def GetChannelFilters(self): # Filter for each board channel
+		return [oSensor.dictFilters[sSensorValueType] for (oSensor, sSensorValueType) in self.lsChannels]
+
+	def GetEnergyChannels(self): # Returns a list of (CT name, power column, current column, voltage column) for each sensor with a real power channel
+		dictColumns = dict(((oSensor.sName, sSensorValueType), nColumn) for (nColumn, (oSensor, sSensorValueType)) in enumerate(self.lsChannels))
+		lsVoltages = [nColumn for ((sName, sSensorValueType), nColumn) in sorted(dictColumns.items(), key=lambda t: t[1])
+			if sSensorValueType == "Vrms_V" and self.sVoltageSensor in (None, sName)]
+		nVoltage = lsVoltages[0] if lsVoltages else None
+		return [(oSensor.sName, nColumn, dictColumns.get((oSensor.sName, "Irms_A")), nVoltage) for (nColumn, (oSensor, sSensorValueType)) in enumerate(self.lsChannels)
+			if sSensorValueType == "RealPower_W"]
+
+
+
+# --- Functions ---
+def GetLimits(dictSensor): # Range of good readings set for a sensor in the config, as a dictionary of (min, max)
+	return dict((sSensorValueType, tuple(lsRange)) for (sSensorValueType, lsRange) in dictSensor.get("limits", {}).items())
+
+def GetServer(dictServer): # Returns the server to post to. An address starting with udp:// is a gateway (see gateway.py).
+	if dictServer["address"].lower().startswith("udp://"):
+		return GatewayServer(dictServer["name"], dictServer["address"], dictServer.get("enabled", 1), dictServer.get("timeout_s", 5))
+	return EmoncmsServer(dictServer["name"], dictServer["address"], dictServer.get("location", "/"), dictServer["apikey"],
+		dictServer.get("enabled", 1), dictServer.get("timeout_s", 10))
+
+def GetFilters(dictSensor, dictDefault, lsSensorValueTypes): # Filter for each type of reading a sensor has, as a dictionary
+	dictFilters = dictSensor.get("filters", {})
+	for sSensorValueType in dictFilters:
+		if sSensorValueType not in lsSensorValueTypes:
+			raise ValueError("Sensor " + dictSensor["name"] + " has a filter for an unknown reading type " + sSensorValueType)
+	dictDefault = dictSensor.get("filter", dictDefault)
+	return dict((sSensorValueType, dictFilters.get(sSensorValueType, dictDefault)) for sSensorValueType in lsSensorValueTypes)
+
+def LoadConfig(sPath): # Returns the config file as a dictionary. The file is only read again when it has been changed.
+	dModified = os.stat(sPath).st_mtime
+	with Lock:
+		if sPath in dictConfigCache and dictConfigCache[sPath][0] == dModified:
+			return dictConfigCache[sPath][1]
+	with open(sPath) as f:
+		dictConfig = json.load(f)
+	with Lock:
+		dictConfigCache[sPath] = (dModified, dictConfig)
+	return dictConfig
+
+def GetRegistry(sPath): # Returns the SensorRegistry for a config file. The same object is returned until the file is changed.
+	dictConfig = LoadConfig(sPath)
+	with Lock:
+		if sPath in dictRegistryCache and dictRegistryCache[sPath].dictConfig is dictConfig:
+			return dictRegistryCache[sPath]
+	oRegistry = SensorRegistry(dictConfig)
+	with Lock:
+		oOldRegistry = dictRegistryCache.get(sPath)
+		dictRegistryCache[sPath] = oRegistry
+	if oOldRegistry is not None: # Nothing else keeps the old registry so its sockets would only be closed when it is garbage collected
+		oOldRegistry.Close()
+	return oRegistry
+
+
+
+# --- Main Code ---
+Lock = threading.Lock()
+dictConfigCache = {} # Path -> (modified time, dictionary)
+dictRegistryCache = {} # Path -> SensorRegistry
+sDefaultPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sensors.json") # Config file used by the v2 scripts
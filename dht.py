@@ -0,0 +1,217 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Read all the DHT22 sensors at the same time. Used by read_sensors_v2.py
+# Notes: Adafruit_DHT.read_retry tries 15 times waiting 2 seconds between each try and the sensors were read one after
+# the other, so a sensor that is not working could hold up the whole run for minutes. Here each sensor is read on its own
+# thread and is given a deadline, so the time taken is that of the slowest sensor rather than the sum of all of them.
+# The driver is passed in as a backend so the code can be run with a simulated sensor on a machine without the sensors.
+# ReplayDHTBackend gives back the tries recorded by capture.py so a capture can be replayed.
+# Each sensor has a RetryPolicy that keeps track of how well it has been working. Healthy sensors are given fewer tries,
+# and a sensor that keeps failing (e.g. nothing connected to the pin) is quarantined and only tried now and then.
+# A thread stuck in the driver can not be stopped, so it is left to finish and its pin is not read again (it is counted as
+# busy) until it has, so two threads never use the same pin or RetryPolicy at once.
+
+# --- Imports ---
+import time # Used for the delay
+import threading # Used to read the sensors at the same time
+import random # Used by the simulated sensor
+import math # Used to work out the number of tries
+import collections # Used for the replayed tries
+from metrics import oSharedMetrics # Used to count the tries for each pin
+from capture import oSharedRecorder # Used to record every try when capturing is on
+
+
+
+# --- Classes ---
+class AdafruitDHTBackend(object): # Backend that reads a real sensor using the Adafruit_DHT library
+	def __init__(self, nSensorType=None):
+		import Adafruit_DHT # Python library for accessing the DHT22 temperature and humidity sensor. Only imported when real sensors are used.
+		self.Adafruit_DHT = Adafruit_DHT
+		self.nSensorType = Adafruit_DHT.AM2302 if nSensorType is None else nSensorType # AM2302 is the same as the DHT22
+
+	def Read(self, nPin): # Try to read the sensor once. Returns (humidity, temperature) or (None, None) if the read failed.
+		return self.Adafruit_DHT.read(self.nSensorType, nPin) # The function needs to know the type of sensor and the RPi GPIO pin number
+
+
+class SimulatedDHTBackend(object): # Backend that pretends to be a sensor so the code can be tested without the hardware
+	def __init__(self, dTemperature_C=22.0, dHumidity_P=45.0, dFailureRate=0.0, dLatency_s=0.0, lsDeadPins=(), nSeed=None):
+		self.dTemperature_C = dTemperature_C
+		self.dHumidity_P = dHumidity_P
+		self.dFailureRate = dFailureRate # Fraction of reads that fail, as happens when the linux kernel takes priority
+		self.dLatency_s = dLatency_s # Time taken by each read
+		self.lsDeadPins = list(lsDeadPins) # Pins where every read fails e.g. a sensor that is not connected
+		self.Random = random.Random(nSeed)
+		self.Lock = threading.Lock() # random.Random is shared between the threads
+		self.nReads = 0
+
+	def Read(self, nPin):
+		time.sleep(self.dLatency_s)
+		with self.Lock:
+			self.nReads += 1
+			if nPin in self.lsDeadPins or self.Random.random() < self.dFailureRate:
+				return None, None
+			return round(self.dHumidity_P + self.Random.uniform(-1, 1), 1), round(self.dTemperature_C + self.Random.uniform(-0.5, 0.5), 1)
+
+
+class ReplayDHTBackend(object): # Backend that gives back the tries recorded in a capture file (see capture.py), in the order they were made
+	def __init__(self):
+		self.dictReads = {} # Pin -> deque of (humidity, temperature)
+		self.nReads = 0
+
+	def AddRead(self, nPin, dHumidity_P, dTemperature_C):
+		self.dictReads.setdefault(nPin, collections.deque()).append((dHumidity_P, dTemperature_C))
+
+	def Read(self, nPin): # Only called from one thread per pin so each pin's tries stay in order
+		self.nReads += 1
+		dqReads = self.dictReads.get(nPin)
+		if not dqReads: # Nothing more was recorded for this pin
+			return None, None
+		return dqReads.popleft()
+
+
+class RetryPolicy(object): # Class used to keep track of how well a sensor is working and decide how many times to try it
+	def __init__(self, nMinTries=2, nMaxTries=15, dTarget=0.95, nQuarantineAfter=3, nMaxSkip=32):
+		self.nMinTries = nMinTries
+		self.nMaxTries = nMaxTries # Same as Adafruit_DHT.read_retry
+		self.dTarget = dTarget # Chance of getting a good reading that the number of tries is chosen for
+		self.nQuarantineAfter = nQuarantineAfter # Number of failed readings in a row before the sensor is quarantined
+		self.nMaxSkip = nMaxSkip # Most readings that will be skipped between tries of a quarantined sensor
+		self.dAttemptSuccessRate = 0.5 # Moving average of the chance that one try works. Starts off unsure.
+		self.dAvgLatency_s = None # Moving average of the time taken by one try
+		self.nAttempts = 0 # Number of times the driver has been called
+		self.nReads = 0 # Number of readings asked for (each can be a number of tries)
+		self.nSuccesses = 0
+		self.nFailures = 0
+		self.nConsecutiveFailures = 0
+		self.nSkipped = 0 # Number of readings skipped while quarantined
+		self.nSkipRemaining = 0 # Readings still to skip in the current quarantine
+		self.nSkipNext = 1 # Readings to skip next time the sensor is quarantined. Doubles each time up to nMaxSkip.
+		self.nBusy = 0 # Number of readings skipped because the last one was still stuck in the driver
+		self.Lock = threading.RLock() # A stuck read from an earlier cycle can still be updating the policy
+
+	def IsQuarantined(self): # Returns True if this reading should be skipped
+		with self.Lock:
+			if self.nSkipRemaining > 0:
+				self.nSkipRemaining -= 1
+				self.nSkipped += 1
+				return True
+			return False
+
+	def GetMaxTries(self): # Number of tries needed to get a good reading dTarget of the time given how well the sensor has been working
+		with self.Lock:
+			if self.nConsecutiveFailures >= self.nQuarantineAfter: # Just coming out of quarantine so only try once to see if it works now
+				return 1
+			dFailRate = 1 - self.dAttemptSuccessRate
+		if dFailRate <= 0:
+			return self.nMinTries
+		if dFailRate >= 1:
+			return self.nMaxTries
+		nTries = int(math.ceil(math.log(1 - self.dTarget) / math.log(dFailRate)))
+		return max(self.nMinTries, min(self.nMaxTries, nTries))
+
+	def RecordAttempt(self, bSuccess, dLatency_s): # Record the result of one call to the driver
+		with self.Lock:
+			self.nAttempts += 1
+			self.dAttemptSuccessRate += 0.2 * (bSuccess - self.dAttemptSuccessRate)
+			self.dAvgLatency_s = dLatency_s if self.dAvgLatency_s is None else self.dAvgLatency_s + 0.2 * (dLatency_s - self.dAvgLatency_s)
+
+	def RecordRead(self, bSuccess): # Record whether a reading worked after all its tries
+		with self.Lock:
+			self.nReads += 1
+			if bSuccess == 1:
+				self.nSuccesses += 1
+				self.nConsecutiveFailures = 0
+				self.nSkipNext = 1
+				return
+			self.nFailures += 1
+			self.nConsecutiveFailures += 1
+			if self.nConsecutiveFailures >= self.nQuarantineAfter: # Keeps failing so stop trying it for a while
+				self.nSkipRemaining = self.nSkipNext
+				self.nSkipNext = min(self.nSkipNext * 2, self.nMaxSkip)
+
+	def RecordBusy(self): # Record a reading skipped because the sensor's last read has not finished
+		with self.Lock:
+			self.nBusy += 1
+
+	def GetStats(self): # Returns the counters as a dictionary
+		with self.Lock:
+			return {"Reads": self.nReads, "Successes": self.nSuccesses, "Failures": self.nFailures, "Attempts": self.nAttempts,
+				"Skipped": self.nSkipped, "Busy": self.nBusy, "ConsecutiveFailures": self.nConsecutiveFailures, "AttemptSuccessRate": self.dAttemptSuccessRate,
+				"AvgLatency_s": self.dAvgLatency_s, "MaxTries": self.GetMaxTries(), "Quarantined": int(self.nSkipRemaining > 0)}
+
+
+class DHTScheduler(object): # Class used to read a number of DHT sensors at the same time
+	def __init__(self, oBackend, dDeadline_s=8, dRetryDelay_s=2):
+		self.oBackend = oBackend
+		self.dDeadline_s = dDeadline_s # Time allowed for each sensor to give a good reading
+		self.dRetryDelay_s = dRetryDelay_s # The DHT22 can not be read more often than every 2 seconds
+		self.dictPolicies = {} # Sensor name -> RetryPolicy
+		self.dictThreads = {} # Pin -> thread that last read it. Kept so a pin is not read again while a stuck read is still running.
+		self.Lock = threading.Lock() # Used when a sensor's policy is first made
+
+	def ReadAll(self, lsSensors): # Read all the enabled sensors at the same time. Returns a list of (sensor, humidity, temperature).
+		lsSensors = [oSensor for oSensor in lsSensors if oSensor.bEnabled == 1] # Only read the sensor if it has been enabled
+		dictResults = {}
+		lsThreads = []
+		dStop = time.time() + self.dDeadline_s
+		for oSensor in lsSensors:
+			oThread = self.dictThreads.get(oSensor.nPin)
+			if oThread is not None and oThread.is_alive(): # The last read is still stuck in the driver so leave the pin alone
+				self.GetPolicy(oSensor).RecordBusy()
+				oSharedMetrics.Inc("dht_reads_total", sensor=oSensor.sName, pin=oSensor.nPin, result="busy")
+				lsThreads.append(None)
+				continue
+			def Worker(oSensor=oSensor):
+				dictResults[oSensor.sName] = self.ReadSensor(oSensor, dStop)
+			oThread = threading.Thread(target=Worker)
+			oThread.daemon = True # A stuck driver call must not stop the script from exiting
+			oThread.start()
+			self.dictThreads[oSensor.nPin] = oThread
+			lsThreads.append(oThread)
+
+		lsResults = []
+		for oSensor, oThread in zip(lsSensors, lsThreads):
+			if oThread is not None:
+				oThread.join(max(0, dStop - time.time()) + self.dRetryDelay_s) # Allow time for a read that started just before the deadline
+			dHumidity_P, dTemperature_C = dictResults.get(oSensor.sName, (None, None))
+			lsResults.append((oSensor, dHumidity_P, dTemperature_C))
+		return lsResults
+
+	def GetPolicy(self, oSensor):
+		with self.Lock:
+			if oSensor.sName not in self.dictPolicies:
+				self.dictPolicies[oSensor.sName] = RetryPolicy()
+			return self.dictPolicies[oSensor.sName]
+
+	def GetStats(self): # Returns sensor name -> dictionary of counters
+		return dict((sName, oPolicy.GetStats()) for (sName, oPolicy) in self.dictPolicies.items())
+
+	def PrintStats(self):
+		for sName in sorted(self.dictPolicies):
+			dictStats = self.dictPolicies[sName].GetStats()
+			print(sName + ": " + str(dictStats["Successes"]) + "/" + str(dictStats["Reads"]) + " readings ok, " + str(dictStats["Attempts"]) + " tries, "
+				+ str(dictStats["Skipped"]) + " skipped, " + str(dictStats["Busy"]) + " busy, next max tries " + str(dictStats["MaxTries"]) + (" (quarantined)" if dictStats["Quarantined"] == 1 else ""))
+
+	def ReadSensor(self, oSensor, dStop): # Keep trying to read a sensor until it works, it runs out of tries or the deadline is reached
+		oPolicy = self.GetPolicy(oSensor)
+		if oPolicy.IsQuarantined(): # The sensor keeps failing so do not waste time on it this time
+			oSharedMetrics.Inc("dht_reads_total", sensor=oSensor.sName, pin=oSensor.nPin, result="skipped")
+			return None, None
+		for nTry in range(oPolicy.GetMaxTries()):
+			dStart = time.time()
+			dHumidity_P, dTemperature_C = self.oBackend.Read(oSensor.nPin)
+			oSharedRecorder.AddDHT(oSensor.nPin, dHumidity_P, dTemperature_C)
+			bSuccess = int(dHumidity_P is not None and dTemperature_C is not None)
+			oPolicy.RecordAttempt(bSuccess, time.time() - dStart)
+			oSharedMetrics.Observe("dht_attempt_seconds", time.time() - dStart, sensor=oSensor.sName, pin=oSensor.nPin)
+			oSharedMetrics.Inc("dht_attempts_total", sensor=oSensor.sName, pin=oSensor.nPin, result="ok" if bSuccess == 1 else "failed")
+			if bSuccess == 1:
+				oPolicy.RecordRead(1)
+				oSharedMetrics.Inc("dht_reads_total", sensor=oSensor.sName, pin=oSensor.nPin, result="ok")
+				return dHumidity_P, dTemperature_C
+			if time.time() + self.dRetryDelay_s > dStop: # Not enough time left for another try
+				break
+			time.sleep(self.dRetryDelay_s)
+		oPolicy.RecordRead(0)
+		oSharedMetrics.Inc("dht_reads_total", sensor=oSensor.sName, pin=oSensor.nPin, result="failed")
+		return None, None
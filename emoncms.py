@@ -0,0 +1,220 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Shared code for posting data to emoncms servers. Used by read_board_v2.py and read_sensors_v2.py
+# Notes: All the values from a run are gathered into a batch so that each node only needs one request per server rather
+# than one request per value. If timestamps have been attached to the values the input/bulk API is used instead of input/post.
+# Each server is posted to on its own thread so a slow or unreachable server does not hold up the others.
+# Connections come from a shared pool (see httppool.py) so they are reused between cycles in daemon mode, and a server
+# address starting with https:// is posted to over TLS so the API key is not sent in plain text.
+# If an Outbox is given the batch is stored on disk first and only removed once each server has accepted it (see outbox.py).
+# StubEmoncmsServer is a local web server that pretends to be emoncms so posting can be tested without a real server.
+
+# --- Imports ---
+import time # Used for timestamps
+import threading # Used to post to all the servers at the same time
+import collections # Used for the requests kept by the stub server
+from httppool import oSharedPool # Used for web access. Connections are kept open and reused between posts.
+from metrics import oSharedMetrics # Used to time the posts and count the status codes for each server
+try:
+	from urllib import quote # Used to encode the data in the URL. Python 2
+except ImportError:
+	from urllib.parse import quote # Used to encode the data in the URL. Python 3
+
+
+
+# --- Classes ---
+class EmoncmsBatch(object): # Class used to gather all the values from a run before posting them
+	def __init__(self): # This is run when an object is first created
+		self.lsNodeIDs = [] # Node IDs in the order they were first added
+		self.dictValues = {} # Node ID -> list of (input name, formatted value, timestamp)
+
+	def AddValue(self, sNodeID, sSensorName, sSensorValueType, dSensorValue, nTimestamp=None, sFormat="%.2f"):
+		if dSensorValue is None: # Only send data that has been populated
+			return
+		sInputName = sSensorName + "_" + sSensorValueType # Input names cannot have spaces
+		self.AddInput(sNodeID, sInputName, sFormat % dSensorValue, nTimestamp)
+
+	def AddInput(self, sNodeID, sInputName, sValue, nTimestamp=None): # Add a value that has already been formatted e.g. when replaying from the outbox
+		if sNodeID not in self.dictValues:
+			self.lsNodeIDs.append(sNodeID)
+			self.dictValues[sNodeID] = []
+		self.dictValues[sNodeID].append((sInputName, sValue, nTimestamp))
+
+	def IsEmpty(self):
+		return len(self.lsNodeIDs) == 0
+
+	def SetTimestamp(self, nTimestamp): # Give the values that do not have a timestamp this one e.g. before the batch is queued to be posted later
+		for sNodeID in self.lsNodeIDs:
+			self.dictValues[sNodeID] = [(sInputName, sValue, nTimestamp if nValueTimestamp is None else nValueTimestamp)
+				for (sInputName, sValue, nValueTimestamp) in self.dictValues[sNodeID]]
+
+	def GetRequests(self, sLocation, sApiKey): # Returns a list of (node ID, request) with one request per node, and one input/bulk request for all the nodes with timestamps
+		lsRequests = []
+		lsBulk = [] # (node ID, payload) for the nodes sent with input/bulk, which takes any number of nodes in one request e.g. from a gateway
+		for sNodeID in self.lsNodeIDs:
+			lsValues = self.dictValues[sNodeID]
+			if any(nTimestamp is not None for (sInputName, sValue, nTimestamp) in lsValues):
+				lsBulk.append((sNodeID, BulkData(sNodeID, lsValues)))
+			else:
+				sData = "{" + ",".join(sInputName + ":" + sValue for (sInputName, sValue, nTimestamp) in lsValues) + "}"
+				sRequest = sLocation + "input/post?apikey=" + sApiKey + "&node=" + sNodeID + "&json=" + quote(sData, ",:")
+				lsRequests.append((sNodeID, sRequest))
+		if lsBulk:
+			sData = "[" + ",".join(sPayload[1:-1] for (sNodeID, sPayload) in lsBulk) + "]"
+			lsRequests.append((",".join(sNodeID for (sNodeID, sPayload) in lsBulk), sLocation + "input/bulk?apikey=" + sApiKey + "&data=" + quote(sData, ",:")))
+		return lsRequests
+
+
+class EmoncmsServer(object): # Class for an emoncms server that data is posted to
+	def __init__(self, sName, sAddress, sLocation, sApiKey, bEnabled=1, dTimeout_s=10, dConnectTimeout_s=5, oPool=None):
+		self.sName = sName
+		self.sAddress = sAddress # Address of emoncms server with port number e.g. "emoncms.org:80", or "https://emoncms.org" to use TLS
+		self.sLocation = sLocation # Subfolder for the given emoncms server e.g. "/" or "/emoncms/"
+		self.sApiKey = sApiKey # Read & write api key
+		self.bEnabled = bEnabled
+		self.dTimeout_s = dTimeout_s # Time allowed for this server before it is reported as failed. Also used as the time to wait for each response.
+		self.Connection = (oSharedPool if oPool is None else oPool).GetHost(sAddress, dConnectTimeout_s, dTimeout_s) # Connections are kept open between cycles
+		self.Lock = threading.Lock() # Stops a hung post from an earlier cycle and a new one running at once
+
+	def Post(self, oBatch, bDebugPrint): # Post a batch to this server and return a PublishResult
+		dStart = time.time()
+		if not self.Lock.acquire(False): # A post from an earlier cycle has hung so do not start another one
+			return PublishResult(self.sName, 0, "previous post still running", 0)
+		try:
+			lsStatus = PostToEmoncms(oBatch, self.Connection, self.sLocation, self.sApiKey, bDebugPrint)
+		except Exception as e: # Any network error is reported rather than stopping the other servers
+			oSharedMetrics.Inc("emoncms_errors_total", server=self.sAddress, error=type(e).__name__)
+			return PublishResult(self.sName, 0, str(e), time.time() - dStart)
+		finally:
+			self.Lock.release()
+		lsFailed = [sNodeID + ": " + str(nStatus) + " " + str(sReason) for (sNodeID, nStatus, sReason) in lsStatus if nStatus != 200]
+		return PublishResult(self.sName, int(len(lsFailed) == 0), ", ".join(lsFailed), time.time() - dStart)
+
+	def Close(self): # Close the idle connections to this server
+		self.Connection.Close()
+
+class PublishResult(object): # Class for the result of posting to one server
+	def __init__(self, sServerName, bSuccess, sError, dDuration_s):
+		self.sServerName = sServerName
+		self.bSuccess = bSuccess
+		self.sError = sError
+		self.dDuration_s = dDuration_s
+
+	def PrintValues(self):
+		if self.bSuccess == 1:
+			print(self.sServerName + ": post succeeded in " + "%.2f" % self.dDuration_s + " s")
+		else:
+			print(self.sServerName + ": post failed after " + "%.2f" % self.dDuration_s + " s - " + self.sError)
+
+
+
+class StubEmoncmsServer(object): # Local web server that records each request and replies like emoncms
+	def __init__(self, nPort=0, dLatency_s=0.0, nStatus=200, nMaxRequests=None):
+		self.nPort = nPort # 0 = pick a free port when started. The same port is used if the server is started again.
+		self.dLatency_s = dLatency_s # Time taken to reply to each request
+		self.nStatus = nStatus # Status sent back e.g. 500 to pretend the server has a problem
+		self.lsRequests = collections.deque(maxlen=nMaxRequests) # Path of every request received, or only the newest nMaxRequests so a long run does not keep using more memory
+		self.nRequests = 0 # Number of requests received
+		self.oHTTPServer = None
+		self.bRunning = 0
+
+	def Start(self):
+		try:
+			from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler # Python 2. Only imported when the stub is used.
+			from SocketServer import ThreadingMixIn
+		except ImportError:
+			from http.server import HTTPServer, BaseHTTPRequestHandler # Python 3
+			from socketserver import ThreadingMixIn
+		oStub = self
+		class StubHTTPServer(ThreadingMixIn, HTTPServer): # Each connection has its own thread so kept open connections do not block the others
+			daemon_threads = True
+		class StubHandler(BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1" # Keep connections open like a real server
+			disable_nagle_algorithm = True # Send the reply straight away rather than waiting for the client's ACK
+			def do_GET(self):
+				if oStub.bRunning == 0: # Stopped, so drop connections that were kept open as a server that has gone down would
+					self.close_connection = True
+					return
+				oStub.lsRequests.append(self.path)
+				oStub.nRequests += 1
+				time.sleep(oStub.dLatency_s)
+				self.send_response(oStub.nStatus)
+				self.send_header("Content-Length", "2")
+				self.end_headers()
+				self.wfile.write(b"ok")
+			def log_message(self, *args): # Do not print each request
+				pass
+		self.oHTTPServer = StubHTTPServer(("127.0.0.1", self.nPort), StubHandler)
+		self.nPort = self.oHTTPServer.server_address[1]
+		self.bRunning = 1
+		oThread = threading.Thread(target=self.oHTTPServer.serve_forever)
+		oThread.daemon = True # The server must not stop the script from exiting
+		oThread.start()
+		return self
+
+	def Stop(self): # Stop the server e.g. to pretend it has gone down
+		self.bRunning = 0
+		if self.oHTTPServer is not None:
+			self.oHTTPServer.shutdown()
+			self.oHTTPServer.server_close()
+			self.oHTTPServer = None
+
+	def GetAddress(self): # Address to give to EmoncmsServer
+		return "127.0.0.1:" + str(self.nPort)
+
+
+
+# --- Functions ---
+def BulkData(sNodeID, lsValues): # Build an input/bulk payload: [[time,"node",{"name":value,...}],...] with one entry per timestamp
+	nNow = int(time.time()) # Values without a timestamp are sent as now
+	lsTimestamps = []
+	dictFrames = {}
+	for (sInputName, sValue, nTimestamp) in lsValues:
+		nTimestamp = nNow if nTimestamp is None else int(nTimestamp)
+		if nTimestamp not in dictFrames:
+			lsTimestamps.append(nTimestamp)
+			dictFrames[nTimestamp] = []
+		dictFrames[nTimestamp].append('"' + sInputName + '":' + sValue)
+	lsFrames = ['[' + str(nTimestamp) + ',"' + sNodeID + '",{' + ",".join(dictFrames[nTimestamp]) + '}]' for nTimestamp in lsTimestamps]
+	return "[" + ",".join(lsFrames) + "]"
+
+def PostToEmoncms(oBatch, conn, sLocation, ApiKey, bDebugPrint): # Function to post a batch of data to an emoncms server. conn is a httppool.HostConnection.
+	lsStatus = [] # List of (node ID, status, reason) for each request
+	for (sNodeID, Request) in oBatch.GetRequests(sLocation, ApiKey):
+		dStart = time.time()
+		nStatus, sReason, Body = conn.Request("GET", Request) # Make a GET request to the emoncms server. This sends all the data for the node at once.
+		oSharedMetrics.Observe("emoncms_request_seconds", time.time() - dStart, server=conn.sAddress)
+		oSharedMetrics.Inc("emoncms_responses_total", server=conn.sAddress, status=nStatus)
+		if bDebugPrint == 1:
+			print(sNodeID + ": data post status and reason - " + str(nStatus) + ", " + str(sReason))
+		lsStatus.append((sNodeID, nStatus, sReason))
+	return lsStatus
+
+def PublishToServers(lsServers, oBatch, bDebugPrint, oOutbox=None): # Post a batch to all the enabled servers at the same time and return a list of PublishResults
+	lsServers = [oServer for oServer in lsServers if oServer.bEnabled == 1]
+	if oOutbox is not None: # Store the batch first so it is not lost if a server can not be reached
+		oOutbox.Add(oBatch, lsServers)
+	dictResults = {}
+	lsThreads = []
+	dStart = time.time()
+	for oServer in lsServers:
+		def Worker(oServer=oServer):
+			if oOutbox is not None: # Send the oldest readings waiting for this server, including this batch
+				dictResults[oServer.sName] = oOutbox.Drain(oServer, bDebugPrint, dStart + oServer.dTimeout_s)
+			else:
+				dictResults[oServer.sName] = oServer.Post(oBatch, bDebugPrint)
+		oThread = threading.Thread(target=Worker)
+		oThread.daemon = True # A hung server must not stop the script from exiting
+		oThread.start()
+		lsThreads.append(oThread)
+
+	lsResults = []
+	for oServer, oThread in zip(lsServers, lsThreads):
+		oThread.join(max(0, dStart + oServer.dTimeout_s - time.time())) # Each server has its own time limit counted from when posting started
+		if oServer.sName in dictResults:
+			lsResults.append(dictResults[oServer.sName])
+		else:
+			lsResults.append(PublishResult(oServer.sName, 0, "timed out", time.time() - dStart))
+		if bDebugPrint == 1:
+			lsResults[-1].PrintValues()
+	return lsResults
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Work out the energy used (kWh), apparent power, power factor and peak power of each CT from every frame the board
+# sends. Used by the board pipeline in read_board_v2.py and collector.py
+# Notes: Only one real power value per CT is sent to emoncms each cycle, so the kWh worked out by emoncms is only as good as
+# its guess of what happened between those values. Here every frame is used: the real power is integrated over time with
+# the trapezoidal rule (the average of each pair of frames times the time between them) and added to a running total, so
+# short loads between posts are counted. The apparent power of each frame is the CT's current times the voltage from the
+# VT, and the power factor is the average real power over the cycle divided by the average apparent power. The peak power
+# is the highest real power seen in the cycle.
+# Each CT only keeps a few numbers (the totals, the last frame and this cycle's sums) however many frames there are, and
+# they are saved to a JSON file after each cycle so the kWh total carries on from where it was after a restart. Gaps
+# between frames longer than dMaxGap_s (e.g. the script was stopped) are not integrated as it is not known what happened
+# in them; they are counted in the energy_gap_seconds_total metric. Run from cron the board is only read for part of each
+# minute so most of the energy would be missed, which is why the scripts only use this in daemon mode.
+
+# --- Imports ---
+import os # Used to check for the state file
+import json # Used to load the totals
+import numpy as np # Used to integrate every frame at once
+from metrics import oSharedMetrics # Used to count the time that could not be integrated
+from jsonfile import SaveJSON # Used to save the totals
+
+
+
+# --- Classes ---
+class EnergyAccumulator(object): # Class that keeps the running totals for each CT
+	def __init__(self, sPath=None, dMaxGap_s=10, bDebugPrint=0):
+		self.sPath = sPath # JSON file the totals are saved to. None = only kept in memory.
+		self.dMaxGap_s = dMaxGap_s # Longest time between frames that is integrated
+		self.bDebugPrint = bDebugPrint
+		self.lsCTs = [] # (CT name, power column, current column, voltage column) with None for a column the board does not send
+		self.dictState = {} # CT name -> totals, last frame and this cycle's sums
+		if sPath is not None and os.path.exists(sPath):
+			try:
+				with open(sPath) as f:
+					self.dictState = json.load(f)
+			except ValueError: # A broken file means the totals start again from 0
+				if bDebugPrint == 1:
+					print("Energy totals in " + sPath + " could not be read so they have been reset")
+
+	def SetChannels(self, lsCTs): # Set the columns used for each CT. The totals are kept by name so they carry on when the channels change.
+		self.lsCTs = lsCTs
+		for (sName, nPower, nCurrent, nVoltage) in lsCTs:
+			dictCT = self.dictState.setdefault(sName, {})
+			for sKey in ("energy_Wh", "apparent_VAh", "cycle_Wh", "cycle_s", "cycle_VAh", "cycle_VA_s"):
+				dictCT.setdefault(sKey, 0.0)
+			for sKey in ("time", "power_W", "apparent_time", "apparent_VA", "peak_W"):
+				dictCT.setdefault(sKey, None)
+
+	def AddFrames(self, lsTimes, aValues): # Add frames with one row per frame (oldest first) and NaN where a value failed the range check
+		aTimes = np.asarray(lsTimes, dtype=float)
+		aValues = np.asarray(aValues, dtype=float)
+		if len(aTimes) == 0:
+			return
+		for (sName, nPower, nCurrent, nVoltage) in self.lsCTs:
+			dictCT = self.dictState[sName]
+			aPower = aValues[:, nPower]
+			dEnergy_Ws, dTime_s, dictCT["time"], dictCT["power_W"] = self.Integrate(sName, aTimes, aPower, dictCT["time"], dictCT["power_W"])
+			dictCT["energy_Wh"] += dEnergy_Ws / 3600.0
+			dictCT["cycle_Wh"] += dEnergy_Ws / 3600.0
+			dictCT["cycle_s"] += dTime_s
+			if not np.all(np.isnan(aPower)):
+				dPeak_W = float(np.nanmax(aPower))
+				dictCT["peak_W"] = dPeak_W if dictCT["peak_W"] is None else max(dictCT["peak_W"], dPeak_W)
+			if nCurrent is not None and nVoltage is not None:
+				aApparent = aValues[:, nCurrent] * aValues[:, nVoltage] # NaN if either failed the range check
+				dApparent_VAs, dTime_s, dictCT["apparent_time"], dictCT["apparent_VA"] = self.Integrate(None, aTimes, aApparent, dictCT["apparent_time"], dictCT["apparent_VA"])
+				dictCT["apparent_VAh"] += dApparent_VAs / 3600.0
+				dictCT["cycle_VAh"] += dApparent_VAs / 3600.0
+				dictCT["cycle_VA_s"] += dTime_s
+
+	def Integrate(self, sName, aTimes, aValues, dLastTime, dLastValue): # Trapezoidal integral of the good values carrying on from the last frame. Returns (integral, seconds, last time, last value).
+		aGood = ~np.isnan(aValues)
+		aTimes = aTimes[aGood]
+		aValues = aValues[aGood]
+		if dLastTime is not None:
+			aTimes = np.concatenate(([dLastTime], aTimes))
+			aValues = np.concatenate(([dLastValue], aValues))
+		if len(aTimes) == 0:
+			return 0.0, 0.0, dLastTime, dLastValue
+		aStep_s = np.diff(aTimes)
+		aUsed = (aStep_s > 0) & (aStep_s <= self.dMaxGap_s)
+		if sName is not None: # Only counted once per CT
+			oSharedMetrics.Inc("energy_gap_seconds_total", float(aStep_s[~aUsed & (aStep_s > 0)].sum()), channel=sName)
+		dIntegral = float(np.sum(np.where(aUsed, (aValues[:-1] + aValues[1:]) / 2.0 * aStep_s, 0.0)))
+		return dIntegral, float(aStep_s[aUsed].sum()), float(aTimes[-1]), float(aValues[-1])
+
+	def EndCycle(self): # Returns a list of (CT name, dictionary of reading type -> value) for this cycle and starts the next one
+		lsResults = []
+		for (sName, nPower, nCurrent, nVoltage) in self.lsCTs:
+			dictCT = self.dictState[sName]
+			dictValues = {"Energy_kWh": dictCT["energy_Wh"] / 1000.0, "PeakPower_W": dictCT["peak_W"]}
+			if dictCT["cycle_VA_s"] > 0:
+				dApparent_VA = dictCT["cycle_VAh"] * 3600.0 / dictCT["cycle_VA_s"] # Average over the cycle
+				dictValues["ApparentPower_VA"] = dApparent_VA
+				if dictCT["cycle_s"] > 0 and dApparent_VA > 0:
+					dReal_W = dictCT["cycle_Wh"] * 3600.0 / dictCT["cycle_s"]
+					dictValues["PowerFactor"] = max(-1.0, min(1.0, dReal_W / dApparent_VA)) # Noise can take it just past 1. Negative if the CT is the wrong way round.
+			lsResults.append((sName, dictValues))
+			dictCT.update({"cycle_Wh": 0.0, "cycle_s": 0.0, "cycle_VAh": 0.0, "cycle_VA_s": 0.0, "peak_W": None})
+		if self.bDebugPrint == 1:
+			for (sName, dictValues) in lsResults:
+				print(sName + " energy: " + ", ".join(sKey + " " + ("None" if dValue is None else "%.3f" % dValue) for (sKey, dValue) in sorted(dictValues.items())))
+		return lsResults
+
+	def Save(self): # Save the totals so they carry on after a restart
+		if self.sPath is None:
+			return
+		SaveJSON(self.sPath, self.dictState)
+
+
+
+# --- Functions ---
+def SelfTest(): # Check the totals against known loads, that gaps are skipped and the totals are kept across a restart
+	import tempfile
+	import shutil
+	import time
+	sPath = tempfile.mkdtemp()
+	try:
+		sStatePath = os.path.join(sPath, "energy.json")
+		oEnergy = EnergyAccumulator(sStatePath)
+		oEnergy.SetChannels([("CT1", 0, 1, 2)])
+		aTimes = np.arange(0, 3600.5, 0.5) # An hour of frames every 0.5 s
+		aPower = np.where((aTimes % 47) < 12, 2000.0, 200.0) # A 2 kW load on for 12 s of every 47 s over a 200 W base load
+		aCurrent = aPower / 230.0 / 0.9 # Power factor of 0.9
+		aValues = np.column_stack([aPower, aCurrent, np.full(len(aTimes), 230.0)])
+		aValues[::97, 0] = np.nan # Some frames failed the range check
+		for nStart in range(0, len(aTimes), 120): # Added a minute at a time as the pipeline does
+			oEnergy.AddFrames(aTimes[nStart:nStart + 120], aValues[nStart:nStart + 120])
+		dOn_s = sum(min(12, 3600 - n) for n in range(0, 3600, 47))
+		dTrue_kWh = (200.0 * 3600 + 1800.0 * dOn_s) / 3600000.0
+		dictValues = dict(oEnergy.EndCycle())["CT1"]
+		if abs(dictValues["Energy_kWh"] - dTrue_kWh) > 0.002 or abs(dictValues["PowerFactor"] - 0.9) > 0.001 or dictValues["PeakPower_W"] != 2000.0:
+			raise AssertionError("Expected " + "%.4f" % dTrue_kWh + " kWh with a power factor of 0.9, got " + str(dictValues))
+		dSampled_kWh = sum(aPower[::120]) * 60 / 3600000.0 # One value a minute as emoncms would see it
+		oEnergy.Save()
+
+		oEnergy = EnergyAccumulator(sStatePath) # After a restart
+		oEnergy.SetChannels([("CT1", 0, 1, 2)])
+		oEnergy.AddFrames([3700, 3701], [[1000, np.nan, np.nan], [1000, np.nan, np.nan]]) # 99.5 s gap is not integrated
+		dictValues = dict(oEnergy.EndCycle())["CT1"]
+		if abs(dictValues["Energy_kWh"] - (dTrue_kWh + 1000 / 3600000.0)) > 0.002 or "PowerFactor" in dictValues:
+			raise AssertionError("Total was not carried on after a restart or a gap was integrated: " + str(dictValues))
+		print("Energy self test passed: " + "%.4f" % dTrue_kWh + " kWh used, integrating every frame gave " + "%.4f" % (dictValues["Energy_kWh"] - 1000 / 3600000.0)
+			+ " kWh, one value a minute would give " + "%.4f" % dSampled_kWh + " kWh")
+
+		oEnergy.SetChannels([("CT" + str(n), n, n + 3, 6) for n in range(3)])
+		aFrames = 100 + np.random.RandomState(1).random_sample((100000, 7))
+		dStart = time.time()
+		for nStart in range(0, len(aFrames), 1000):
+			oEnergy.AddFrames(np.arange(nStart, nStart + 1000) * 0.2, aFrames[nStart:nStart + 1000])
+		print("Integrated " + "%.0f" % (len(aFrames) / (time.time() - dStart)) + " frames/s for 3 CTs")
+	finally:
+		shutil.rmtree(sPath)
+
+
+
+# --- Main Code ---
+if __name__ == "__main__":
+	SelfTest()
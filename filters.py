@@ -0,0 +1,125 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Remove outliers from each channel's readings and work out its final value. Used by samplestore.py and sensors.py
+# Notes: The final value used to be the 80th percentile of the readings that passed the range check, which is always a
+# bit high. Each channel can now be given its own filter in sensors.json, e.g. {"method": "median_mad", "k": 3}:
+#	percentile - the given percentile of the readings (the old way). "percentile": 80
+#	median_mad - readings more than k robust standard deviations (1.4826 x median absolute deviation) from the median are
+#		removed and the rest are averaged. "k": 3
+#	hampel - each reading is compared with the median of the readings around it ("window" either side) and replaced by
+#		that median if it is more than k robust standard deviations away. The cleaned readings are averaged.
+#	rate - single readings that jump by more than "max_step" from both the reading before and the one after, when those two
+#		agree with each other, are removed as spikes (a real step change only jumps on one side) and the rest are averaged.
+#	ewma - exponentially weighted average of the readings with the newest weighted the most. "alpha": 0.3
+# "max_step" can also be added to any of the other methods to remove spikes first. The readings are passed in as an array
+# with one row per reading (oldest first) and one column per channel, with NaN for readings that failed the range check.
+# Channels with the same filter are done together in one set of numpy operations, so the time taken depends on the number
+# of different filters rather than the number of channels, and the work is bounded by the size of the store.
+
+# --- Imports ---
+import warnings # Used to hide the numpy warnings for a channel with no good values
+import numpy as np # Used for the vectorised maths
+
+
+
+# --- Functions ---
+def ApplyFilters(aValues, lsFilters): # Returns the final value for each column, or None if a column has no good readings
+	aValues = np.asarray(aValues, dtype=float)
+	if aValues.ndim == 1:
+		aValues = aValues.reshape(-1, 1)
+	aResults = np.full(aValues.shape[1], np.nan)
+	dictGroups = {} # Filter -> columns that use it
+	for (nColumn, dictFilter) in enumerate(lsFilters):
+		dictGroups.setdefault(tuple(sorted(dictFilter.items())), []).append(nColumn)
+	if len(aValues) > 0:
+		with warnings.catch_warnings():
+			warnings.simplefilter("ignore", RuntimeWarning) # All-NaN slice for a channel with no good values
+			for (tFilter, lsColumns) in dictGroups.items():
+				dictFilter = dict(tFilter)
+				sMethod = dictFilter.get("method", "percentile")
+				if sMethod not in dictMethods:
+					raise ValueError("Unknown filter method " + str(sMethod) + ", use one of " + ", ".join(sorted(dictMethods)))
+				aGroup = aValues[:, lsColumns]
+				if "max_step" in dictFilter:
+					aGroup = RemoveSpikes(aGroup, dictFilter["max_step"])
+				aResults[lsColumns] = dictMethods[sMethod](aGroup, dictFilter)
+	return [None if np.isnan(dValue) else float(dValue) for dValue in aResults]
+
+def FilterValues(lsValues, dictFilter): # Returns the final value of a list of readings (oldest first), or None if there are none
+	return ApplyFilters(np.array([np.nan if dValue is None else dValue for dValue in lsValues], dtype=float), [dictFilter])[0]
+
+def Percentile(aValues, dictFilter):
+	return np.nanpercentile(aValues, dictFilter.get("percentile", 80), axis=0)
+
+def MedianMAD(aValues, dictFilter):
+	aMedian = np.nanmedian(aValues, axis=0)
+	aDeviation = np.abs(aValues - aMedian)
+	aMAD = np.nanmedian(aDeviation, axis=0)
+	aKeep = aDeviation <= dictFilter.get("k", 3.0) * 1.4826 * aMAD # A MAD of 0 keeps only the readings equal to the median
+	return np.nanmean(np.where(aKeep, aValues, np.nan), axis=0)
+
+def Hampel(aValues, dictFilter):
+	nWindow = int(dictFilter.get("window", 3)) # Readings either side used for the local median
+	nRows = len(aValues)
+	aPadded = np.full((nRows + 2 * nWindow, aValues.shape[1]), np.nan)
+	aPadded[nWindow:nWindow + nRows] = aValues
+	aWindows = np.stack([aPadded[n:n + nRows] for n in range(2 * nWindow + 1)], axis=2) # Rows x channels x window
+	aMedian = np.nanmedian(aWindows, axis=2)
+	aMAD = np.nanmedian(np.abs(aWindows - aMedian[:, :, np.newaxis]), axis=2)
+	aOutlier = np.abs(aValues - aMedian) > dictFilter.get("k", 3.0) * 1.4826 * aMAD
+	return np.nanmean(np.where(aOutlier, aMedian, aValues), axis=0)
+
+def Rate(aValues, dictFilter): # The spikes have already been removed using max_step
+	return np.nanmean(aValues, axis=0)
+
+def EWMA(aValues, dictFilter):
+	dAlpha = dictFilter.get("alpha", 0.3)
+	aWeights = (1 - dAlpha) ** np.arange(len(aValues) - 1, -1, -1, dtype=float) # Newest reading has a weight of 1
+	aValid = ~np.isnan(aValues)
+	return np.where(aValid, aValues, 0).T.dot(aWeights) / aValid.T.dot(aWeights) # Skipping bad readings rather than treating them as 0
+
+def RemoveSpikes(aValues, dMaxStep): # Set single readings that jump by more than dMaxStep away from the good readings around them to NaN
+	nRows = len(aValues)
+	aValid = ~np.isnan(aValues)
+	aRows = np.arange(nRows)[:, np.newaxis]
+	aColumns = np.arange(aValues.shape[1])[np.newaxis, :]
+	aLastGood = np.maximum.accumulate(np.where(aValid, aRows, -1), axis=0) # Row of the newest good reading up to and including each row
+	aPrevious = np.vstack([np.full((1, aValues.shape[1]), -1), aLastGood[:-1]]) # Row of the good reading before each row, -1 if none
+	aNextGood = np.minimum.accumulate(np.where(aValid, aRows, nRows)[::-1], axis=0)[::-1]
+	aNext = np.vstack([aNextGood[1:], np.full((1, aValues.shape[1]), nRows)]) # Row of the good reading after each row, nRows if none
+	aPrevious2 = np.where(aPrevious >= 0, aPrevious[np.clip(aPrevious, 0, None), aColumns], -1) # And the ones before and after those
+	aNext2 = np.where(aNext < nRows, aNext[np.clip(aNext, None, nRows - 1), aColumns], nRows)
+	def GetValues(aIndex): # Values at the rows given, NaN where there is no good reading
+		return np.where((aIndex >= 0) & (aIndex < nRows), aValues[np.clip(aIndex, 0, nRows - 1), aColumns], np.nan)
+	aPreviousValue, aPrevious2Value, aNextValue, aNext2Value = GetValues(aPrevious), GetValues(aPrevious2), GetValues(aNext), GetValues(aNext2)
+	aJumpPrevious = np.abs(aValues - aPreviousValue) > dMaxStep # Comparisons with NaN are False
+	aJumpNext = np.abs(aValues - aNextValue) > dMaxStep
+	aSpike = aJumpPrevious & aJumpNext & (np.abs(aPreviousValue - aNextValue) <= dMaxStep) # The readings either side agree so this one is a spike, a real step change only jumps on one side
+	aSpike |= np.isnan(aPreviousValue) & aJumpNext & (np.abs(aNextValue - aNext2Value) <= dMaxStep) # First reading, compared with the two after it
+	aSpike |= np.isnan(aNextValue) & aJumpPrevious & (np.abs(aPreviousValue - aPrevious2Value) <= dMaxStep) # Last reading, compared with the two before it
+	return np.where(aSpike, np.nan, aValues)
+
+def Benchmark(nRuns=200, nReadings=300, nChannels=7, nSeed=1): # Compare how close each method gets to the true value with some outliers
+	import time
+	oRandom = np.random.RandomState(nSeed)
+	lsFilters = [{"method": "percentile", "percentile": 80}, {"method": "median_mad", "k": 3}, {"method": "hampel", "window": 3, "k": 3},
+		{"method": "rate", "max_step": 10}, {"method": "ewma", "alpha": 0.3, "max_step": 10}]
+	for dictFilter in lsFilters:
+		for nSamples in (6, nReadings):
+			lsErrors = []
+			dStart = time.time()
+			for n in range(nRuns):
+				aValues = 100 + oRandom.normal(0, 1, (nSamples, nChannels)) # True value is 100
+				aOutliers = oRandom.random_sample((nSamples, nChannels)) < 0.05
+				aValues[aOutliers] += oRandom.choice([-1, 1], aOutliers.sum()) * 50 # 5% of the readings are way out
+				lsErrors.extend(abs(dValue - 100) for dValue in ApplyFilters(aValues, [dictFilter] * nChannels))
+			print(dictFilter["method"] + " over " + str(nSamples) + " readings: mean error " + "%.2f" % (sum(lsErrors) / len(lsErrors))
+				+ ", " + "%.2f" % ((time.time() - dStart) / nRuns * 1000) + " ms for " + str(nChannels) + " channels")
+
+
+
+# --- Main Code ---
+dictMethods = {"percentile": Percentile, "median_mad": MedianMAD, "hampel": Hampel, "rate": Rate, "ewma": EWMA}
+
+if __name__ == "__main__":
+	Benchmark()
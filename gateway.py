@@ -0,0 +1,355 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Collect the readings from the Pis in many server rooms on one machine and post them to emoncms together. Used
+# by run_gateway.py, and by the collectors when a server in sensors.json has an address starting with udp://
+# Notes: Each Pi sends its batches to the gateway as UDP packets rather than posting to every emoncms server itself. A
+# packet is a header line "EG1 <packet id>" followed by the readings in the emoncms input/bulk format
+# [[time,"node",{"name":value,...}],...], so one packet can hold readings from several nodes and times. Packets are kept
+# under nMaxPacket bytes so they are not split up on the network. The gateway replies "ACK <packet id>" to every packet
+# and GatewayServer sends any packet that was not acknowledged again once, so a post only succeeds (and the Pi's outbox
+# only lets go of the readings) once the gateway has them.
+# The gateway drops packets it has already seen (a resend after a lost ACK) and writes the readings in every packet that
+# has arrived to its outbox in one transaction before any of them are acknowledged. The outbox syncs each commit to the
+# disk (synchronous=FULL, see outbox.py) before Add() returns, so once a Pi lets go of a reading it is on the gateway's
+# disk and a crash, restart or power cut of the gateway can not lose it. Within each burst of packets one value is kept
+# for each node, input and time (later ones replace earlier ones). Every dForwardInterval_s the outbox sends what it
+# holds to each emoncms server in input/bulk requests holding many nodes at once over connections that are kept open.
+# Run this file on its own for a load test: simulated nodes with CT/VT and DHT22 sensors send to a gateway that posts to
+# stub emoncms servers, and the values the stubs receive are checked against what was sent.
+
+# --- Imports ---
+import socket # Used for the UDP packets
+import threading # Used to receive packets in the background
+import collections # Used to remember the packets already seen
+import json # Used to read the packets
+import random # Used for the session ID
+import time # Used for timeouts and timestamps
+from emoncms import EmoncmsBatch, PublishResult, PublishToServers, BulkData # Used to build the packets and post to emoncms
+from metrics import oSharedMetrics # Used to count the packets and values
+
+
+
+# --- Classes ---
+class GatewayServer(object): # Used in place of an EmoncmsServer to send readings to a gateway over UDP
+	def __init__(self, sName, sAddress, bEnabled=1, dTimeout_s=5, nMaxPacket=1400):
+		self.sName = sName
+		self.sAddress = sAddress # e.g. "udp://192.168.1.10:5005"
+		sHost, sPort = sAddress.split("://", 1)[-1].rstrip("/").rsplit(":", 1)
+		self.tAddress = (sHost, int(sPort))
+		self.bEnabled = bEnabled
+		self.dTimeout_s = dTimeout_s # Time allowed for all the packets in a post to be acknowledged
+		self.nMaxPacket = nMaxPacket # Most bytes in a packet. 1400 fits in one Ethernet frame.
+		self.sSession = "%08x" % random.getrandbits(32) # Makes the packet IDs different each time the script is started
+		self.nNextID = 0
+		self.Socket = None
+		self.Lock = threading.Lock() # Stops a hung post from an earlier cycle and a new one running at once
+
+	def Post(self, oBatch, bDebugPrint): # Send a batch to the gateway and return a PublishResult
+		dStart = time.time()
+		if not self.Lock.acquire(False):
+			return PublishResult(self.sName, 0, "previous post still running", 0)
+		try:
+			lsMissing = self.SendAndWait(self.MakePackets(oBatch))
+		except socket.error as e:
+			oSharedMetrics.Inc("gateway_send_errors_total", server=self.sAddress)
+			return PublishResult(self.sName, 0, str(e), time.time() - dStart)
+		finally:
+			self.Lock.release()
+		if bDebugPrint == 1:
+			print(self.sName + ": " + str(len(lsMissing)) + " packets not acknowledged")
+		return PublishResult(self.sName, int(len(lsMissing) == 0), "" if len(lsMissing) == 0 else str(len(lsMissing)) + " packets not acknowledged", time.time() - dStart)
+
+	def MakePackets(self, oBatch): # Returns a list of (packet ID, packet) with the readings split so each packet is under nMaxPacket bytes
+		lsFrames = []
+		for sNodeID in oBatch.lsNodeIDs:
+			dictTimes = collections.OrderedDict() # Time -> values, so each time is one frame
+			for (sInputName, sValue, nTimestamp) in oBatch.dictValues[sNodeID]:
+				dictTimes.setdefault(nTimestamp, []).append((sInputName, sValue, nTimestamp))
+			for lsValues in dictTimes.values():
+				lsFrames.append(BulkData(sNodeID, lsValues)[1:-1]) # Values without a time are given the current time
+		lsPackets = []
+		lsPacketFrames = []
+		nSize = 0
+		for sFrame in lsFrames:
+			if lsPacketFrames and nSize + len(sFrame) + 1 > self.nMaxPacket - 30: # Leave room for the header
+				lsPackets.append(self.MakePacket(lsPacketFrames))
+				lsPacketFrames = []
+				nSize = 0
+			lsPacketFrames.append(sFrame)
+			nSize += len(sFrame) + 1
+		if lsPacketFrames:
+			lsPackets.append(self.MakePacket(lsPacketFrames))
+		return lsPackets
+
+	def MakePacket(self, lsFrames):
+		sID = self.sSession + ":" + str(self.nNextID)
+		self.nNextID += 1
+		return (sID, ("EG1 " + sID + "\n[" + ",".join(lsFrames) + "]").encode("utf-8"))
+
+	def SendAndWait(self, lsPackets): # Send the packets and wait for them to be acknowledged, sending the missing ones again half way. Returns the IDs not acknowledged.
+		if self.Socket is None:
+			self.Socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		dictWaiting = dict(lsPackets)
+		dStart = time.time()
+		bResent = 0
+		for (sID, Packet) in lsPackets:
+			self.Socket.sendto(Packet, self.tAddress)
+		while dictWaiting:
+			dLeft = dStart + self.dTimeout_s - time.time()
+			if bResent == 0 and dLeft < self.dTimeout_s / 2.0:
+				for Packet in dictWaiting.values():
+					self.Socket.sendto(Packet, self.tAddress)
+				bResent = 1
+				oSharedMetrics.Inc("gateway_resends_total", len(dictWaiting), server=self.sAddress)
+			if dLeft <= 0:
+				break
+			self.Socket.settimeout(min(dLeft, max(0.01, dLeft - self.dTimeout_s / 2.0)) if bResent == 0 else dLeft)
+			try:
+				Reply = self.Socket.recv(256)
+			except socket.timeout:
+				continue
+			if Reply.startswith(b"ACK "):
+				dictWaiting.pop(Reply[4:].decode("utf-8"), None) # Acknowledgements for packets from an earlier post are ignored
+		return list(dictWaiting)
+
+	def Close(self):
+		with self.Lock: # Waits for a post that is still running
+			if self.Socket is not None:
+				self.Socket.close()
+				self.Socket = None
+
+
+class Gateway(object): # Class that receives readings from many nodes and forwards them to the emoncms servers
+	def __init__(self, lsServers, oOutbox, sAddress="0.0.0.0", nPort=5005, nMaxPending=1000000, nSeenPackets=100000, nMaxBurst=1000, bDebugPrint=0):
+		self.lsServers = lsServers # emoncms servers the readings are forwarded to. Set before Start() as readings are stored for these servers as they arrive.
+		self.oOutbox = oOutbox # Readings are written to the outbox before they are acknowledged and kept until each server has them
+		self.sAddress = sAddress # "0.0.0.0" = receive from any machine
+		self.nPort = nPort # 0 = pick a free port
+		self.nMaxPending = nMaxPending # Most rows waiting in the outbox. Newer packets are not acknowledged when full so the nodes keep them.
+		self.nSeenPackets = nSeenPackets # Number of packet IDs remembered to spot resends
+		self.nMaxBurst = nMaxBurst # Most packets stored in one transaction
+		self.bDebugPrint = bDebugPrint
+		self.Lock = threading.Lock()
+		self.dictSeen = collections.OrderedDict() # Packet IDs already received, oldest first
+		self.Socket = None
+		self.oThread = None
+		self.bRunning = 0
+		self.nPackets = 0
+		self.nDuplicates = 0
+		self.nBadPackets = 0
+		self.nValues = 0
+		self.nCoalesced = 0 # Values that replaced one in the same burst for the same node, input and time
+		self.nStored = 0 # Values written to the outbox
+
+	def Start(self):
+		self.Socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.Socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024) # Room for bursts when many nodes send at once
+		self.Socket.bind((self.sAddress, self.nPort))
+		self.Socket.settimeout(0.5) # So the thread can see it has been stopped
+		self.nPort = self.Socket.getsockname()[1]
+		self.bRunning = 1
+		self.oThread = threading.Thread(target=self.Receive)
+		self.oThread.daemon = True
+		self.oThread.start()
+		return self
+
+	def Receive(self): # Receive packets until Stop() is called
+		Socket = self.Socket
+		while self.bRunning == 1:
+			try:
+				lsPackets = [Socket.recvfrom(65535)]
+			except socket.timeout:
+				continue
+			except socket.error: # Closed by Stop()
+				return
+			try: # Take the other packets that have already arrived so they are stored in the same transaction
+				Socket.settimeout(0)
+				while len(lsPackets) < self.nMaxBurst:
+					lsPackets.append(Socket.recvfrom(65535))
+			except socket.error: # Nothing more waiting
+				pass
+			try:
+				Socket.settimeout(0.5)
+			except socket.error:
+				return
+			lsIDs = self.HandlePackets([Packet for (Packet, tAddress) in lsPackets])
+			for (sID, (Packet, tAddress)) in zip(lsIDs, lsPackets):
+				if sID is not None:
+					try:
+						Socket.sendto(("ACK " + sID).encode("utf-8"), tAddress)
+					except socket.error:
+						oSharedMetrics.Inc("gateway_ack_errors_total")
+
+	def HandlePackets(self, lsPackets): # Store the readings in a list of packets. Returns the packet ID to acknowledge for each packet, or None if it was not stored.
+		lsIDs = []
+		lsNewIDs = [] # Packets whose readings are in this burst
+		dictValues = {} # (node, time, input) -> value
+		nValues = 0
+		lsServers = [oServer for oServer in self.lsServers if oServer.bEnabled == 1]
+		bFull = len(lsServers) == 0 or self.oOutbox.GetBacklog() >= self.nMaxPending # Not acknowledged so the nodes keep the readings and try again
+		for Packet in lsPackets:
+			try:
+				sHeader, sBody = Packet.decode("utf-8").split("\n", 1)
+				sMagic, sID = sHeader.split(" ", 1)
+				if sMagic != "EG1":
+					raise ValueError("Unknown packet type " + sMagic)
+				if sID in self.dictSeen or sID in lsNewIDs: # Sent again because the ACK was lost
+					self.nDuplicates += 1
+					oSharedMetrics.Inc("gateway_packets_total", result="duplicate")
+					lsIDs.append(sID)
+					continue
+				if bFull:
+					oSharedMetrics.Inc("gateway_packets_total", result="full" if lsServers else "no_servers")
+					lsIDs.append(None)
+					continue
+				lsFrames = json.loads(sBody, parse_float=str, parse_int=str) # Numbers are kept as they were sent
+				lsValues = [(str(sNodeID), int(sTime), str(sInputName), sValue) for (sTime, sNodeID, dictInputs) in lsFrames for (sInputName, sValue) in dictInputs.items()]
+			except (ValueError, TypeError, UnicodeDecodeError) as e:
+				self.nBadPackets += 1
+				oSharedMetrics.Inc("gateway_packets_total", result="bad")
+				if self.bDebugPrint == 1:
+					print("Bad packet: " + str(e))
+				lsIDs.append(None)
+				continue
+			for (sNodeID, nTimestamp, sInputName, sValue) in lsValues:
+				dictValues[(sNodeID, nTimestamp, sInputName)] = sValue
+			nValues += len(lsValues)
+			lsNewIDs.append(sID)
+			lsIDs.append(sID)
+		if not lsNewIDs:
+			return lsIDs
+		oBatch = EmoncmsBatch()
+		for (sNodeID, nTimestamp, sInputName) in sorted(dictValues):
+			oBatch.AddInput(sNodeID, sInputName, dictValues[(sNodeID, nTimestamp, sInputName)], nTimestamp)
+		try:
+			with oSharedMetrics.Time("stage_seconds", stage="gateway_store"):
+				self.oOutbox.Add(oBatch, lsServers) # Only returns once the transaction has been synced to the disk, so nothing is acknowledged before then
+		except Exception as e: # e.g. the disk is full. Nothing is acknowledged so the nodes keep the readings.
+			oSharedMetrics.Inc("gateway_store_errors_total", error=type(e).__name__)
+			if self.bDebugPrint == 1:
+				print("Could not store packets: " + str(e))
+			return [sID if sID not in lsNewIDs else None for sID in lsIDs]
+		with self.Lock:
+			for sID in lsNewIDs:
+				self.dictSeen[sID] = 1
+			while len(self.dictSeen) > self.nSeenPackets:
+				self.dictSeen.popitem(last=False)
+			self.nPackets += len(lsNewIDs)
+			self.nValues += nValues
+			self.nCoalesced += nValues - len(dictValues)
+			self.nStored += len(dictValues)
+		oSharedMetrics.Inc("gateway_packets_total", len(lsNewIDs), result="ok")
+		oSharedMetrics.Inc("gateway_values_total", nValues)
+		return lsIDs
+
+	def Forward(self): # Send what is waiting in the outbox to the emoncms servers
+		oSharedMetrics.Set("gateway_pending", self.oOutbox.GetBacklog())
+		with oSharedMetrics.Time("stage_seconds", stage="gateway_forward"):
+			return PublishToServers(self.lsServers, EmoncmsBatch(), self.bDebugPrint, self.oOutbox) # The readings were stored as they arrived so the batch is empty
+
+	def Stop(self):
+		self.bRunning = 0
+		if self.oThread is not None:
+			self.oThread.join(5)
+			self.oThread = None
+		if self.Socket is not None:
+			self.Socket.close()
+			self.Socket = None
+
+	def PrintStats(self):
+		print("Gateway: " + str(self.nPackets) + " packets, " + str(self.nValues) + " values, " + str(self.nDuplicates) + " duplicate packets, "
+			+ str(self.nCoalesced) + " values replaced, " + str(self.nBadPackets) + " bad packets, " + str(self.nStored) + " values stored")
+
+
+
+# --- Functions ---
+def CountValues(lsRequests): # Returns a set of (node, time, input) in a list of input/bulk request paths, as received by a stub server
+	try:
+		from urlparse import urlparse, parse_qs # Python 2
+	except ImportError:
+		from urllib.parse import urlparse, parse_qs # Python 3
+	setValues = set()
+	for sPath in lsRequests:
+		for sData in parse_qs(urlparse(sPath).query).get("data", []):
+			for (nTimestamp, sNodeID, dictInputs) in json.loads(sData):
+				setValues.update((sNodeID, int(nTimestamp), sInputName) for sInputName in dictInputs)
+	return setValues
+
+def LoadTest(nNodes=200, nCycles=5, nThreads=8, dDuplicateRate=0.05, nSeed=1): # Drive a gateway with simulated nodes and check every value reaches the stub servers
+	import os
+	import shutil
+	import tempfile
+	from sensors import CTVTSensor, DHTSensor
+	from emoncms import EmoncmsServer, StubEmoncmsServer
+	from outbox import Outbox
+	sPath = tempfile.mkdtemp()
+	lsStubs = [StubEmoncmsServer().Start() for n in range(2)]
+	lsServers = [EmoncmsServer("Stub" + str(n), oStub.GetAddress(), "/", "key", dTimeout_s=60) for (n, oStub) in enumerate(lsStubs)]
+	oOutbox = Outbox(os.path.join(sPath, "outbox_gateway.db"), nMaxRows=10000000, nMaxRowsPerCycle=10000000)
+	oGateway = Gateway(lsServers, oOutbox, "127.0.0.1", 0).Start()
+	try:
+		oRandom = random.Random(nSeed)
+		lsNodes = [] # (node ID, sensors, client)
+		for n in range(nNodes):
+			lsSensors = [CTVTSensor("CT" + str(i), 8, 1) for i in (1, 2, 3)] + [CTVTSensor("VT1", 1, 1)] + [DHTSensor("DHT" + str(i), 0, 1) for i in (1, 2, 3, 4)]
+			lsNodes.append(("Room_" + str(n), lsSensors, GatewayServer("Gateway", "udp://127.0.0.1:" + str(oGateway.nPort), dTimeout_s=2)))
+		nSent = 0
+		lsFailed = []
+		dSend_s = 0.0
+		dForward_s = 0.0
+		for nCycle in range(nCycles):
+			nTimestamp = 1500000000 + 60 * nCycle # One cycle a minute
+			def Worker(lsMyNodes):
+				for (sNodeID, lsSensors, oClient) in lsMyNodes:
+					oBatch = EmoncmsBatch()
+					for oSensor in lsSensors:
+						if isinstance(oSensor, DHTSensor):
+							oBatch.AddValue(sNodeID, oSensor.sName, "Temperature_C", oRandom.gauss(22, 1), nTimestamp, "%.1f")
+							oBatch.AddValue(sNodeID, oSensor.sName, "Humidity_P", oRandom.gauss(45, 3), nTimestamp, "%.1f")
+						elif oSensor.sName.startswith("VT"):
+							oBatch.AddValue(sNodeID, oSensor.sName, "Vrms_V", oRandom.gauss(240, 2), nTimestamp)
+						else:
+							oBatch.AddValue(sNodeID, oSensor.sName, "RealPower_W", oRandom.uniform(0, 3000), nTimestamp)
+							oBatch.AddValue(sNodeID, oSensor.sName, "Irms_A", oRandom.uniform(0, 13), nTimestamp)
+					lsPackets = oClient.MakePackets(oBatch)
+					lsMissing = oClient.SendAndWait(lsPackets)
+					if oRandom.random() < dDuplicateRate: # Pretend the ACK was lost so the packets are sent again
+						lsMissing += oClient.SendAndWait(lsPackets)
+					if oRandom.random() < dDuplicateRate: # Sent again in new packets, as a node's outbox does after a post that seemed to fail
+						lsMissing += oClient.SendAndWait(oClient.MakePackets(oBatch))
+					if lsMissing:
+						lsFailed.append(sNodeID)
+			dStart = time.time()
+			lsThreads = [threading.Thread(target=Worker, args=(lsNodes[n::nThreads],)) for n in range(nThreads)] # Nodes send at the same time
+			for oThread in lsThreads:
+				oThread.start()
+			for oThread in lsThreads:
+				oThread.join()
+			dSend_s += time.time() - dStart
+			nSent += nNodes * 15
+			dStart = time.time()
+			lsResults = oGateway.Forward()
+			dForward_s += time.time() - dStart
+			if not all(oResult.bSuccess == 1 for oResult in lsResults):
+				raise AssertionError("Forward failed: " + ", ".join(oResult.sError for oResult in lsResults))
+		oGateway.PrintStats()
+		for oStub in lsStubs:
+			nReceived = len(CountValues(oStub.lsRequests))
+			if nReceived != nSent:
+				raise AssertionError("Stub server received " + str(nReceived) + " values but " + str(nSent) + " were sent")
+		if lsFailed:
+			raise AssertionError(str(len(lsFailed)) + " posts to the gateway were not acknowledged")
+		print(str(nNodes) + " nodes, " + str(nSent) + " values: received at " + "%.0f" % (nSent / dSend_s * 60) + " values/minute, forwarded to "
+			+ str(len(lsServers)) + " servers at " + "%.0f" % (nSent / dForward_s * 60) + " values/minute in " + str(len(lsStubs[0].lsRequests)) + " requests per server")
+	finally:
+		oGateway.Stop()
+		oOutbox.Close()
+		for oStub in lsStubs:
+			oStub.Stop()
+		shutil.rmtree(sPath)
+
+
+
+# --- Main Code ---
+if __name__ == "__main__":
+	LoadTest()
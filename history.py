@@ -0,0 +1,311 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Keep a history of the readings on the Pi so it can be looked at without emoncms. Used by collector.py
+# Notes: Every reading is appended to a binary file as a fixed size record (time, series number, value = 10 bytes) and
+# the readings are also rolled up into 1 minute, 15 minute and 1 hour records (count, min, max, mean, 80th percentile).
+# Each level is split into segment files covering a fixed amount of time, so old data is removed by deleting whole files
+# once it is older than the level's retention (e.g. raw readings are kept for 7 days, hourly rollups for 5 years).
+# Records are kept in time order in each file so a query finds the start of its range with a binary search on a memory
+# mapped file rather than reading the whole file. New records are buffered and written once per cycle by Flush() so the
+# SD card sees one small append per file per cycle. Readings older than ones already written are dropped (nLate).
+# A rollup is written once its period has ended. The periods that have not ended are rebuilt from the raw readings when
+# the store is opened, so the rollups come out the same whether the script keeps running or is started by cron each minute.
+# Run this file on its own to time the ingest and queries over a year of simulated data.
+
+# --- Imports ---
+import os # Used for the segment files
+import json # Used to save the series names
+import mmap # Used to read the segment files without loading them
+import struct # Used to pack the records
+import time # Used for timestamps
+from array import array # Used for the readings in each rollup
+from aggregate import Percentile # Used for the 80th percentile of each rollup
+
+
+
+# --- Classes ---
+class Bucket(object): # Class for the readings of one series in one rollup period
+	__slots__ = ("nCount", "dMin", "dMax", "dSum", "aValues")
+
+	def __init__(self):
+		self.nCount = 0
+		self.dMin = None
+		self.dMax = None
+		self.dSum = 0.0
+		self.aValues = array("d") # Kept so the percentile is exact. 8 bytes a reading rather than a float object each.
+
+	def Add(self, dValue):
+		self.nCount += 1
+		self.dSum += dValue
+		if self.dMin is None or dValue < self.dMin:
+			self.dMin = dValue
+		if self.dMax is None or dValue > self.dMax:
+			self.dMax = dValue
+		self.aValues.append(dValue)
+
+	def GetRecord(self, nStart, nSeriesID): # Returns the values packed into a rollup record
+		return (nStart, nSeriesID, self.nCount, self.dMin, self.dMax, self.dSum / self.nCount, Percentile(sorted(self.aValues), 80))
+
+
+class Level(object): # Class for one level of the store e.g. raw readings or 15 minute rollups
+	def __init__(self, sName, nBucket_s, nSegment_s, nRetention_s):
+		self.sName = sName
+		self.nBucket_s = nBucket_s # Length of each rollup, 0 for the raw readings
+		self.nSegment_s = nSegment_s # Time covered by each file
+		self.nRetention_s = nRetention_s # Files older than this are deleted
+		self.Struct = oRawStruct if nBucket_s == 0 else oRollupStruct
+		self.dictBuckets = {} # Series number -> Bucket for the period that is still open
+		self.nOpenStart = None # Start of the open period
+		self.lsPending = [] # Records waiting to be written by Flush()
+		self.nLastWritten = 0 # Time of the newest record written, anything older is late
+
+
+class HistoryStore(object): # Class for the history of every series
+	def __init__(self, sPath, nRawRetention_s=7 * 86400, n1mRetention_s=31 * 86400, n15mRetention_s=366 * 86400, n1hRetention_s=5 * 366 * 86400):
+		self.sPath = sPath # Folder holding the segment files
+		if not os.path.isdir(sPath):
+			os.makedirs(sPath)
+		self.lsLevels = [ # Name, rollup length, file length, retention
+			Level("raw", 0, 86400, nRawRetention_s),
+			Level("1m", 60, 86400, n1mRetention_s),
+			Level("15m", 900, 7 * 86400, n15mRetention_s),
+			Level("1h", 3600, 28 * 86400, n1hRetention_s),
+		]
+		self.dictLevels = dict((oLevel.sName, oLevel) for oLevel in self.lsLevels)
+		self.sSeriesPath = os.path.join(sPath, "series.json")
+		self.dictSeries = {} # Series name -> series number used in the records
+		if os.path.exists(self.sSeriesPath):
+			with open(self.sSeriesPath) as f:
+				self.dictSeries = json.load(f)
+		self.dictSeriesNames = dict((nSeriesID, sName) for (sName, nSeriesID) in self.dictSeries.items())
+		for oLevel in self.lsLevels: # Carry on from the newest record already on disk so the files stay in time order
+			for (nSegmentStart, sFile) in reversed(self.GetSegments(oLevel)):
+				with open(sFile, "r+b") as f:
+					nSize = os.fstat(f.fileno()).st_size
+					if nSize % oLevel.Struct.size != 0: # Record cut short by a crash. Removed so the records added after it line up.
+						nSize -= nSize % oLevel.Struct.size
+						f.truncate(nSize)
+					if nSize == 0: # Crashed before anything was written to this file so use the one before
+						continue
+					f.seek(nSize - oLevel.Struct.size)
+					oLevel.nLastWritten = oTimeStruct.unpack_from(f.read(oTimeStruct.size))[0]
+				break
+		self.nNewest = self.lsLevels[0].nLastWritten # Time of the newest reading, used for the retention so simulated data works the same as real data
+		self.nLastEvicted = 0
+		self.nLate = 0 # Readings dropped because they were older than ones already written
+		self.nBytesWritten = 0
+		if self.nNewest > 0:
+			self.ReloadOpenBuckets()
+
+	def ReloadOpenBuckets(self): # Rebuild the rollups for the periods that had not ended when the store was last closed
+		oRaw = self.lsLevels[0]
+		nFrom = min(self.nNewest - self.nNewest % oLevel.nBucket_s for oLevel in self.lsLevels[1:])
+		lsRecords = []
+		for (nSegmentStart, sFile) in self.GetSegments(oRaw):
+			if nSegmentStart + oRaw.nSegment_s > nFrom:
+				lsRecords.extend(self.ReadSegment(oRaw, sFile, nFrom, self.nNewest + 1))
+		for oLevel in self.lsLevels[1:]:
+			oLevel.nOpenStart = self.nNewest - self.nNewest % oLevel.nBucket_s
+			for (nTimestamp, nSeriesID, dValue) in lsRecords:
+				if nTimestamp >= oLevel.nOpenStart:
+					oBucket = oLevel.dictBuckets.get(nSeriesID)
+					if oBucket is None:
+						oBucket = oLevel.dictBuckets[nSeriesID] = Bucket()
+					oBucket.Add(dValue)
+
+	def GetSeriesID(self, sName): # Returns the number for a series, adding it if it is new
+		nSeriesID = self.dictSeries.get(sName)
+		if nSeriesID is None:
+			nSeriesID = len(self.dictSeries)
+			self.dictSeries[sName] = nSeriesID
+			self.dictSeriesNames[nSeriesID] = sName
+			with open(self.sSeriesPath, "w") as f: # Only written when a sensor is added
+				json.dump(self.dictSeries, f)
+		return nSeriesID
+
+	def Add(self, sName, dValue, nTimestamp=None): # Add a reading. None values are skipped.
+		if dValue is None:
+			return
+		nTimestamp = int(time.time()) if nTimestamp is None else int(nTimestamp)
+		oRaw = self.lsLevels[0]
+		if nTimestamp < oRaw.nLastWritten or (self.lsLevels[1].nOpenStart is not None and nTimestamp < self.lsLevels[1].nOpenStart):
+			self.nLate += 1 # Would be out of order in the files
+			return
+		nSeriesID = self.GetSeriesID(sName)
+		oRaw.lsPending.append((nTimestamp, nSeriesID, dValue))
+		for oLevel in self.lsLevels[1:]:
+			nStart = nTimestamp - nTimestamp % oLevel.nBucket_s
+			if oLevel.nOpenStart != nStart:
+				self.CloseBuckets(oLevel)
+				oLevel.nOpenStart = nStart
+			oBucket = oLevel.dictBuckets.get(nSeriesID)
+			if oBucket is None:
+				oBucket = oLevel.dictBuckets[nSeriesID] = Bucket()
+			oBucket.Add(dValue)
+		if nTimestamp > self.nNewest:
+			self.nNewest = nTimestamp
+
+	def AddBatch(self, oBatch): # Add every value in an emoncms.EmoncmsBatch. Series are named "node/input" e.g. "Server_Room/CT1_Irms_A".
+		nNow = int(time.time())
+		for sNodeID in oBatch.lsNodeIDs:
+			for (sInputName, sValue, nTimestamp) in oBatch.dictValues[sNodeID]:
+				self.Add(sNodeID + "/" + sInputName, float(sValue), nNow if nTimestamp is None else nTimestamp)
+
+	def CloseBuckets(self, oLevel): # Turn the open period's buckets into records
+		if oLevel.nOpenStart is not None:
+			for nSeriesID in sorted(oLevel.dictBuckets):
+				oLevel.lsPending.append(oLevel.dictBuckets[nSeriesID].GetRecord(oLevel.nOpenStart, nSeriesID))
+		oLevel.dictBuckets = {}
+
+	def Flush(self): # Write the buffered records to the files and delete files that are past their retention. Call once per cycle.
+		for oLevel in self.lsLevels:
+			if not oLevel.lsPending:
+				continue
+			oLevel.lsPending.sort(key=lambda lsRecord: lsRecord[0]) # Readings from one cycle can arrive in any order
+			nSegmentStart = None
+			lsData = []
+			for lsRecord in oLevel.lsPending:
+				nStart = lsRecord[0] - lsRecord[0] % oLevel.nSegment_s
+				if nStart != nSegmentStart:
+					self.WriteSegment(oLevel, nSegmentStart, lsData)
+					nSegmentStart, lsData = nStart, []
+				lsData.append(oLevel.Struct.pack(*lsRecord))
+			self.WriteSegment(oLevel, nSegmentStart, lsData)
+			oLevel.nLastWritten = oLevel.lsPending[-1][0]
+			oLevel.lsPending = []
+		if self.nNewest - self.nLastEvicted >= 3600: # Only look for old files once an hour
+			self.Evict()
+			self.nLastEvicted = self.nNewest
+
+	def WriteSegment(self, oLevel, nSegmentStart, lsData): # Append packed records to a segment file
+		if lsData:
+			Data = b"".join(lsData)
+			with open(self.GetSegmentPath(oLevel, nSegmentStart), "ab") as f:
+				f.write(Data)
+			self.nBytesWritten += len(Data)
+
+	def Evict(self): # Delete the files that only hold data older than each level's retention
+		for oLevel in self.lsLevels:
+			for (nSegmentStart, sFile) in self.GetSegments(oLevel):
+				if nSegmentStart + oLevel.nSegment_s <= self.nNewest - oLevel.nRetention_s:
+					os.remove(sFile)
+
+	def GetSegmentPath(self, oLevel, nSegmentStart):
+		return os.path.join(self.sPath, oLevel.sName + "-" + str(nSegmentStart) + ".bin")
+
+	def GetSegments(self, oLevel): # Returns a sorted list of (start time, path) of a level's files
+		lsSegments = []
+		for sFile in os.listdir(self.sPath):
+			if sFile.startswith(oLevel.sName + "-") and sFile.endswith(".bin"):
+				lsSegments.append((int(sFile[len(oLevel.sName) + 1:-4]), os.path.join(self.sPath, sFile)))
+		return sorted(lsSegments)
+
+	def ReadSegment(self, oLevel, sFile, nStart, nEnd, nSeriesID=None): # Returns the records in a file from nStart up to but not including nEnd
+		nSize = oLevel.Struct.size
+		with open(sFile, "rb") as f:
+			nRecords = os.fstat(f.fileno()).st_size // nSize
+			if nRecords == 0: # An empty file can not be memory mapped
+				return []
+			Map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			nLow = self.Search(Map, nSize, nRecords, nStart)
+			nHigh = self.Search(Map, nSize, nRecords, nEnd)
+			lsRecords = [oLevel.Struct.unpack_from(Map, nOffset) for nOffset in range(nLow * nSize, nHigh * nSize, nSize)]
+		finally:
+			Map.close()
+		if nSeriesID is not None:
+			lsRecords = [lsRecord for lsRecord in lsRecords if lsRecord[1] == nSeriesID]
+		return lsRecords
+
+	def Search(self, Map, nSize, nRecords, nTimestamp): # Returns the first record with a time of nTimestamp or later
+		nLow, nHigh = 0, nRecords
+		while nLow < nHigh:
+			nMid = (nLow + nHigh) // 2
+			if oTimeStruct.unpack_from(Map, nMid * nSize)[0] < nTimestamp:
+				nLow = nMid + 1
+			else:
+				nHigh = nMid
+		return nLow
+
+	def ChooseLevel(self, nStart, nEnd, nMaxPoints=2000, nRawInterval_s=60): # Finest level that still has data for nStart and gives no more than about nMaxPoints
+		for oLevel in self.lsLevels:
+			if (nEnd - nStart) / float(oLevel.nBucket_s or nRawInterval_s) <= nMaxPoints and nStart >= self.nNewest - oLevel.nRetention_s:
+				return oLevel
+		return self.lsLevels[-1]
+
+	def Query(self, sName, nStart, nEnd, sLevel=None): # Returns the records for a series from nStart up to but not including nEnd
+		# Raw records are (time, value). Rollup records are (start time, count, min, max, mean, 80th percentile).
+		# If sLevel ("raw", "1m", "15m" or "1h") is not given one is chosen from the length of the range.
+		nSeriesID = self.dictSeries.get(sName)
+		if nSeriesID is None:
+			return []
+		oLevel = self.ChooseLevel(nStart, nEnd) if sLevel is None else self.dictLevels[sLevel]
+		lsResults = []
+		for (nSegmentStart, sFile) in self.GetSegments(oLevel):
+			if nSegmentStart + oLevel.nSegment_s > nStart and nSegmentStart < nEnd:
+				lsResults.extend(lsRecord[:1] + lsRecord[2:] for lsRecord in self.ReadSegment(oLevel, sFile, nStart, nEnd, nSeriesID))
+		for lsRecord in oLevel.lsPending: # Records that have not been flushed yet
+			if lsRecord[1] == nSeriesID and nStart <= lsRecord[0] < nEnd:
+				lsResults.append(lsRecord[:1] + lsRecord[2:])
+		return lsResults
+
+	def GetSeries(self): # Returns the names of all the series
+		return sorted(self.dictSeries)
+
+	def Close(self): # Write anything still buffered. The rollups that have not ended are rebuilt next time the store is opened.
+		self.Flush()
+
+
+
+# --- Functions ---
+def Benchmark(nDays=365, nSeries=15, nInterval_s=60, nSeed=1): # Time the ingest of a year of readings and queries over it
+	import random
+	import shutil
+	import tempfile
+	oRandom = random.Random(nSeed)
+	sPath = tempfile.mkdtemp()
+	try:
+		oStore = HistoryStore(sPath)
+		lsNames = ["Server_Room/S" + str(n) for n in range(nSeries)]
+		nStart = 1500000000 - 1500000000 % 86400
+		nEnd = nStart + nDays * 86400
+		nSamples = 0
+		dStart = time.time()
+		for nTimestamp in range(nStart, nEnd, nInterval_s): # One cycle
+			for sName in lsNames:
+				oStore.Add(sName, 20 + 5 * oRandom.random(), nTimestamp)
+			nSamples += nSeries
+			oStore.Flush()
+		dIngest_s = time.time() - dStart
+		oStore.Close()
+		nBytesWritten = oStore.nBytesWritten
+		oStore = HistoryStore(sPath) # Open it again as a script started by cron would
+		nBytes = sum(os.path.getsize(os.path.join(sPath, sFile)) for sFile in os.listdir(sPath))
+		print("Ingest: " + str(nSamples) + " readings in " + "%.1f" % dIngest_s + " s = " + "%.0f" % (nSamples / dIngest_s) + " readings/s, "
+			+ "%.1f" % (nBytesWritten / float(nDays)) + " bytes written per day, " + "%.1f" % (nBytes / 1e6) + " MB kept after retention")
+
+		for (sDescription, nRange_s) in (("Last hour", 3600), ("Last day", 86400), ("Last month", 31 * 86400), ("Last year", 365 * 86400)):
+			nRuns = 20
+			dStart = time.time()
+			for n in range(nRuns):
+				lsRecords = oStore.Query(lsNames[n % nSeries], nEnd - nRange_s, nEnd)
+			dQuery_s = (time.time() - dStart) / nRuns
+			print(sDescription + ": " + str(len(lsRecords)) + " records from level " + oStore.ChooseLevel(nEnd - nRange_s, nEnd).sName
+				+ " in " + "%.2f" % (dQuery_s * 1000) + " ms")
+
+		lsHour = oStore.Query(lsNames[0], nEnd - 7200, nEnd, "1h")[0] # The last hour that has ended
+		lsRaw = [dValue for (nTimestamp, dValue) in oStore.Query(lsNames[0], lsHour[0], lsHour[0] + 3600, "raw")]
+		if lsHour[1] != len(lsRaw) or abs(lsHour[4] - sum(lsRaw) / len(lsRaw)) > 1e-4: # The rollup matches the raw readings
+			raise AssertionError("Hourly rollup does not match the raw readings")
+	finally:
+		shutil.rmtree(sPath)
+
+
+
+# --- Main Code ---
+oRawStruct = struct.Struct("<IHf") # Time, series number, value = 10 bytes
+oRollupStruct = struct.Struct("<IHIffff") # Start time, series number, count, min, max, mean, 80th percentile = 26 bytes
+oTimeStruct = struct.Struct("<I") # Every record starts with its time
+
+if __name__ == "__main__":
+	Benchmark()
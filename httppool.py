@@ -0,0 +1,128 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Keep web connections open between requests and cycles so each post does not have to connect again. Used by emoncms.py
+# Notes: Connections are kept in a pool per server address and reused (keep-alive). A connection that has been idle for
+# longer than dMaxIdle_s is closed rather than reused, and if a reused connection turns out to have been closed by the
+# server the request is tried once more on a new connection. Connecting and waiting for a response each have their own
+# timeout so a hung server can not freeze the script. Addresses starting with https:// use TLS so the API key is not sent
+# in plain text, e.g. "https://emoncms.org". Addresses without a scheme e.g. "emoncms.org:80" use plain HTTP as before.
+
+# --- Imports ---
+import time # Used to work out how long a connection has been idle
+import threading # Used to share the pool between the servers' threads
+import socket # Used for the network errors
+from metrics import oSharedMetrics # Used to count new and reused connections
+
+
+
+# --- Classes ---
+class ConnectionPool(object): # Class holding the idle connections for every server address
+	def __init__(self, dConnectTimeout_s=5, dReadTimeout_s=10, dMaxIdle_s=60, nMaxIdlePerHost=2):
+		self.dConnectTimeout_s = dConnectTimeout_s
+		self.dReadTimeout_s = dReadTimeout_s
+		self.dMaxIdle_s = dMaxIdle_s # Servers close idle connections after a while so do not reuse old ones
+		self.nMaxIdlePerHost = nMaxIdlePerHost
+		self.dictIdle = {} # Address -> list of (connection, time it was last used)
+		self.Lock = threading.Lock()
+		self.nConnects = 0 # Number of new connections made
+		self.nReuses = 0 # Number of requests sent on a connection that was already open
+		self.nRetries = 0 # Number of requests tried again because a reused connection had been closed
+
+	def GetHost(self, sAddress, dConnectTimeout_s=None, dReadTimeout_s=None): # Returns a HostConnection for an address e.g. "emoncms.org:80" or "https://emoncms.org"
+		return HostConnection(self, sAddress, self.dConnectTimeout_s if dConnectTimeout_s is None else dConnectTimeout_s,
+			self.dReadTimeout_s if dReadTimeout_s is None else dReadTimeout_s)
+
+	def Take(self, sAddress): # Take an idle connection for an address, or None if there is not one
+		dNow = time.time()
+		with self.Lock:
+			lsIdle = self.dictIdle.get(sAddress, [])
+			while lsIdle:
+				Connection, dLastUsed = lsIdle.pop() # Most recently used first as it is the least likely to have been closed
+				if dNow - dLastUsed <= self.dMaxIdle_s:
+					return Connection
+				Connection.close()
+		return None
+
+	def Give(self, sAddress, Connection): # Put a connection back once its response has been read
+		with self.Lock:
+			lsIdle = self.dictIdle.setdefault(sAddress, [])
+			lsIdle.append((Connection, time.time()))
+			while len(lsIdle) > self.nMaxIdlePerHost:
+				lsIdle.pop(0)[0].close()
+
+	def Close(self, sAddress=None): # Close the idle connections for an address, or for every address
+		with self.Lock:
+			for sKey in list(self.dictIdle):
+				if sAddress is None or sKey == sAddress:
+					for (Connection, dLastUsed) in self.dictIdle.pop(sKey):
+						Connection.close()
+
+
+class HostConnection(object): # Class used to send requests to one address through the pool
+	def __init__(self, oPool, sAddress, dConnectTimeout_s, dReadTimeout_s):
+		self.oPool = oPool
+		self.sAddress = sAddress
+		self.dConnectTimeout_s = dConnectTimeout_s
+		self.dReadTimeout_s = dReadTimeout_s
+		self.bHTTPS = int(sAddress.lower().startswith("https://"))
+		self.sHost = sAddress.split("://", 1)[-1].rstrip("/") # Host with optional port number
+
+	def Connect(self): # Make a new connection using the connect timeout, then switch to the read timeout
+		if httplib is None:
+			ImportHTTPLib()
+		if self.bHTTPS == 1:
+			Connection = httplib.HTTPSConnection(self.sHost, timeout=self.dConnectTimeout_s) # Checks the server certificate on Python 2.7.9+ and 3
+		else:
+			Connection = httplib.HTTPConnection(self.sHost, timeout=self.dConnectTimeout_s)
+		Connection.connect()
+		Connection.sock.settimeout(self.dReadTimeout_s)
+		self.oPool.nConnects += 1
+		oSharedMetrics.Inc("http_connections_total", server=self.sAddress, result="new")
+		return Connection
+
+	def Request(self, sMethod, sPath): # Send a request and return (status, reason, body)
+		Connection = self.oPool.Take(self.sAddress)
+		bReused = int(Connection is not None)
+		while True:
+			if Connection is None:
+				Connection = self.Connect()
+			elif bReused == 1:
+				self.oPool.nReuses += 1
+				oSharedMetrics.Inc("http_connections_total", server=self.sAddress, result="reused")
+			try:
+				Connection.request(sMethod, sPath)
+				Response = Connection.getresponse()
+				Body = Response.read() # The whole response must be read before the connection can be used again
+			except (httplib.HTTPException, socket.error) as e:
+				Connection.close()
+				if bReused == 1 and not isinstance(e, socket.timeout): # The server probably closed the idle connection so try once on a new one
+					self.oPool.nRetries += 1
+					oSharedMetrics.Inc("http_connections_total", server=self.sAddress, result="retried")
+					Connection = None
+					bReused = 0
+					continue
+				raise
+			if Response.getheader("connection", "").lower() == "close" or Response.version < 11: # The server will not keep this connection open
+				Connection.close()
+			else:
+				self.oPool.Give(self.sAddress, Connection)
+			return Response.status, Response.reason, Body
+
+	def Close(self): # Close the idle connections to this address
+		self.oPool.Close(self.sAddress)
+
+
+
+# --- Functions ---
+def ImportHTTPLib(): # Only imported when the first connection is made as it also loads ssl, which slows down starting the scripts
+	global httplib
+	try:
+		import httplib # Used for web access. Python 2
+	except ImportError:
+		import http.client as httplib # Used for web access. Python 3
+
+
+
+# --- Main Code ---
+httplib = None # Set by ImportHTTPLib()
+oSharedPool = ConnectionPool() # Pool shared by all the emoncms servers in the script
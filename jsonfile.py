@@ -0,0 +1,30 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Save the state files (energy totals, last values published, metrics) so they survive a power cut. Used by
+# energy.py, publish.py and metrics.py.
+# Notes: The JSON is written to a temporary file which is synced to the SD card and then renamed over the old file, so
+# the file is either the old one or the new one and never half written, even if the Pi loses power part way through.
+# The folder is also synced so the rename itself is not lost.
+
+# --- Imports ---
+import os # Used to sync and replace the file
+import json # Used to write the file
+
+
+
+# --- Functions ---
+def SaveJSON(sPath, Data, nIndent=None): # Replace a JSON file in one step
+	sTempPath = sPath + ".tmp"
+	with open(sTempPath, "w") as f:
+		json.dump(Data, f, indent=nIndent, sort_keys=True)
+		f.flush()
+		os.fsync(f.fileno()) # On the SD card before it replaces the old file
+	os.rename(sTempPath, sPath)
+	try:
+		nFolder = os.open(os.path.dirname(os.path.abspath(sPath)), os.O_RDONLY)
+	except OSError: # Folders can not be opened on Windows
+		return
+	try:
+		os.fsync(nFolder)
+	finally:
+		os.close(nFolder)
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Count and time what the scripts are doing so it can be seen where each cycle's time goes. Used by all the v2 code.
+# Notes: The modules add to the shared oSharedMetrics object: counters (e.g. frames rejected, DHT22 tries per pin, HTTP status
+# codes per server), gauges (e.g. readings waiting in the outbox) and timings (e.g. serial read latency, percentile time,
+# HTTP latency), each with optional labels. Timings are kept as a count and a total so the average can be worked out.
+# MetricsServer serves them on a local port in the Prometheus text format at /metrics and as JSON at /metrics.json, and
+# Dump() writes the JSON to a file e.g. for when the script is run from cron. Adding to a metric takes a lock and a
+# dictionary update so it can be left in the hot paths.
+
+# --- Imports ---
+import time # Used for the timings
+import json # Used for the JSON dump
+from jsonfile import SaveJSON # Used to write the JSON file
+import threading # Used to share the metrics between threads and to run the server in the background
+
+
+
+# --- Classes ---
+class Metrics(object): # Class holding every metric
+	def __init__(self, sPrefix="monitor_"):
+		self.sPrefix = sPrefix # Added to the start of every name
+		self.Lock = threading.Lock()
+		self.dictTypes = {} # Name -> "counter", "gauge" or "summary"
+		self.dictValues = {} # (name, labels) -> value, or [count, total] for a summary. Labels are a sorted tuple of (name, value as a string).
+
+	def Inc(self, sName, dValue=1, **dictLabels): # Add to a counter
+		tKey = GetKey(sName, dictLabels)
+		with self.Lock:
+			self.dictTypes.setdefault(sName, "counter")
+			self.dictValues[tKey] = self.dictValues.get(tKey, 0) + dValue
+
+	def Set(self, sName, dValue, **dictLabels): # Set a gauge
+		tKey = GetKey(sName, dictLabels)
+		with self.Lock:
+			self.dictTypes.setdefault(sName, "gauge")
+			self.dictValues[tKey] = dValue
+
+	def Observe(self, sName, dValue, **dictLabels): # Add a timing (or any other amount) to a summary
+		tKey = GetKey(sName, dictLabels)
+		with self.Lock:
+			self.dictTypes.setdefault(sName, "summary")
+			lsSummary = self.dictValues.get(tKey)
+			if lsSummary is None:
+				lsSummary = self.dictValues[tKey] = [0, 0.0]
+			lsSummary[0] += 1
+			lsSummary[1] += dValue
+
+	def Time(self, sName, **dictLabels): # Used as "with oMetrics.Time(name):" to time a block of code
+		return Timer(self, sName, dictLabels)
+
+	def GetValue(self, sName, **dictLabels): # Returns the value of a metric, or None if it has not been set
+		with self.Lock:
+			return self.dictValues.get(GetKey(sName, dictLabels))
+
+	def Reset(self):
+		with self.Lock:
+			self.dictTypes = {}
+			self.dictValues = {}
+
+	def Render(self): # Returns the metrics in the Prometheus text format
+		with self.Lock:
+			lsItems = sorted(self.dictValues.items())
+			dictTypes = dict(self.dictTypes)
+		lsLines = []
+		sLastName = None
+		for ((sName, tLabels), Value) in lsItems:
+			sFullName = self.sPrefix + sName
+			if sName != sLastName:
+				lsLines.append("# TYPE " + sFullName + " " + dictTypes[sName])
+				sLastName = sName
+			sLabels = FormatLabels(tLabels)
+			if dictTypes[sName] == "summary":
+				lsLines.append(sFullName + "_count" + sLabels + " " + repr(Value[0]))
+				lsLines.append(sFullName + "_sum" + sLabels + " " + repr(float(Value[1])))
+			else:
+				lsLines.append(sFullName + sLabels + " " + repr(float(Value)))
+		return "\n".join(lsLines) + "\n"
+
+	def GetDict(self): # Returns the metrics as a dictionary of name -> list of {"labels": ..., "value": ...}
+		with self.Lock:
+			lsItems = sorted(self.dictValues.items())
+			dictTypes = dict(self.dictTypes)
+		dictResult = {}
+		for ((sName, tLabels), Value) in lsItems:
+			dictItem = {"labels": dict(tLabels)}
+			if dictTypes[sName] == "summary":
+				dictItem.update({"count": Value[0], "sum": Value[1], "mean": Value[1] / Value[0]})
+			else:
+				dictItem["value"] = Value
+			dictResult.setdefault(self.sPrefix + sName, []).append(dictItem)
+		return dictResult
+
+	def Dump(self, sPath): # Write the metrics to a JSON file
+		SaveJSON(sPath, {"time": time.time(), "metrics": self.GetDict()}, 1)
+
+
+class Timer(object): # Class used to time a block of code and add the time to a summary
+	def __init__(self, oMetrics, sName, dictLabels):
+		self.oMetrics = oMetrics
+		self.sName = sName
+		self.dictLabels = dictLabels
+
+	def __enter__(self):
+		self.dStart = time.time()
+		return self
+
+	def __exit__(self, *args):
+		self.oMetrics.Observe(self.sName, time.time() - self.dStart, **self.dictLabels)
+		return False # Errors are not hidden
+
+
+class MetricsServer(object): # Class for the local web server the metrics are read from
+	def __init__(self, oMetrics=None, nPort=9105, sAddress="127.0.0.1"):
+		self.oMetrics = oSharedMetrics if oMetrics is None else oMetrics
+		self.nPort = nPort
+		self.sAddress = sAddress # Use "" to allow other machines e.g. a Prometheus server to read the metrics
+		self.oHTTPServer = None
+
+	def Start(self):
+		try:
+			from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler # Python 2. Only imported when the server is used as it is slow to load.
+		except ImportError:
+			from http.server import HTTPServer, BaseHTTPRequestHandler # Python 3
+		oMetrics = self.oMetrics
+		class MetricsHandler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path.split("?")[0] == "/metrics":
+					Body, sContentType = oMetrics.Render().encode("utf-8"), "text/plain; version=0.0.4"
+				elif self.path.split("?")[0] == "/metrics.json":
+					Body, sContentType = json.dumps(oMetrics.GetDict(), sort_keys=True).encode("utf-8"), "application/json"
+				else:
+					self.send_error(404)
+					return
+				self.send_response(200)
+				self.send_header("Content-Type", sContentType)
+				self.send_header("Content-Length", str(len(Body)))
+				self.end_headers()
+				self.wfile.write(Body)
+			def log_message(self, *args): # Do not print each request
+				pass
+		self.oHTTPServer = HTTPServer((self.sAddress, self.nPort), MetricsHandler)
+		self.nPort = self.oHTTPServer.server_address[1] # In case port 0 was used to pick a free port
+		oThread = threading.Thread(target=self.oHTTPServer.serve_forever)
+		oThread.daemon = True # The server must not stop the script from exiting
+		oThread.start()
+
+	def Stop(self):
+		if self.oHTTPServer is not None:
+			self.oHTTPServer.shutdown()
+			self.oHTTPServer.server_close()
+			self.oHTTPServer = None
+
+
+
+# --- Functions ---
+def GetKey(sName, dictLabels): # Returns the dictionary key for a metric. Label values are turned into strings so they always sort.
+	return (sName, tuple(sorted((sLabel, str(Value)) for (sLabel, Value) in dictLabels.items())))
+
+def FormatLabels(tLabels): # Returns the labels in the Prometheus format e.g. {server="emoncms.org",status="200"}
+	if not tLabels:
+		return ""
+	return "{" + ",".join(sName + '="' + Value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"' for (sName, Value) in tLabels) + "}"
+
+
+
+# --- Main Code ---
+oSharedMetrics = Metrics() # Metrics shared by all the modules in the script
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Keep every reading on the SD card until each emoncms server has accepted it. Used by the v2 scripts.
+# Notes: When a server could not be reached the reading used to be lost. Now every batch is written to an SQLite database
+# for each enabled server before anything is posted. The database is in WAL mode with synchronous=FULL and each cycle is
+# one transaction, so the SD card is synced once per cycle and a reading in the outbox survives a power cut. Each server
+# is then sent its oldest readings first through the input/bulk API with their original timestamps, and readings are
+# only removed once the server has accepted them. The database is limited to nMaxRows rows (the oldest are thrown away
+# first) and at most nMaxRowsPerCycle rows are sent to a server each cycle so a long backlog does not swamp the server or
+# the Pi when it comes back. The number of rows for each server is counted once when the database is opened and then
+# kept up to date as rows are added and removed, so the table is not scanned every cycle.
+# Run this file on its own to check the outbox against a local stub emoncms server that goes down and comes back.
+
+# --- Imports ---
+import sqlite3 # Used for the database
+import threading # Used to stop two servers using the database at the same time
+import time # Used for timestamps
+from emoncms import EmoncmsBatch, PublishResult # Used to replay the readings to the servers
+from metrics import oSharedMetrics # Used to show how many readings are waiting
+
+
+
+# --- Classes ---
+class Outbox(object): # Class for the database of readings that have not been sent yet
+	def __init__(self, sPath, nMaxRows=200000, nMaxRowsPerCycle=1000, nRowsPerPost=100):
+		self.sPath = sPath
+		self.nMaxRows = nMaxRows # Roughly 50 bytes per row on disk
+		self.nMaxRowsPerCycle = nMaxRowsPerCycle # Most rows sent to each server per cycle
+		self.nRowsPerPost = nRowsPerPost # Rows in each input/bulk request
+		self.Lock = threading.Lock()
+		self.Connection = sqlite3.connect(sPath, check_same_thread=False) # The servers are posted to on their own threads
+		self.Connection.execute("PRAGMA journal_mode=WAL") # Writes are appended to a log rather than rewriting the database
+		self.Connection.execute("PRAGMA synchronous=FULL") # Sync the log to the SD card on every commit. NORMAL only syncs at checkpoints so a power cut could lose committed rows.
+		self.Connection.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, server TEXT, node TEXT, time INTEGER, name TEXT, value TEXT)")
+		self.Connection.execute("CREATE INDEX IF NOT EXISTS outbox_server ON outbox (server, id)")
+		self.Connection.commit()
+		self.nDropped = 0 # Rows thrown away because the database was full
+		self.dictBacklog = dict(self.Connection.execute("SELECT server, COUNT(*) FROM outbox GROUP BY server").fetchall()) # Server name -> rows waiting
+		self.nRows = sum(self.dictBacklog.values())
+
+	def Add(self, oBatch, lsServers): # Store a batch for each of the servers. Values without a timestamp are given the current time.
+		nNow = int(time.time())
+		lsRows = []
+		for sNodeID in oBatch.lsNodeIDs:
+			for (sInputName, sValue, nTimestamp) in oBatch.dictValues[sNodeID]:
+				for oServer in lsServers:
+					lsRows.append((oServer.sName, sNodeID, nNow if nTimestamp is None else int(nTimestamp), sInputName, sValue))
+		with self.Lock:
+			self.Connection.executemany("INSERT INTO outbox (server, node, time, name, value) VALUES (?, ?, ?, ?, ?)", lsRows)
+			for lsRow in lsRows:
+				self.dictBacklog[lsRow[0]] = self.dictBacklog.get(lsRow[0], 0) + 1
+			self.nRows += len(lsRows)
+			if self.nRows > self.nMaxRows: # Database is full so throw away the oldest readings
+				nExtra = self.nRows - self.nMaxRows
+				for (sServer, nCount) in self.Connection.execute("SELECT server, COUNT(*) FROM (SELECT server FROM outbox ORDER BY id LIMIT ?) GROUP BY server", (nExtra,)).fetchall():
+					self.dictBacklog[sServer] -= nCount
+				self.Connection.execute("DELETE FROM outbox WHERE id IN (SELECT id FROM outbox ORDER BY id LIMIT ?)", (nExtra,))
+				self.nRows -= nExtra
+				self.nDropped += nExtra
+			self.Connection.commit() # One transaction per cycle
+
+	def Drain(self, oServer, bDebugPrint, dStop=None): # Send the oldest readings for a server until none are left, the cycle limit or dStop is reached
+		dStart = time.time()
+		nSent = 0
+		while nSent < self.nMaxRowsPerCycle and (dStop is None or time.time() < dStop):
+			with self.Lock:
+				lsRows = self.Connection.execute("SELECT id, node, time, name, value FROM outbox WHERE server = ? ORDER BY id LIMIT ?",
+					(oServer.sName, min(self.nRowsPerPost, self.nMaxRowsPerCycle - nSent))).fetchall()
+			if len(lsRows) == 0:
+				break
+			oBatch = EmoncmsBatch()
+			for (nID, sNodeID, nTimestamp, sInputName, sValue) in lsRows:
+				oBatch.AddInput(sNodeID, sInputName, sValue, nTimestamp) # Every value has a timestamp so input/bulk is used
+			oResult = oServer.Post(oBatch, bDebugPrint)
+			if oResult.bSuccess == 0: # Leave the readings in the outbox to try again next cycle
+				oResult.dDuration_s = time.time() - dStart
+				nBacklog = self.GetBacklog(oServer)
+				oSharedMetrics.Set("outbox_backlog", nBacklog, server=oServer.sName)
+				oResult.sError += " (" + str(nBacklog) + " readings waiting)"
+				return oResult
+			with self.Lock:
+				nDeleted = self.Connection.executemany("DELETE FROM outbox WHERE id = ?", [(lsRow[0],) for lsRow in lsRows]).rowcount # Fewer than were sent if some were thrown away while posting
+				self.Connection.commit()
+				self.dictBacklog[oServer.sName] = self.dictBacklog.get(oServer.sName, 0) - nDeleted
+				self.nRows -= nDeleted
+			nSent += len(lsRows)
+		oSharedMetrics.Set("outbox_backlog", self.GetBacklog(oServer), server=oServer.sName)
+		return PublishResult(oServer.sName, 1, "", time.time() - dStart)
+
+	def GetBacklog(self, oServer=None): # Number of readings waiting to be sent to a server, or to all servers
+		with self.Lock:
+			if oServer is None:
+				return self.nRows
+			return self.dictBacklog.get(oServer.sName, 0)
+
+	def Close(self):
+		with self.Lock:
+			self.Connection.close()
+
+
+
+# --- Functions ---
+def SelfTest(): # Post through the outbox to a stub server that is down for the first few cycles and check nothing is lost
+	import os
+	import tempfile
+	from emoncms import EmoncmsServer, PublishToServers, StubEmoncmsServer
+
+	oStub = StubEmoncmsServer().Start()
+	oStub.Stop() # Server starts off down
+	sPath = os.path.join(tempfile.mkdtemp(), "outbox.db")
+	oOutbox = Outbox(sPath, nRowsPerPost=3)
+	oServer = EmoncmsServer("Stub", oStub.GetAddress(), "/", "key", dTimeout_s=2)
+	for nCycle in range(6):
+		if nCycle == 3: # Server comes back on the same port
+			oStub.Start()
+		oBatch = EmoncmsBatch()
+		oBatch.AddValue("Server_Room", "CT1", "Irms_A", 1.0 + nCycle, nTimestamp=1000 + nCycle * 60)
+		oBatch.AddValue("Server_Room", "VT1", "Vrms_V", 240.0, nTimestamp=1000 + nCycle * 60)
+		lsResults = PublishToServers([oServer], oBatch, 0, oOutbox)
+		print("Cycle " + str(nCycle) + ": success " + str(lsResults[0].bSuccess) + ", backlog " + str(oOutbox.GetBacklog()))
+	oStub.Stop()
+	lsRequests = oStub.lsRequests
+	print(str(len(lsRequests)) + " bulk requests sent")
+	if oOutbox.GetBacklog() != 0 or not all("input/bulk" in sRequest for sRequest in lsRequests):
+		raise AssertionError("Outbox did not send every reading")
+	for nCycle in range(6): # Every reading arrived with its original timestamp
+		if not any("%5B" + str(1000 + nCycle * 60) + "," in sRequest for sRequest in lsRequests):
+			raise AssertionError("Reading from cycle " + str(nCycle) + " is missing")
+	oOutbox.Close()
+
+
+
+# --- Main Code ---
+if __name__ == "__main__":
+	SelfTest()
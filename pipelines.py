@@ -0,0 +1,181 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Take a set of readings from the CT/VT board or the DHT22 sensors and add them to a batch for emoncms. Used by
+# read_board_v2.py, read_sensors_v2.py and collector.py
+# Notes: Each pipeline takes its sensors from the registry loaded from sensors.json (see config.py) and is given the
+# registry each cycle, so sensors can be changed in the file while the scripts are running in daemon mode. The board
+# pipeline reads the serial port on a background thread, so collector.py can read the DHT22 sensors while the board's
+# frames are being collected and then send both sets of readings in one post per server.
+
+# --- Imports ---
+import time # Used for the delay
+from metrics import oSharedMetrics # Used to time each stage and count the readings removed by the error check
+from capture import oSharedRecorder # Used to mark the start of each DHT22 cycle when capturing is on
+
+
+
+# --- Classes ---
+class BoardPipeline(object): # Class used to take readings from the RPICT3V1 board
+	def __init__(self, nFrameBufferSize=1000, dSampleWindow_s=30, bDebugPrint=0, fnOpenSerial=None, bEnergy=0, sEnergyPath=None, oAlerts=None):
+		self.nFrameBufferSize = nFrameBufferSize # Number of frames kept in memory by the serial reader
+		self.fnOpenSerial = fnOpenSerial # None = the real serial port, or e.g. rpict3v1.SimulatedBoard().Open to run without the board
+		self.bEnergy = bEnergy # 1 = work out the kWh, apparent power, power factor and peak power of each CT from every frame (see energy.py)
+		self.sEnergyPath = sEnergyPath # JSON file the kWh totals are kept in between runs
+		self.oEnergy = None
+		self.lsEnergyValues = [] # (CT name, dictionary of reading type -> value) for the last cycle
+		self.oAlerts = oAlerts # AlertEngine every frame is checked against as it arrives (see alerts.py). None = off.
+		self.lsAlertChannels = [] # (input name, scale, min, max) for each board channel
+		self.dSampleWindow_s = dSampleWindow_s # Time spent collecting frames on the first cycle
+		self.bDebugPrint = bDebugPrint
+		self.oRegistry = None # Registry the store and reader were set up for
+		self.oStore = None
+		self.oReader = None
+		self.nLastFrame = 0 # Sequence number of the last frame used
+		self.dStarted = None # Time the serial reader was started
+		self.bReplay = 0 # 1 when the data is given to AddData() from a capture file rather than read from the serial port
+
+	def Setup(self, oRegistry): # Set up the serial reader for the channels in the config. The store is set up by Read().
+		from rpict3v1 import SerialReader, FrameDecoder # Only imported when the board is used
+		self.Stop() # The config has been changed so start again with the new channels
+		self.oStore = None
+		oDecoder = FrameDecoder(len(oRegistry.lsChannels)) # The values are scaled by the store
+		self.lsAlertChannels = list(zip(oRegistry.GetChannelNames(), oRegistry.GetChannelScales(), *oRegistry.GetChannelLimits()))
+		self.oReader = SerialReader(oRegistry.sSerialPort, oRegistry.nBaudRate, self.nFrameBufferSize, self.bDebugPrint, oDecoder, self.fnOpenSerial,
+			None if self.oAlerts is None else self.CheckAlerts) # Reads every frame from the serial port in the background
+		self.nLastFrame = 0
+		self.oRegistry = oRegistry
+
+	def Start(self, oRegistry): # Clear the last cycle's readings and make sure the serial port is being read
+		if oRegistry is not self.oRegistry:
+			self.Setup(oRegistry)
+		if self.oAlerts is not None:
+			self.oAlerts.SetConfig(oRegistry.dictAlerts)
+		for oSensor in oRegistry.lsCTVTSensors:
+			oSensor.ClearReadings()
+		if self.oStore is not None:
+			self.oStore.Clear()
+		if not self.oReader.bRunning and self.bReplay == 0: # The serial port is opened once and kept open, every frame the board sends is stored by the reader
+			self.oReader.Start()
+			self.dStarted = time.time()
+
+	def Read(self, oRegistry): # Work out the final values from every frame received since the last cycle
+		if self.oStore is None: # Set up here rather than in Setup() so numpy is loaded while the first frames are arriving rather than before the serial port is opened
+			from samplestore import SampleStore # Only imported when the board is used so numpy is not loaded to read the DHT22 sensors
+			self.oStore = SampleStore(len(oRegistry.lsChannels), self.nFrameBufferSize, # CTs being used are 100/1A which means they dont measure small currents well. To compensate extra turns have been used on the primary side.
+				oRegistry.GetChannelScales(), *oRegistry.GetChannelLimits()) # Power and current are divided by the turns ratio and current comes back in mA
+			if self.bEnergy == 1:
+				if self.oEnergy is None:
+					from energy import EnergyAccumulator # Only imported when the board is used
+					self.oEnergy = EnergyAccumulator(self.sEnergyPath, oRegistry.dEnergyMaxGap_s, self.bDebugPrint)
+				self.oEnergy.dMaxGap_s = oRegistry.dEnergyMaxGap_s
+				self.oEnergy.SetChannels(oRegistry.GetEnergyChannels()) # The totals are kept by CT name so they carry on if the channels have changed
+		if self.nLastFrame == 0 and self.bReplay == 0: # There is no data from a previous cycle so wait for the buffer to fill
+			time.sleep(max(0, self.dStarted + self.dSampleWindow_s - time.time())) # Any time spent reading other sensors since Start() counts
+		with oSharedMetrics.Time("stage_seconds", stage="board_store"):
+			lsFrames, self.nLastFrame = self.oReader.GetFramesAfter(self.nLastFrame) # Use every frame received since the last cycle
+			nAdded = self.oStore.AddFrames([aValues for (dTimestamp, aValues) in lsFrames]) # Scales and error checks every channel of every frame at once
+		if self.oEnergy is not None:
+			with oSharedMetrics.Time("stage_seconds", stage="board_energy"):
+				if nAdded > 0: # Every frame since the last cycle so nothing is missed between posts
+					self.oEnergy.AddFrames([dTimestamp for (dTimestamp, aValues) in lsFrames[-nAdded:]], self.oStore.GetOrdered()[-nAdded:])
+				self.lsEnergyValues = self.oEnergy.EndCycle()
+				self.oEnergy.Save()
+		aGood, aBad = self.oStore.GetCounts()
+		for (sChannel, nGood, nBad) in zip(oRegistry.GetChannelNames(), aGood, aBad):
+			oSharedMetrics.Inc("readings_total", int(nGood), channel=sChannel, result="good")
+			oSharedMetrics.Inc("readings_total", int(nBad), channel=sChannel, result="rejected")
+
+		if self.bDebugPrint ==1 :
+			print("FORMATTED DATA: Note error check has been perfomed to extreme values have been removed")
+			self.oStore.PrintValues(oRegistry.GetChannelNames())
+
+		# Use each channel's filter from the config. This removes any values that are within the limits of the sensor but are clearly false.
+		# The value is None if there were no good readings so it is not sent to emoncms.
+		with oSharedMetrics.Time("stage_seconds", stage="board_filter"):
+			lsValues = self.oStore.GetFiltered(oRegistry.GetChannelFilters())
+		for (oSensor, sSensorValueType), dValue in zip(oRegistry.lsChannels, lsValues):
+			oSensor.SetValue(sSensorValueType, dValue)
+
+		if self.bDebugPrint == 1:
+			print("FINAL DATA TO BE SENT TO EMONCMS:")
+			for oSensor in oRegistry.lsCTVTSensors:
+				oSensor.PrintValues()
+
+	def CheckAlerts(self, dTimestamp, oBlock): # Run on the serial reader's thread as soon as frames arrive
+		for n in range(len(oBlock)):
+			for ((sName, dScale, dMin, dMax), dRaw) in zip(self.lsAlertChannels, oBlock.GetFrame(n)):
+				dValue = dRaw * dScale
+				if dMin <= dValue <= dMax: # Values outside the range of the sensor are bad data
+					self.oAlerts.Check(sName, dValue, dTimestamp)
+
+	def AddData(self, oRegistry, Data, dTimestamp): # Add data from the serial port recorded in a capture file (see capture.py) in place of reading the port
+		if oRegistry is not self.oRegistry:
+			self.Setup(oRegistry)
+		self.bReplay = 1
+		self.oReader.AddData(Data, dTimestamp)
+
+	def AddToBatch(self, oBatch, oRegistry): # Add the final values to a batch for emoncms
+		for (oSensor, sSensorValueType) in oRegistry.lsChannels:
+			if oSensor.bEnabled == 1: # Values that are None are not added so they are not sent
+				oBatch.AddValue(oRegistry.sNodeID, oSensor.sName, sSensorValueType, oSensor.GetValue(sSensorValueType))
+		dictEnabled = dict((oSensor.sName, oSensor.bEnabled) for oSensor in oRegistry.lsCTVTSensors)
+		for (sName, dictValues) in self.lsEnergyValues:
+			if dictEnabled.get(sName) == 1:
+				for (sSensorValueType, dValue) in sorted(dictValues.items()):
+					oBatch.AddValue(oRegistry.sNodeID, sName, sSensorValueType, dValue, sFormat="%.4f" if sSensorValueType == "Energy_kWh" else "%.2f")
+
+	def Stop(self): # Stop reading the serial port
+		if self.oReader is not None:
+			self.oReader.Stop()
+
+
+class DHTPipeline(object): # Class used to take readings from the DHT22 sensors
+	def __init__(self, oDHTScheduler, nReadings=6, bDebugPrint=0, oAlerts=None):
+		self.oDHTScheduler = oDHTScheduler # Reads all the sensors at the same time
+		self.oAlerts = oAlerts # AlertEngine each reading is checked against as soon as it is read (see alerts.py). None = off.
+		self.nReadings = nReadings # Number of readings per cycle so outliers can be removed
+		self.bDebugPrint = bDebugPrint
+
+	def Read(self, oRegistry): # Take a set of readings and work out the final values
+		oSharedRecorder.AddDHTCycle(self.nReadings) # So a replay takes the same number of readings
+		if self.oAlerts is not None:
+			self.oAlerts.SetConfig(oRegistry.dictAlerts)
+		for item in oRegistry.lsDHTSensors:
+			item.ClearReadings()
+
+		for x in range(0, self.nReadings):
+			# Sometimes reading the sensors can fail becuase the linux kernal takes priority so each sensor is tried until its deadline
+			with oSharedMetrics.Time("stage_seconds", stage="dht_read"):
+				lsResults = self.oDHTScheduler.ReadAll(oRegistry.lsDHTSensors) # Only enabled sensors are read
+			for (item, dHumidity_P, dTemperature_C) in lsResults:
+				item.dHumidity_P, item.dTemperature_C = dHumidity_P, dTemperature_C
+				item.ErrorCheck() # Check the data is realistic
+				for (sSensorValueType, dRead, dChecked) in (("Humidity_P", dHumidity_P, item.dHumidity_P), ("Temperature_C", dTemperature_C, item.dTemperature_C)):
+					if dRead is not None: # Failed reads are counted by the scheduler
+						oSharedMetrics.Inc("readings_total", channel=item.sName + "_" + sSensorValueType, result="good" if dChecked is not None else "rejected")
+					if dChecked is not None and self.oAlerts is not None:
+						self.oAlerts.Check(item.sName + "_" + sSensorValueType, dChecked)
+				item.oHumidity_P.Add(item.dHumidity_P) # Add to the aggregators which are used later by the filters. None values are skipped.
+				item.oTemperature_C.Add(item.dTemperature_C)
+
+		if self.bDebugPrint == 1:
+			self.oDHTScheduler.PrintStats() # How well each sensor has been working and how many tries it will get next time
+
+		for item in oRegistry.lsDHTSensors:
+			if item.bEnabled == 1: # Only run if the sensor is enabled
+				with oSharedMetrics.Time("stage_seconds", stage="dht_filter"):
+					item.SetFinalValues() # Use the filters from the config. This removes any values that are within the limits of the sensor but are clearly false.
+
+			if self.bDebugPrint == 1: # Debug statements
+				if item.bEnabled == 0:
+					print(item.sName + ": Disabled")
+				elif item.dTemperature_C is not None and item.dHumidity_P is not None:
+					item.PrintValues()
+				else:
+					print(item.sName + ": Error Reading Sensor")
+
+	def AddToBatch(self, oBatch, oRegistry): # Add the final values to a batch for emoncms
+		for item in oRegistry.lsDHTSensors:
+			if item.bEnabled == 1: # Values that are None are not added so they are not sent
+				oBatch.AddValue(oRegistry.sNodeID, item.sName, "Temperature_C", item.dTemperature_C, sFormat="%.1f") # oDHT22 sensor can only give 1 decimal place
+				oBatch.AddValue(oRegistry.sNodeID, item.sName, "Humidity_P", item.dHumidity_P, sFormat="%.1f")
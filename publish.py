@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Decide which values in a batch need to be sent to emoncms so values that have not changed are not posted every
+# cycle. Used by the v2 scripts and collector.py between working out the final values and posting them.
+# Notes: The rules are in the "publish" section of sensors.json. "default" applies to every input and "inputs" can set a rule
+# for a type of reading (e.g. "Temperature_C") or for one input (e.g. "DHT1_Temperature_C"), which wins over the type.
+# Each rule can have:
+#	deadband - only send a value when it has moved more than this from the last value sent (report by exception). 0 sends
+#		any change. Leave it out (or null) to send every value as before.
+#	min_interval_s - never send an input more often than this, even if it has changed
+#	max_interval_s - always send an input at least this often even if it has not changed (heartbeat), so emoncms can still
+#		tell the sensor is working. null = never.
+# The last value sent and when it was sent are kept for every input and saved to a JSON file, so a restart or a cron run
+# carries on from where the last one stopped rather than sending everything again. A value only counts as sent once it
+# has been stored in the outbox or every server has accepted it, so a failed post is tried again on the next cycle.
+# The history (see history.py) is given every value, not just the ones sent.
+
+# --- Imports ---
+import os # Used to check for the state file
+import json # Used to load the last values sent
+import time # Used for the time each value was sent
+import threading # Used in case values are published from more than one thread
+from emoncms import EmoncmsBatch, PublishToServers # Used to build the batch of values to send and send it
+from metrics import oSharedMetrics # Used to count the values sent and held back
+from jsonfile import SaveJSON # Used to save the last values sent
+
+
+
+# --- Classes ---
+class PublishPolicy(object): # Class that keeps the last value sent for each input
+	def __init__(self, sPath=None, bDebugPrint=0):
+		self.sPath = sPath # JSON file the last values are saved to. None = only kept in memory.
+		self.bDebugPrint = bDebugPrint
+		self.Lock = threading.Lock()
+		self.dictLastSent = {} # "node/input" -> [value, time sent]
+		if sPath is not None and os.path.exists(sPath):
+			try:
+				with open(sPath) as f:
+					self.dictLastSent = json.load(f)
+			except ValueError: # A broken file only means everything is sent once more
+				if bDebugPrint == 1:
+					print("Publish state in " + sPath + " could not be read so it has been reset")
+
+	def Apply(self, oBatch, dictPublish, dNow=None): # Returns a new batch with only the values that need to be sent
+		dNow = time.time() if dNow is None else dNow
+		oSend = EmoncmsBatch()
+		nHeld = 0
+		with self.Lock:
+			for sNodeID in oBatch.lsNodeIDs:
+				for (sInputName, sValue, nTimestamp) in oBatch.dictValues[sNodeID]:
+					if self.IsDue(sNodeID + "/" + sInputName, sValue, dNow if nTimestamp is None else nTimestamp, GetRule(dictPublish, sInputName)):
+						oSend.AddInput(sNodeID, sInputName, sValue, nTimestamp)
+					else:
+						nHeld += 1
+		oSharedMetrics.Inc("publish_values_total", sum(len(lsValues) for lsValues in oSend.dictValues.values()), result="sent")
+		oSharedMetrics.Inc("publish_values_total", nHeld, result="held")
+		if self.bDebugPrint == 1:
+			print(str(nHeld) + " values have not changed enough to be sent")
+		return oSend
+
+	def IsDue(self, sKey, sValue, dTime, dictRule): # Returns True if a value needs to be sent
+		lsLast = self.dictLastSent.get(sKey)
+		if lsLast is None: # Never been sent
+			return True
+		dLastValue, dLastTime = lsLast
+		dElapsed_s = dTime - dLastTime
+		if dElapsed_s < dictRule.get("min_interval_s", 0):
+			return False
+		if dictRule.get("max_interval_s") is not None and dElapsed_s >= dictRule["max_interval_s"]: # Heartbeat
+			return True
+		if dictRule.get("deadband") is None:
+			return True
+		try:
+			return abs(float(sValue) - dLastValue) > dictRule["deadband"]
+		except (TypeError, ValueError): # Not a number so always send it
+			return True
+
+	def Commit(self, oBatch, dNow=None): # Record the values in a batch as sent and save them
+		dNow = time.time() if dNow is None else dNow
+		with self.Lock:
+			for sNodeID in oBatch.lsNodeIDs:
+				for (sInputName, sValue, nTimestamp) in oBatch.dictValues[sNodeID]:
+					try:
+						self.dictLastSent[sNodeID + "/" + sInputName] = [float(sValue), dNow if nTimestamp is None else nTimestamp]
+					except ValueError:
+						pass
+			if self.sPath is not None and not oBatch.IsEmpty():
+				SaveJSON(self.sPath, self.dictLastSent)
+
+
+
+# --- Functions ---
+def GetRule(dictPublish, sInputName): # Returns the rule for an input e.g. "CT1_RealPower_W"
+	dictInputs = dictPublish.get("inputs", {})
+	dictRule = dict(dictPublish.get("default", {}))
+	lsTypes = [sType for sType in dictInputs if sInputName.endswith("_" + sType)] # Type of reading e.g. "RealPower_W". Sensor names can have "_" in them so the input is not split.
+	if lsTypes:
+		dictRule.update(dictInputs[max(lsTypes, key=len)])
+	dictRule.update(dictInputs.get(sInputName, {}))
+	return dictRule
+
+def PublishChanges(oPolicy, lsServers, oBatch, dictPublish, bDebugPrint, oOutbox=None): # Post only the values that are due to all the enabled servers and return a list of PublishResults
+	if oPolicy is None: # Send everything
+		return PublishToServers(lsServers, oBatch, bDebugPrint, oOutbox)
+	dNow = time.time()
+	oSend = oPolicy.Apply(oBatch, dictPublish, dNow)
+	if oSend.IsEmpty() and oOutbox is None: # Nothing to send. With an outbox the servers are still posted to so any backlog is sent.
+		return []
+	lsResults = PublishToServers(lsServers, oSend, bDebugPrint, oOutbox)
+	if oOutbox is not None or all(oResult.bSuccess == 1 for oResult in lsResults): # The outbox will keep trying until each server has it
+		oPolicy.Commit(oSend, dNow)
+	return lsResults
+
+def SelfTest(): # Check the deadband, heartbeat and minimum interval rules and that the state is kept across a restart
+	import tempfile
+	import shutil
+	sPath = tempfile.mkdtemp()
+	try:
+		dictPublish = {"default": {"max_interval_s": 300}, "inputs": {"Temperature_C": {"deadband": 0.5, "min_interval_s": 60}, "DHT2_Temperature_C": {"deadband": 2}}}
+		oPolicy = PublishPolicy(os.path.join(sPath, "publish.json"))
+		lsSent = []
+		for (nTime, dValue) in ((0, 20.0), (60, 20.3), (120, 20.6), (150, 25.0), (180, 25.0), (480, 25.0)):
+			oBatch = EmoncmsBatch()
+			oBatch.AddValue("Room", "DHT1", "Temperature_C", dValue, nTime, "%.1f")
+			oBatch.AddValue("Room", "DHT2", "Temperature_C", dValue, nTime, "%.1f")
+			oBatch.AddValue("Room", "CT1", "RealPower_W", dValue, nTime) # No deadband so always sent
+			oSend = oPolicy.Apply(oBatch, dictPublish, nTime)
+			oPolicy.Commit(oSend, nTime)
+			lsSent.append(sorted(sInputName for (sInputName, sValue, nTimestamp) in oSend.dictValues.get("Room", [])))
+		lsExpected = [["CT1_RealPower_W", "DHT1_Temperature_C", "DHT2_Temperature_C"], ["CT1_RealPower_W"], ["CT1_RealPower_W", "DHT1_Temperature_C"],
+			["CT1_RealPower_W", "DHT2_Temperature_C"], ["CT1_RealPower_W", "DHT1_Temperature_C"], ["CT1_RealPower_W", "DHT1_Temperature_C", "DHT2_Temperature_C"]]
+		if lsSent != lsExpected:
+			raise AssertionError("Sent " + str(lsSent) + " but expected " + str(lsExpected))
+		oBatch = EmoncmsBatch()
+		oBatch.AddValue("Room", "DHT1", "Temperature_C", 25.1, 500, "%.1f")
+		if not PublishPolicy(os.path.join(sPath, "publish.json")).Apply(oBatch, dictPublish, 500).IsEmpty(): # After a restart
+			raise AssertionError("Last values sent were not kept across a restart")
+		if GetRule(dictPublish, "Rack_A_Temperature_C") != {"max_interval_s": 300, "deadband": 0.5, "min_interval_s": 60}: # Sensor name with "_" in it
+			raise AssertionError("Rule for a sensor name with _ in it is " + str(GetRule(dictPublish, "Rack_A_Temperature_C")))
+		print("Publish policy self test passed")
+	finally:
+		shutil.rmtree(sPath)
+
+
+
+# --- Main Code ---
+if __name__ == "__main__":
+	SelfTest()
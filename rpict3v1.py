@@ -0,0 +1,306 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Continuously read data from the RPICT3V1 board on a background thread. Used by read_board_v2.py
+# Notes: The serial port is kept open and every frame the board sends is parsed and stored in a ring buffer with a fixed
+# size, so the oldest frames are thrown away once it is full. Each frame is given a sequence number so the code using the
+# reader can ask for all the frames after the last one it saw without anything being missed or used twice.
+# The board sends one frame per line: node ID followed by the channel values separated by spaces e.g.
+# "11 RealPower1 RealPower2 RealPower3 Irms1 Irms2 Irms3 Vrms". Lines can be split across reads or corrupted so the decoder
+# keeps any partial line until the rest of it arrives and throws away anything that does not look like a frame.
+# SimulatedBoard pretends to be the serial port with a board attached (with noise and garbage lines) so the code can be
+# run on a machine without the board. Pass its Open method to SerialReader in place of opening the real port.
+# Run this file on its own to fuzz the decoder and measure how many frames per second it can parse.
+
+# --- Imports ---
+try:
+	import serial # Used for communicating with the RPICT3V1 Raspberry Pi board
+	SerialError = serial.SerialException
+except ImportError:
+	serial = None # Only needed to open the real port, the decoder and simulated board can be used without pyserial installed
+	SerialError = IOError
+import time # Used for the delay and timestamps
+import threading # Used to read the serial port in the background
+import collections # Used for the ring buffer
+import random # Used by the simulated board
+import operator # Used to scale the values of a frame in one step
+from array import array # Used to store the frames compactly
+from metrics import oSharedMetrics # Used to count the frames and time the serial reads
+from capture import oSharedRecorder # Used to record the raw data from the serial port when capturing is on
+
+
+
+# --- Classes ---
+class FrameBlock(object): # Class holding a number of decoded frames in flat arrays rather than a list per frame
+	def __init__(self, nChannels):
+		self.nChannels = nChannels
+		self.aNodeIDs = array('i') # One node ID per frame
+		self.aValues = array('d') # nChannels values per frame, one frame after another
+
+	def __len__(self):
+		return len(self.aNodeIDs)
+
+	def GetFrame(self, nIndex): # Returns the values in a frame as an array
+		return self.aValues[nIndex * self.nChannels:(nIndex + 1) * self.nChannels]
+
+	def GetChannel(self, nChannel): # Returns the values for one channel from every frame as an array
+		return self.aValues[nChannel::self.nChannels]
+
+
+class FrameDecoder(object): # Class used to turn the bytes from the board into frames
+	def __init__(self, nChannels=7, lsScale=None, nMaxLineLength=128):
+		self.nChannels = nChannels # Number of values after the node ID. 7 for the RPICT3V1.
+		self.lsScale = [1.0] * nChannels if lsScale is None else [float(dScale) for dScale in lsScale] # Each value is multiplied by its scale e.g. to divide by the turns ratio or convert mA to A
+		if len(self.lsScale) != nChannels:
+			raise ValueError("Need one scale per channel")
+		self.nMaxLineLength = nMaxLineLength # Anything longer than this without a new line is garbage
+		self.baPending = bytearray() # Part of a line that has not been finished yet
+		self.bSkipLine = 0 # Set after garbage has been thrown away so the rest of that line is not used
+		self.nFramesDecoded = 0
+		self.nFramesRejected = 0
+
+	def Feed(self, Data): # Add bytes (or a bytearray/memoryview) from the serial port and return a FrameBlock of the complete frames
+		try:
+			self.baPending += Data
+		except TypeError: # Python 2 can not add a memoryview to a bytearray
+			self.baPending += Data.tobytes()
+		oBlock = FrameBlock(self.nChannels)
+		nLast = self.baPending.rfind(b"\n")
+		if nLast >= 0:
+			lsLines = bytes(self.baPending[:nLast]).split(b"\n") # Every complete line in one go
+			del self.baPending[:nLast + 1] # Keep any partial line for next time
+			if self.bSkipLine == 1: # This is the end of a line that was too long so do not use it
+				self.bSkipLine = 0
+				del lsLines[0]
+			self.nFramesRejected += self.DecodeLines(lsLines, oBlock)
+		if len(self.baPending) > self.nMaxLineLength: # No new line for too long so throw it away and start again at the next new line
+			del self.baPending[:]
+			self.bSkipLine = 1
+			self.nFramesRejected += 1
+		return oBlock
+
+	def DecodeLines(self, lsLines, oBlock): # Decode complete lines and add the valid frames to the block. Returns the number of lines that were not valid frames.
+		nFields = self.nChannels + 1
+		lsScale = self.lsScale
+		aValues = oBlock.aValues # Looked up once rather than for every line
+		aNodeIDs = oBlock.aNodeIDs
+		nRejected = 0
+		for sLine in lsLines:
+			lsData = sLine.split(b" ") # The board puts one space between values. float() and int() ignore the \r at the end.
+			if len(lsData) != nFields:
+				lsData = sLine.split() # Slower but also copes with runs of spaces or tabs
+				if len(lsData) != nFields:
+					nRejected += 1
+					continue
+			try:
+				nNodeID = int(lsData[0])
+				lsValues = list(map(operator.mul, map(float, lsData[1:]), lsScale)) # Converted and scaled without a Python loop over the values
+			except ValueError:
+				nRejected += 1
+				continue
+			dSum = sum(lsValues)
+			if dSum - dSum != 0: # Only true if a value is nan or inf
+				nRejected += 1
+				continue
+			aValues.extend(lsValues)
+			aNodeIDs.append(nNodeID)
+		self.nFramesDecoded += len(lsLines) - nRejected
+		return nRejected
+
+
+class SerialReader(object): # Class used to read frames from the RPICT3V1 board in the background
+	def __init__(self, sPort='/dev/ttyAMA0', nBaudRate=38400, nBufferSize=1000, bDebugPrint=0, oDecoder=None, fnOpen=None, fnOnFrames=None):
+		self.sPort = sPort
+		self.nBaudRate = nBaudRate
+		self.fnOpen = OpenSerialPort if fnOpen is None else fnOpen # Called with the port and baud rate, e.g. SimulatedBoard().Open to run without the board
+		self.bDebugPrint = bDebugPrint
+		self.oDecoder = FrameDecoder() if oDecoder is None else oDecoder
+		self.fnOnFrames = fnOnFrames # Called with the timestamp and FrameBlock of each set of new frames as soon as they arrive, e.g. to check the alert rules
+		self.dqFrames = collections.deque(maxlen=nBufferSize) # Ring buffer of (sequence number, timestamp, values)
+		self.Lock = threading.Lock() # Stops the buffer being read while it is being written to
+		self.nLastSeq = 0 # Sequence number of the newest frame
+		self.bRunning = 0
+		self.Thread = None
+
+	def Start(self):
+		if self.bRunning == 1:
+			return
+		self.bRunning = 1
+		self.Thread = threading.Thread(target=self.Run)
+		self.Thread.daemon = True # The reader must not stop the script from exiting
+		self.Thread.start()
+
+	def Stop(self):
+		self.bRunning = 0
+		if self.Thread is not None:
+			self.Thread.join()
+			self.Thread = None
+
+	def Run(self): # Read from the serial port until Stop() is called. The port is opened again if there is an error.
+		while self.bRunning == 1:
+			try:
+				SerialConnection = self.fnOpen(self.sPort, self.nBaudRate)
+			except SerialError as e:
+				if self.bDebugPrint == 1:
+					print("Serial port error: " + str(e))
+				time.sleep(5) # Wait before trying to open the serial port again
+				continue
+			try:
+				while self.bRunning == 1:
+					dStart = time.time()
+					SerialResponse = SerialConnection.read(max(1, SerialConnection.inWaiting())) # Read whatever has arrived, waiting for at least 1 byte
+					if SerialResponse:
+						oSharedMetrics.Observe("serial_read_seconds", time.time() - dStart, port=self.sPort)
+						oSharedMetrics.Inc("serial_bytes_total", len(SerialResponse), port=self.sPort)
+						self.AddData(SerialResponse)
+			except SerialError as e:
+				oSharedMetrics.Inc("serial_errors_total", port=self.sPort)
+				if self.bDebugPrint == 1:
+					print("Serial port error: " + str(e))
+			finally:
+				SerialConnection.close()
+
+	def AddData(self, SerialResponse, dTimestamp=None): # Decode data from the board and add any complete frames to the buffer. dTimestamp is the time it was read when replaying a capture.
+		if self.bDebugPrint == 1:
+			print("Raw data: " + repr(SerialResponse)) # Print the raw serial port data (CSV format with space not comma)
+		nRejected = self.oDecoder.nFramesRejected
+		oBlock = self.oDecoder.Feed(SerialResponse)
+		oSharedMetrics.Inc("frames_total", len(oBlock), result="decoded")
+		oSharedMetrics.Inc("frames_total", self.oDecoder.nFramesRejected - nRejected, result="rejected")
+		dTimestamp = time.time() if dTimestamp is None else dTimestamp
+		with self.Lock:
+			oSharedRecorder.AddSerial(SerialResponse, dTimestamp) # Recorded while the buffer is locked so a replay puts each frame in the same cycle
+			for n in range(len(oBlock)):
+				self.nLastSeq += 1
+				self.dqFrames.append((self.nLastSeq, dTimestamp, oBlock.GetFrame(n)))
+		if self.fnOnFrames is not None and len(oBlock) > 0:
+			self.fnOnFrames(dTimestamp, oBlock)
+
+	def GetFramesAfter(self, nSeq): # Returns (list of (timestamp, values), sequence number of the newest frame) for frames after nSeq
+		with self.Lock:
+			oSharedRecorder.AddBoardCycle() # So a replay uses the same frames for each cycle
+			lsFrames = [(dTimestamp, aValues) for (nFrameSeq, dTimestamp, aValues) in self.dqFrames if nFrameSeq > nSeq]
+			return lsFrames, self.nLastSeq
+
+
+
+class SimulatedBoard(object): # Pretends to be the serial port with an RPICT3V1 board attached
+	def __init__(self, lsValues=None, dNoise=0.02, dGarbageRate=0.0, dFramesPerSecond=5.0, nNodeID=11, nSeed=None):
+		self.lsValues = [800.0, 1600.0, 2400.0, 3704.0, 7407.0, 11111.0, 240.0] if lsValues is None else lsValues # Values as the board sends them e.g. power and current multiplied by the turns ratio, current in mA. A power factor of 0.9 with a turns ratio of 8.
+		self.dNoise = dNoise # Each value is changed by up to this fraction either way
+		self.dGarbageRate = dGarbageRate # Fraction of lines that are garbage or cut short
+		self.dFramesPerSecond = dFramesPerSecond # None = send frames as fast as they are read, e.g. to measure throughput
+		self.nNodeID = nNodeID
+		self.Random = random.Random(nSeed)
+		self.baBuffer = bytearray() # Bytes that have been sent but not read yet
+		self.dNextFrame = None # Time the next frame is due
+		self.nFramesSent = 0 # Number of good frames sent
+		self.nGarbageSent = 0 # Number of bad lines sent
+
+	def Open(self, sPort, nBaudRate): # Used as the SerialReader's fnOpen
+		self.dNextFrame = time.time()
+		return self
+
+	def MakeLine(self): # Returns the next line the board would send
+		if self.Random.random() < self.dGarbageRate:
+			self.nGarbageSent += 1
+			if self.Random.random() < 0.5: # Frame cut short
+				return ("%d %.2f %.2f\r\n" % (self.nNodeID, self.lsValues[0], self.lsValues[1])).encode("ascii")
+			return ("".join(self.Random.choice("abcxyz!@# ") for x in range(self.Random.randint(0, 40))) + "\r\n").encode("ascii")
+		self.nFramesSent += 1
+		lsValues = [dValue * (1 + self.Random.uniform(-self.dNoise, self.dNoise)) for dValue in self.lsValues]
+		return (str(self.nNodeID) + " " + " ".join("%.2f" % dValue for dValue in lsValues) + "\r\n").encode("ascii")
+
+	def inWaiting(self): # Same as pyserial. Returns the number of bytes waiting to be read.
+		if self.dFramesPerSecond is None:
+			return 4096
+		while self.dNextFrame <= time.time(): # Add the frames that are due
+			self.baBuffer += self.MakeLine()
+			self.dNextFrame += 1.0 / self.dFramesPerSecond
+		return len(self.baBuffer)
+
+	def read(self, nBytes): # Same as pyserial. Waits for at least 1 byte (up to a 1 second timeout) and returns up to nBytes.
+		if self.dFramesPerSecond is None:
+			while len(self.baBuffer) < nBytes:
+				self.baBuffer += self.MakeLine()
+		elif self.inWaiting() == 0:
+			time.sleep(min(1.0, max(0, self.dNextFrame - time.time())))
+			self.inWaiting()
+		nBytes = min(nBytes, len(self.baBuffer), self.Random.randint(1, 256)) # Lines arrive split at random points as they can from the real port
+		Data = bytes(self.baBuffer[:nBytes])
+		del self.baBuffer[:nBytes]
+		return Data
+
+	def close(self):
+		pass
+
+
+
+# --- Functions ---
+def OpenSerialPort(sPort, nBaudRate): # Open the real serial port
+	return serial.Serial(sPort, nBaudRate, timeout=1) # The timeout lets the reader's thread check if it should stop
+
+def ChannelScale(sSensorValueType, nTurnsRatio): # Scale for one channel. Real power is divided by the turns ratio, current is in mA and also divided by the turns ratio.
+	if sSensorValueType == "RealPower_W":
+		return 1.0 / nTurnsRatio
+	if sSensorValueType == "Irms_A":
+		return 0.001 / nTurnsRatio
+	return 1.0 # Voltage is not scaled
+
+def BoardScale(lsTurnsRatios): # Scales for the RPICT3V1 channels in the order the board sends them
+	return [ChannelScale("RealPower_W", nTurnsRatio) for nTurnsRatio in lsTurnsRatios] + [ChannelScale("Irms_A", nTurnsRatio) for nTurnsRatio in lsTurnsRatios] + [ChannelScale("Vrms_V", 1)]
+
+def Benchmark(nFrames=200000, nSeed=1): # Fuzz the decoder with garbage and random chunk sizes, check every good frame is found and time it
+	oRandom = random.Random(nSeed)
+	lsLines = []
+	nGood = 0
+	for n in range(nFrames):
+		dChoice = oRandom.random()
+		if dChoice < 0.05: # Garbage line
+			lsLines.append("".join(oRandom.choice("abcxyz!@# ") for x in range(oRandom.randint(0, 40))) + "\n")
+		elif dChoice < 0.06: # Noise with no new line for longer than a frame could be
+			lsLines.append("".join(oRandom.choice("abcxyz ") for x in range(300)) + "\n")
+		elif dChoice < 0.08: # Frame cut short
+			lsLines.append("11 %.1f %.1f %.1f\n" % (oRandom.uniform(0, 900), oRandom.uniform(0, 900), oRandom.uniform(0, 900)))
+		else:
+			lsLines.append("11 %.2f %.2f %.2f %.1f %.1f %.1f %.2f\r\n" % tuple([oRandom.uniform(0, 4000) for x in range(3)] + [oRandom.uniform(0, 15000) for x in range(3)] + [oRandom.uniform(200, 270)]))
+			nGood += 1
+	Data = "".join(lsLines).encode("ascii")
+	lsChunks = []
+	nPos = 0
+	while nPos < len(Data): # Split the data at random points as the serial port would
+		nSize = oRandom.randint(1, 256)
+		lsChunks.append(memoryview(Data)[nPos:nPos + nSize])
+		nPos += nSize
+
+	oDecoder = FrameDecoder(7, BoardScale([8, 8, 8]))
+	dStart = time.time()
+	nDecoded = 0
+	for Chunk in lsChunks:
+		nDecoded += len(oDecoder.Feed(Chunk))
+	dElapsed_s = time.time() - dStart
+	print("Frames sent: " + str(nGood) + ", decoded: " + str(nDecoded) + ", rejected: " + str(oDecoder.nFramesRejected))
+	print("Decoder: " + "%.0f" % (nDecoded / dElapsed_s) + " frames/s in chunks of up to 256 bytes as read from the serial port")
+	if nDecoded != nGood:
+		raise AssertionError("Decoder did not find every good frame")
+
+	oDecoder = FrameDecoder(7, BoardScale([8, 8, 8]))
+	dStart = time.time()
+	oDecoder.Feed(Data)
+	print("Decoder: " + "%.0f" % (nGood / (time.time() - dStart)) + " frames/s with all the data in one chunk")
+
+	dStart = time.time() # The old way of reading a line at a time for comparison. This does not handle split lines, garbage that splits into 8 values, nan or inf.
+	lsFrames = []
+	for sLine in Data.split(b"\n"):
+		lsData = sLine.split(b" ")
+		if len(lsData) == 8:
+			try:
+				lsFrames.append([float(lsData[1]) / 8, float(lsData[2]) / 8, float(lsData[3]) / 8, float(lsData[4]) / 1000 / 8, float(lsData[5]) / 1000 / 8, float(lsData[6]) / 1000 / 8, float(lsData[7][:-1])])
+			except ValueError:
+				pass
+	print("Split per line: " + "%.0f" % (nGood / (time.time() - dStart)) + " frames/s with all the data in one chunk")
+
+
+
+# --- Main Code ---
+if __name__ == "__main__":
+	Benchmark()
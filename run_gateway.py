@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Receive the readings from the collectors in many server rooms and forward them to the emoncms servers in bulk.
+# Notes: Each room's Pi is given a server with an address like "udp://<this machine>:5005" in its sensors.json (and no
+# other servers) and sends its readings here instead of posting to emoncms itself. The readings are written to an outbox
+# for each of the servers listed in this machine's sensors.json as they arrive, and sent on every dForwardInterval_s, so
+# nothing is lost while a server is down or if this script is restarted. See gateway.py for how the readings are sent,
+# checked for duplicates and forwarded.
+
+# --- Imports ---
+import os # Used for the outbox path
+from config import GetRegistry, sDefaultPath # Used to load the emoncms servers from sensors.json
+from gateway import Gateway # Used to receive the readings and forward them
+from outbox import Outbox # Used to keep readings on disk until the servers have them
+from scheduler import FixedIntervalScheduler # Used to forward the readings at a fixed interval
+from metrics import oSharedMetrics, MetricsServer # Used to see how many packets and values are coming in
+
+
+
+# --- Functions ---
+def GetServers(): # Servers to forward to. Only read again if sensors.json has been changed.
+	return [oServer for oServer in GetRegistry(sConfigPath).lsServers if not oServer.sAddress.lower().startswith("udp://")] # Never forward to another gateway
+
+def Forward(): # Forward everything received since the last time
+	oGateway.lsServers = GetServers()
+	oGateway.Forward()
+	if bDebugPrint == 1:
+		oGateway.PrintStats()
+
+
+
+# --- Control Settings ---
+bDebugPrint = 0 # 0/1 will disable/enable debug print statements
+sAddress = "0.0.0.0" # Address to receive on. "0.0.0.0" = any network the machine is on.
+nPort = 5005 # UDP port the collectors send to
+dForwardInterval_s = 10 # Time between forwards to the emoncms servers
+sOutboxPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "outbox_gateway.db") # Database used to keep the readings
+nMaxRowsPerCycle = 500000 # Most readings sent to each server per forward. Roughly 100 readings are sent in each request.
+nMetricsPort = 9106 # Port the metrics are served on at /metrics (Prometheus) and /metrics.json. None = off.
+sConfigPath = sDefaultPath # File listing the emoncms servers to forward to
+
+
+
+# --- Main Code ---
+oOutbox = Outbox(sOutboxPath, nMaxRows=10000000, nMaxRowsPerCycle=nMaxRowsPerCycle)
+oGateway = Gateway(GetServers(), oOutbox, sAddress, nPort, bDebugPrint=bDebugPrint).Start() # The servers are needed before the first packet arrives as the readings are stored for each of them
+if nMetricsPort is not None:
+	MetricsServer(oSharedMetrics, nMetricsPort).Start() # e.g. curl http://localhost:9106/metrics
+try:
+	FixedIntervalScheduler(dForwardInterval_s, bDebugPrint).Run(Forward)
+finally:
+	oGateway.Stop()
+	Forward() # Anything received since the last forward
+	oOutbox.Close()
+
+
+
+if bDebugPrint == 1:
+	print("Script Finished")
+#End of script
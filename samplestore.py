@@ -0,0 +1,65 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Store the readings from all the channels of a board in one numpy array. Used by read_board_v2.py
+# Notes: The array has one row per frame and one column per channel and is set up once with a fixed number of rows. When it
+# is full the oldest rows are overwritten. Scaling (turns ratio, mA to A) and the range check are each done in one numpy
+# operation over every channel, rather than in a Python loop per sensor, so adding more CTs costs very little.
+# A mask records which values passed the range check so bad values are left out of the final values. GetFiltered() passes
+# the good values, oldest first, to filters.py so each channel can use its own outlier filter.
+
+# --- Imports ---
+import numpy as np # Used for the array
+from filters import ApplyFilters # Used to remove outliers from each channel
+
+
+
+# --- Classes ---
+class SampleStore(object): # Class holding the readings for a number of channels
+	def __init__(self, nChannels, nCapacity=1024, lsScale=None, lsMin=None, lsMax=None, nDecimals=2):
+		self.nChannels = nChannels
+		self.nCapacity = nCapacity # Number of frames that can be stored
+		self.aScale = np.ones(nChannels) if lsScale is None else np.asarray(lsScale, dtype=float) # Each channel is multiplied by its scale
+		self.aMin = np.full(nChannels, -np.inf) if lsMin is None else np.asarray(lsMin, dtype=float) # Values outside of min to max are bad data
+		self.aMax = np.full(nChannels, np.inf) if lsMax is None else np.asarray(lsMax, dtype=float)
+		self.nDecimals = nDecimals
+		self.aSamples = np.zeros((nCapacity, nChannels)) # Set up once so no memory is allocated while running
+		self.aValid = np.zeros((nCapacity, nChannels), dtype=bool) # True where the value passed the range check
+		self.Clear()
+
+	def Clear(self): # Remove all the frames e.g. at the start of a new cycle
+		self.nNext = 0 # Row the next frame is written to
+		self.nCount = 0 # Number of rows in use
+		self.aValid[:] = False
+
+	def AddFrames(self, lsFrames): # Add a list of frames (or a 2D array) from the board. Returns the number of frames added.
+		aFrames = np.asarray(lsFrames, dtype=float).reshape(-1, self.nChannels)
+		if len(aFrames) > self.nCapacity: # Only the newest frames fit
+			aFrames = aFrames[-self.nCapacity:]
+		nFrames = len(aFrames)
+		if nFrames == 0:
+			return 0
+		aRows = (self.nNext + np.arange(nFrames)) % self.nCapacity # Wrap around to the start when the end is reached
+		aScaled = np.round(aFrames * self.aScale, self.nDecimals) # Scale every channel at once
+		self.aSamples[aRows] = aScaled
+		self.aValid[aRows] = (aScaled >= self.aMin) & (aScaled <= self.aMax) # Range check every channel at once
+		self.nNext = (self.nNext + nFrames) % self.nCapacity
+		self.nCount = min(self.nCount + nFrames, self.nCapacity)
+		return nFrames
+
+	def GetOrdered(self): # Returns the values with one row per frame, oldest first, and NaN where a value failed the range check
+		aRows = (self.nNext - self.nCount + np.arange(self.nCount)) % self.nCapacity # The oldest row is overwritten first once the store is full
+		return np.where(self.aValid[aRows], self.aSamples[aRows], np.nan)
+
+	def GetFiltered(self, lsFilters): # Final value of each channel using its filter (see filters.py). Channels with no good values are None.
+		return ApplyFilters(self.GetOrdered(), lsFilters)
+
+	def GetCounts(self): # Number of good and bad values for each channel
+		aValid = self.aValid[:self.nCount]
+		aGood = aValid.sum(axis=0)
+		return aGood, self.nCount - aGood
+
+	def PrintValues(self, lsNames):
+		aGood, aBad = self.GetCounts()
+		for n in range(self.nChannels):
+			aValues = self.aSamples[:self.nCount, n][self.aValid[:self.nCount, n]]
+			print(lsNames[n] + ": " + str(aValues.tolist()) + " (" + str(aBad[n]) + " removed by the error check)")
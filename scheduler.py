@@ -0,0 +1,56 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Run a function at a fixed interval so the scripts can keep running instead of being started by cron every minute.
+# Notes: Cycle start times are worked out from when the scheduler started rather than from when the last cycle finished, so
+# the time taken by each cycle does not make the readings drift. If a cycle overruns, the missed slots are skipped.
+
+# --- Imports ---
+import time # Used for the delay
+from metrics import oSharedMetrics # Used to time each cycle
+try:
+	Clock = time.monotonic # Not affected by the system clock being changed e.g. by NTP. Python 3
+except AttributeError:
+	Clock = time.time # Python 2
+
+
+
+# --- Classes ---
+class FixedIntervalScheduler(object): # Class used to call a function every dInterval_s seconds
+	def __init__(self, dInterval_s, bDebugPrint=0):
+		self.dInterval_s = float(dInterval_s)
+		self.bDebugPrint = bDebugPrint
+		self.bRunning = 0
+		self.nCycles = 0 # Number of cycles that have been run
+		self.nSkipped = 0 # Number of slots missed because a cycle overran
+
+	def Run(self, fnCycle, nMaxCycles=None): # Call fnCycle every interval until Stop() is called or nMaxCycles have run
+		self.bRunning = 1
+		dStart = Clock()
+		nSlot = 0
+		while self.bRunning == 1:
+			dCycleStart = Clock()
+			try:
+				fnCycle()
+			except Exception: # An error in one cycle should not stop the readings being taken in the next one
+				oSharedMetrics.Inc("cycle_errors_total")
+				import traceback # Used to print errors without stopping the scheduler. Only imported when there is an error.
+				traceback.print_exc()
+			oSharedMetrics.Observe("cycle_seconds", Clock() - dCycleStart)
+			self.nCycles += 1
+			if nMaxCycles is not None and self.nCycles >= nMaxCycles:
+				break
+
+			nSlot += 1
+			dNow = Clock()
+			nDueSlot = int((dNow - dStart) // self.dInterval_s) + 1 # The next slot that has not already started
+			if nDueSlot > nSlot:
+				self.nSkipped += nDueSlot - nSlot
+				oSharedMetrics.Inc("cycle_skipped_total", nDueSlot - nSlot)
+				if self.bDebugPrint == 1:
+					print("Cycle overran so " + str(nDueSlot - nSlot) + " slot(s) have been skipped")
+				nSlot = nDueSlot
+			time.sleep(max(0, dStart + nSlot * self.dInterval_s - Clock()))
+		self.bRunning = 0
+
+	def Stop(self):
+		self.bRunning = 0
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Classes for the sensors. Used by config.py which creates them from sensors.json, and by the v2 scripts.
+# Notes: The range of good readings for each sensor comes from its class unless it is set for that sensor in the config.
+# Each type of reading also has a filter (see filters.py) that removes outliers and works out the value sent to emoncms.
+# The classes use __slots__ as a new set of sensors is made each time the config file changes in daemon mode.
+
+# --- Imports ---
+from aggregate import StreamingAggregator # Used for percentiles
+
+
+
+# --- Classes ---
+class CTVTSensor(object): # Class for the CT and VT sensors
+	__slots__ = ("sName", "bEnabled", "sNodeID", "dRealPower_W", "dIrms_A", "dVrms_V", "nTurnsRatio", "dictLimits", "dictFilters")
+	dictDefaultLimits = { # Range of each type of reading. Readings outside of the range are bad data.
+		"RealPower_W": (0, 4000), # Roughly 13A @ 253V
+		"Irms_A": (0, 15), # Circuits should not go above 13A standard UK socket
+		"Vrms_V": (200, 270), # UK limits are 216.2V to 253V (-6% / +10%)
+	}
+
+	def __init__(self, sName, nTurnsRatio, bEnabled=0, dictLimits=None, dictFilters=None): # This is run when an onject is first created
+		self.sName = sName
+		self.bEnabled = bEnabled
+		self.sNodeID = None
+		self.dRealPower_W = None
+		self.dIrms_A = None
+		self.dVrms_V = None
+		self.nTurnsRatio = nTurnsRatio
+		self.dictLimits = dict(CTVTSensor.dictDefaultLimits) # Copy so one sensor's limits can be changed without changing the others
+		self.dictLimits.update(dictLimits or {})
+		self.dictFilters = dict((sSensorValueType, dictDefaultFilter) for sSensorValueType in self.dictLimits) # Filter for each type of reading
+		self.dictFilters.update(dictFilters or {})
+
+	def ClearReadings(self): # Clear the readings from the last cycle
+		self.dRealPower_W = None
+		self.dIrms_A = None
+		self.dVrms_V = None
+
+	def SetValue(self, sSensorValueType, dValue): # Set a reading by its type e.g. "Irms_A"
+		if sSensorValueType == "RealPower_W":
+			self.dRealPower_W = dValue
+		elif sSensorValueType == "Irms_A":
+			self.dIrms_A = dValue
+		elif sSensorValueType == "Vrms_V":
+			self.dVrms_V = dValue
+
+	def GetValue(self, sSensorValueType): # Get a reading by its type e.g. "Irms_A"
+		return getattr(self, "d" + sSensorValueType)
+
+	def PrintValues(self):
+		if self.bEnabled == 1: # Only print values if the sensors has been enabled
+			if self.sNodeID is not None: # Only print if the value has been populated
+				print(self.sName + " Node ID: " + self.sNodeID)
+			if self.dRealPower_W is not None:
+				print(self.sName + " Real Power: " + "%.2f" % self.dRealPower_W + " W")
+			if self.dIrms_A is not None:
+				print(self.sName + " Current: " + "%.2f" % self.dIrms_A + " A")
+			if self.dVrms_V is not None:
+				print( self.sName + " Voltage: " + "%.2f" % self.dVrms_V + " V")
+
+	def ErrorCheck (self): # Check that the sensor reading are within the range of the sensor i.e. not bad data
+		for sSensorValueType, dValue in (("RealPower_W", self.dRealPower_W), ("Irms_A", self.dIrms_A), ("Vrms_V", self.dVrms_V)):
+			dMin, dMax = self.dictLimits[sSensorValueType]
+			if dValue is not None and not dMin <= dValue <= dMax: # Values that are not used by this sensor are None
+				self.SetValue(sSensorValueType, None) # Data is bad so set it to None so its not used later on in the code.
+
+
+class DHTSensor(object): # Class for the oDHT22 sensors
+	__slots__ = ("sName", "nPin", "bEnabled", "dictLimits", "dictFilters", "dTemperature_C", "oTemperature_C", "dHumidity_P", "oHumidity_P")
+	dictDefaultLimits = { # Range of each type of reading. Readings outside of the range are bad data.
+		"Temperature_C": (-40, 80),
+		"Humidity_P": (0, 100),
+	}
+
+	def __init__(self, sName, nPin, bEnabled=0, dictLimits=None, nWindowSize=256, dPercentile=80, dictFilters=None): # This is run when an onject is first created
+		self.sName = sName
+		self.nPin = nPin # RPi GPIO pin number the sensor is connected to
+		self.bEnabled = bEnabled
+		self.dictLimits = dict(DHTSensor.dictDefaultLimits)
+		self.dictLimits.update(dictLimits or {})
+		self.dictFilters = dict((sSensorValueType, dictDefaultFilter) for sSensorValueType in self.dictLimits)
+		self.dictFilters.update(dictFilters or {})
+		self.dTemperature_C = None
+		self.oTemperature_C = StreamingAggregator(nWindowSize, dPercentile) # Summary of the readings taken this cycle
+		self.dHumidity_P = None
+		self.oHumidity_P = StreamingAggregator(nWindowSize, dPercentile)
+
+	def ClearReadings(self): # Clear the readings from the last cycle
+		self.dTemperature_C = None
+		self.oTemperature_C.Reset()
+		self.dHumidity_P = None
+		self.oHumidity_P.Reset()
+
+	def SetFinalValues(self): # Work out the values sent to emoncms from this cycle's readings using each reading's filter
+		self.dTemperature_C = self.GetFinalValue("Temperature_C", self.oTemperature_C) # The value is None if there were no good readings so the data is not sent to EMONCMS
+		self.dHumidity_P = self.GetFinalValue("Humidity_P", self.oHumidity_P)
+
+	def GetFinalValue(self, sSensorValueType, oAggregator):
+		dictFilter = self.dictFilters[sSensorValueType]
+		if len(oAggregator.oWindow) <= nSmallWindow:
+			return oAggregator.GetFiltered(dictFilter) # Done without numpy
+		from filters import FilterValues # Only imported for large windows so numpy is not loaded for the usual 6 readings
+		return FilterValues(oAggregator.oWindow.GetValues(), dictFilter)
+
+	def PrintValues(self):
+		if self.bEnabled == 1: # Only print values if the sensors has been enabled
+			print(self.sName + ': Temperature = {0:0.1f} *C  Humidity = {1:0.1f} %'.format(self.dTemperature_C, self.dHumidity_P))
+
+	def ErrorCheck (self): # Check that the sensor reading are within the range of the sensor i.e. not bad data
+		dMin, dMax = self.dictLimits["Temperature_C"]
+		if self.dTemperature_C is None or not dMin <= self.dTemperature_C <= dMax: # The reading is None if the sensor could not be read
+			self.dTemperature_C = None # Data is bad so set it to None so its not used later on in the code.
+		dMin, dMax = self.dictLimits["Humidity_P"]
+		if self.dHumidity_P is None or not dMin <= self.dHumidity_P <= dMax:
+			self.dHumidity_P = None
+
+
+
+# --- Main Code ---
+dictDefaultFilter = {"method": "percentile", "percentile": 80} # Used when no filter is set in the config
+nSmallWindow = 128 # Windows up to this many readings are filtered in plain Python rather than numpy, which is quicker below about this size (see aggregate.py)
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# Author: sehattersley
+# Purpose: Run the slow parts of a cycle (saving the history, posting to emoncms) on their own threads so taking the readings
+# never has to wait for them. Used by collector.py
+# Notes: Each Stage has a worker thread and a bounded queue. The cycle puts its batch on the queue and carries straight on,
+# so a slow or unreachable server or a slow SD card can not delay the next set of readings, and a slow sensor can not
+# delay a post. If a stage falls so far behind that its queue is full, the oldest item is dropped (and counted) rather than
+# the cycle waiting or memory growing. With the outbox on, posting keeps up even when a server is down as each post is
+# limited to the server's timeout. Values are given the time they were read before being queued (see
+# EmoncmsBatch.SetTimestamp) so a batch posted late still has the right times in emoncms.
+# The serial port and DHT22 sensors are already read on their own threads (see rpict3v1.py and dht.py). Threads are used
+# rather than asyncio because the serial, DHT22 and HTTP libraries all block and the scripts also run on Python 2.
+
+# --- Imports ---
+import threading # Used for the worker thread and to wait for items
+import collections # Used for the queue
+import time # Used for the stop timeout
+from metrics import oSharedMetrics # Used to show how far behind each stage is
+
+
+
+# --- Classes ---
+class Stage(object): # Class for a worker thread that handles items from a bounded queue
+	def __init__(self, sName, fnProcess, nMaxQueue=60, bDebugPrint=0):
+		self.sName = sName # Used for the metrics e.g. "publish"
+		self.fnProcess = fnProcess # Called on the worker thread with each item
+		self.nMaxQueue = nMaxQueue # Most items waiting before the oldest is dropped
+		self.bDebugPrint = bDebugPrint
+		self.dqQueue = collections.deque()
+		self.Condition = threading.Condition()
+		self.bRunning = 0
+		self.nBusy = 0 # 1 while an item is being handled
+		self.nDone = 0
+		self.nDropped = 0
+		self.oThread = None
+
+	def Start(self):
+		with self.Condition:
+			if self.bRunning == 1:
+				return self
+			self.bRunning = 1
+		self.oThread = threading.Thread(target=self.Run)
+		self.oThread.daemon = True # A hung server must not stop the script from exiting
+		self.oThread.start()
+		return self
+
+	def Put(self, Item): # Queue an item without waiting. Returns 0 if the oldest item had to be dropped to make room.
+		bRoom = 1
+		with self.Condition:
+			if len(self.dqQueue) >= self.nMaxQueue:
+				self.dqQueue.popleft()
+				self.nDropped += 1
+				bRoom = 0
+			self.dqQueue.append(Item)
+			nQueued = len(self.dqQueue)
+			self.Condition.notify()
+		oSharedMetrics.Set("stage_queue_length", nQueued, stage=self.sName)
+		if bRoom == 0:
+			oSharedMetrics.Inc("stage_dropped_total", stage=self.sName)
+			if self.bDebugPrint == 1:
+				print(self.sName + " stage is behind so the oldest item has been dropped")
+		return bRoom
+
+	def Run(self): # Worker thread
+		while True:
+			with self.Condition:
+				while self.bRunning == 1 and len(self.dqQueue) == 0:
+					self.Condition.wait()
+				if len(self.dqQueue) == 0: # Stopped and nothing left to do
+					return
+				Item = self.dqQueue.popleft()
+				self.nBusy = 1
+				nQueued = len(self.dqQueue)
+			oSharedMetrics.Set("stage_queue_length", nQueued, stage=self.sName)
+			try:
+				with oSharedMetrics.Time("stage_seconds", stage=self.sName):
+					self.fnProcess(Item)
+			except Exception: # An error with one item should not stop the stage
+				oSharedMetrics.Inc("stage_errors_total", stage=self.sName)
+				import traceback # Only imported when there is an error
+				traceback.print_exc()
+			with self.Condition:
+				self.nBusy = 0
+				self.nDone += 1
+				self.Condition.notify_all()
+
+	def Wait(self, dTimeout_s=None): # Wait until every queued item has been handled. Returns 1 if they were all done in time.
+		dStop = None if dTimeout_s is None else time.time() + dTimeout_s
+		with self.Condition:
+			while len(self.dqQueue) > 0 or self.nBusy == 1:
+				if dStop is None:
+					self.Condition.wait(1.0)
+				elif time.time() >= dStop:
+					return 0
+				else:
+					self.Condition.wait(dStop - time.time())
+		return 1
+
+	def Stop(self, dTimeout_s=60): # Finish the items already queued, then stop the worker thread
+		with self.Condition:
+			self.bRunning = 0
+			self.Condition.notify_all()
+		if self.oThread is not None:
+			self.oThread.join(dTimeout_s)
+			self.oThread = None
+
+	def GetLength(self): # Number of items waiting
+		with self.Condition:
+			return len(self.dqQueue)
+
+
+
+# --- Functions ---
+def SelfTest(): # Check a slow stage does not hold up the items being put on it and drops the oldest when full
+	lsDone = []
+	def SlowProcess(Item):
+		time.sleep(0.05)
+		lsDone.append(Item)
+	oStage = Stage("test", SlowProcess, nMaxQueue=5).Start()
+	dStart = time.time()
+	for n in range(10):
+		oStage.Put(n)
+	dPut_s = time.time() - dStart
+	if dPut_s > 0.02:
+		raise AssertionError("Putting items waited for the stage: " + "%.3f" % dPut_s + " s")
+	oStage.Stop()
+	if oStage.nDropped not in (4, 5) or lsDone[-5:] != [5, 6, 7, 8, 9]: # 4 if the worker had already taken the first item
+		raise AssertionError("Expected the oldest items to be dropped, done " + str(lsDone) + ", dropped " + str(oStage.nDropped))
+	print("Stage self test passed: " + str(len(lsDone)) + " items done, " + str(oStage.nDropped) + " dropped, putting 10 items took " + "%.2f" % (dPut_s * 1000) + " ms")
+
+
+
+# --- Main Code ---
+if __name__ == "__main__":
+	SelfTest()